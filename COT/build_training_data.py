@@ -0,0 +1,335 @@
+"""
+Build the SFT / DPO training JSONL (swift messages format) for train/train.sh
+
+Streams the generate_COT.py output, joins every CoT with its NTSB record and
+judge scores by ev_id (indexed corpus lookups, nothing is loaded whole), drops
+low-scoring and over-long samples, and splits train / val by a hash of ev_id.
+Token lengths are measured with the model's fast tokenizer, in batches, in a
+process pool.
+
+    COT/sft_data/train.jsonl, val.jsonl    {"messages": [user, assistant]}
+    COT/dpo_data/train.jsonl, val.jsonl    {"messages": [user, assistant(chosen)], "rejected_response": ...}
+"""
+import os
+import sys
+import glob
+import json
+import hashlib
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from utils.corpus import open_corpus
+from utils.json_stream import iter_records
+
+
+# ================= Configuration Area =================
+RAW_FILE = "./evaluation/generate_COT_eva/sample.json"                              # NTSB records (narr_accp, narr_cause)
+COT_FILE = "./evaluation/generate_COT_eva/results/DeepSeek-V3.2_cot.json"           # generate_COT.py output
+COT_SCORES_FILE = "./evaluation/generate_COT_eva/eva_results/DeepSeek-V3.2_scores.json"  # generate_COT_eva scores; None to skip the score filter
+
+SFT_DIR = "./COT/sft_data"
+DPO_DIR = "./COT/dpo_data"
+
+# Other answers to the same records, for DPO pairs: per ev_id the best-scoring candidate (the
+# CoT above included) is "chosen" and the worst one "rejected". Leave empty to build SFT only.
+DPO_CANDIDATES = [
+    # {"generations": "./evaluation/contrast_eva/process_results/Qwen3-8B.json",
+    #  "scores": "./evaluation/contrast_eva/eva_results/Qwen3-8B_scores.json"},
+]
+DPO_MIN_MARGIN = 0.25   # Mean-score gap required between chosen and rejected
+
+# Score filter (0-1 judge scores): mean over SCORE_METRICS, plus optional per-metric floors
+SCORE_METRICS = ["faithfulness", "logicality", "support", "completeness", "ntsb_style"]
+MIN_MEAN_SCORE = 0.75
+MIN_METRIC_SCORES = {"faithfulness": 0.5}
+
+# Token length filter: the chat-template-rendered sample must fit train.sh's --max_length
+TOKENIZER_PATH = "./Qwen/Qwen3-8B"   # None: estimate ~4 characters per token, no tokenizer needed
+MAX_LENGTH = 2048
+
+VAL_RATIO = 0.05        # Share of ev_ids in val.jsonl, by hash: stable across runs and data additions
+SHARD_RECORDS = None    # e.g. 50000 -> train-00000.jsonl, train-00001.jsonl, ...; None -> train.jsonl
+NUM_PROC = 4            # Tokenizer processes
+CHUNK_SIZE = 512        # Samples per tokenizer batch
+# ======================================================
+
+# Same user prompt as build_request() in evaluation/contrast_eva/generate_response_loar.py
+PROMPT_SUFFIX = "\n\n Please analyze the causes that led to this accident."
+
+
+# =============================
+# Samples
+# =============================
+def user_message(raw):
+    content = raw.get("narr_accp", "")
+    if not content:
+        return None
+    return {"role": "user", "content": content + PROMPT_SUFFIX}
+
+
+def response_text(item, raw):
+    """Assistant turn of a candidate: <think>CoT</think> + answer (the official cause for generate_COT output)."""
+    if item.get("model_output") and not item.get("chain_of_thought"):
+        return item["model_output"].strip()
+    cot = (item.get("chain_of_thought") or "").strip()
+    if not cot:
+        return None
+    answer = (item.get("answer") or raw.get("narr_cause") or "").strip()
+    if not answer:
+        return None
+    return f"<think>\n{cot}\n</think>\n\n{answer}"
+
+
+def mean_score(scores):
+    values = [scores[m] for m in SCORE_METRICS if isinstance(scores.get(m), (int, float))]
+    return sum(values) / len(values) if values else None
+
+
+def passes_scores(scores):
+    mean = mean_score(scores)
+    if mean is None or mean < MIN_MEAN_SCORE:
+        return False
+    return all(isinstance(scores.get(m), (int, float)) and scores[m] >= floor for m, floor in MIN_METRIC_SCORES.items())
+
+
+def is_val(ev_id):
+    digest = hashlib.blake2b(str(ev_id).encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "little") / 2 ** 64 < VAL_RATIO
+
+
+# =============================
+# Token lengths (process pool)
+# =============================
+_tokenizer = None
+
+
+def _init_worker(tokenizer_path):
+    global _tokenizer
+    # The pool is the parallelism; keep each worker's tokenizer single-threaded
+    os.environ["TOKENIZERS_PARALLELISM"] = "false"
+    if tokenizer_path:
+        from transformers import AutoTokenizer
+        _tokenizer = AutoTokenizer.from_pretrained(tokenizer_path, use_fast=True, trust_remote_code=True)
+
+
+def measure_lengths(conversations):
+    """Token lengths of the chat-template-rendered conversations, per sample (a list of conversations each)."""
+    texts, owners = [], []
+    for i, convs in enumerate(conversations):
+        for messages in convs:
+            if _tokenizer is None:
+                texts.append("".join(m["content"] for m in messages))
+            else:
+                texts.append(_tokenizer.apply_chat_template(messages, tokenize=False))
+            owners.append(i)
+
+    if _tokenizer is None:
+        lengths = [max(1, len(t) // 4) for t in texts]
+    else:
+        # One batched call per chunk: the Rust tokenizer spreads it over the batch
+        lengths = [len(ids) for ids in _tokenizer(texts, add_special_tokens=False)["input_ids"]]
+
+    out = [[] for _ in conversations]
+    for i, n in zip(owners, lengths):
+        out[i].append(n)
+    return out
+
+
+# =============================
+# Output
+# =============================
+class ShardedJsonl:
+    """<split>.jsonl, or <split>-00000.jsonl, ... of shard_records lines each; stale shards are removed."""
+
+    def __init__(self, folder, split, shard_records=None):
+        self.folder = folder
+        self.split = split
+        self.shard_records = shard_records
+        self.paths = []
+        self.count = 0
+        self._f = None
+        os.makedirs(folder, exist_ok=True)
+
+    def _open_next(self):
+        if self._f is not None:
+            self._f.close()
+        if self.shard_records:
+            path = os.path.join(self.folder, f"{self.split}-{len(self.paths):05d}.jsonl")
+        else:
+            path = os.path.join(self.folder, f"{self.split}.jsonl")
+        self.paths.append(path)
+        # Written under a temporary name, renamed on close: a crashed run leaves the old files alone
+        self._f = open(path + ".tmp", "w", encoding="utf-8")
+
+    def write(self, obj):
+        if self._f is None or (self.shard_records and self.count % self.shard_records == 0):
+            self._open_next()
+        self._f.write(json.dumps(obj, ensure_ascii=False) + "\n")
+        self.count += 1
+
+    def close(self):
+        if self._f is None:
+            self._open_next()   # empty split: still write an empty file
+        self._f.close()
+
+        previous = glob.glob(os.path.join(self.folder, f"{self.split}.jsonl"))
+        previous += glob.glob(os.path.join(self.folder, f"{self.split}-[0-9][0-9][0-9][0-9][0-9].jsonl"))
+        for old in set(previous) - set(self.paths):
+            os.remove(old)
+        for path in self.paths:
+            os.replace(path + ".tmp", path)
+
+
+class SplitWriter:
+    def __init__(self, folder):
+        self.train = ShardedJsonl(folder, "train", SHARD_RECORDS)
+        self.val = ShardedJsonl(folder, "val", SHARD_RECORDS)
+
+    def write(self, ev_id, obj):
+        (self.val if is_val(ev_id) else self.train).write(obj)
+
+    def close(self):
+        self.train.close()
+        self.val.close()
+
+
+# =============================
+# Streaming join
+# =============================
+def iter_samples(raw_corpus, cot_scores, candidates, counts):
+    """(ev_id, sft sample or None, dpo sample or None, conversations to measure) per usable CoT record."""
+    for item in iter_records(COT_FILE):
+        counts["read"] += 1
+        ev_id = item.get("ev_id")
+        if "error" in item or not item.get("chain_of_thought"):
+            counts["no_cot"] += 1
+            continue
+
+        raw = raw_corpus.get(ev_id)
+        user = user_message(raw) if raw is not None else None
+        if user is None:
+            counts["no_narrative"] += 1
+            continue
+
+        response = response_text(item, raw)
+        if response is None:
+            counts["no_answer"] += 1
+            continue
+
+        score = None
+        sft = None
+        if cot_scores is None:
+            sft = {"messages": [user, {"role": "assistant", "content": response}]}
+        else:
+            scored = cot_scores.get(ev_id)
+            scores = (scored or {}).get("scores") or {}
+            score = mean_score(scores)
+            if passes_scores(scores):
+                sft = {"messages": [user, {"role": "assistant", "content": response}]}
+            else:
+                counts["low_score"] += 1
+
+        dpo = None
+        if candidates and score is not None:
+            ranked = [(score, response)]
+            for generations, scores_corpus in candidates:
+                other = generations.get(ev_id)
+                other_scored = scores_corpus.get(ev_id) if other is not None else None
+                other_score = mean_score((other_scored or {}).get("scores") or {})
+                text = response_text(other, raw) if other is not None else None
+                if text is not None and other_score is not None:
+                    ranked.append((other_score, text))
+            ranked.sort(key=lambda x: x[0])
+            (low, rejected), (high, chosen) = ranked[0], ranked[-1]
+            if len(ranked) > 1 and high - low >= DPO_MIN_MARGIN and high >= MIN_MEAN_SCORE and chosen != rejected:
+                dpo = {"messages": [user, {"role": "assistant", "content": chosen}], "rejected_response": rejected}
+            else:
+                counts["no_dpo_pair"] += 1
+
+        if sft is None and dpo is None:
+            continue
+
+        conversations = []
+        if sft is not None:
+            conversations.append(sft["messages"])
+        if dpo is not None:
+            conversations.append(dpo["messages"])
+            conversations.append([user, {"role": "assistant", "content": dpo["rejected_response"]}])
+        yield ev_id, sft, dpo, conversations
+
+
+def chunked(iterable, size):
+    chunk = []
+    for x in iterable:
+        chunk.append(x)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def build(counts):
+    raw_corpus = open_corpus(RAW_FILE)
+    cot_scores = open_corpus(COT_SCORES_FILE) if COT_SCORES_FILE else None
+    candidates = [(open_corpus(c["generations"]), open_corpus(c["scores"])) for c in DPO_CANDIDATES]
+    if candidates and cot_scores is None:
+        print("DPO pairs need COT_SCORES_FILE; building SFT data only")
+
+    sft_writer = SplitWriter(SFT_DIR)
+    dpo_writer = SplitWriter(DPO_DIR) if candidates and cot_scores is not None else None
+
+    def write_chunk(chunk, lengths):
+        for (ev_id, sft, dpo, _), sample_lengths in zip(chunk, lengths):
+            # Conversations are measured in order: SFT first (if any), then chosen and rejected
+            if sft is not None:
+                if sample_lengths.pop(0) <= MAX_LENGTH:
+                    sft_writer.write(ev_id, sft)
+                else:
+                    counts["too_long"] += 1
+            if dpo is not None:
+                if max(sample_lengths) <= MAX_LENGTH:
+                    dpo_writer.write(ev_id, dpo)
+                else:
+                    counts["too_long"] += 1
+
+    pool = ProcessPoolExecutor(max_workers=NUM_PROC, initializer=_init_worker, initargs=(TOKENIZER_PATH,))
+    try:
+        # A few chunks per worker in flight, written back in input order
+        pending = deque()
+        for chunk in chunked(iter_samples(raw_corpus, cot_scores, candidates, counts), CHUNK_SIZE):
+            pending.append((chunk, pool.submit(measure_lengths, [s[3] for s in chunk])))
+            if len(pending) >= 2 * NUM_PROC:
+                done_chunk, future = pending.popleft()
+                write_chunk(done_chunk, future.result())
+        while pending:
+            done_chunk, future = pending.popleft()
+            write_chunk(done_chunk, future.result())
+    finally:
+        pool.shutdown(cancel_futures=True)
+        for corpus in [raw_corpus, cot_scores] + [c for pair in candidates for c in pair]:
+            if corpus is not None:
+                corpus.close()
+
+    sft_writer.close()
+    if dpo_writer is not None:
+        dpo_writer.close()
+    return sft_writer, dpo_writer
+
+
+def main():
+    counts = Counter()
+    sft_writer, dpo_writer = build(counts)
+
+    print(f"CoT records read: {counts['read']}")
+    for reason in ("no_cot", "no_narrative", "no_answer", "low_score", "no_dpo_pair", "too_long"):
+        if counts[reason]:
+            print(f"   skipped ({reason}): {counts[reason]}")
+    print(f"SFT: {sft_writer.train.count} train / {sft_writer.val.count} val -> {SFT_DIR}")
+    if dpo_writer is not None:
+        print(f"DPO: {dpo_writer.train.count} train / {dpo_writer.val.count} val -> {DPO_DIR}")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,23 +2,40 @@
 Generate Chain-of-Thought
 """
 
-import json
+import os
+import sys
 import asyncio
-import aiofiles
 import traceback
-from langchain_openai import ChatOpenAI
-from tenacity import retry, stop_after_attempt, wait_exponential, RetryError
 
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from utils.adaptive_limiter import AdaptiveLimiter
+from utils.async_pool import bounded_map
+from utils.llm_client import make_llm
+from utils.checkpoint import JsonlSink, compact_jsonl, jsonl_path_for, load_latest
+from utils.corpus import open_corpus
+from utils.telemetry import TELEMETRY
 
-llm = ChatOpenAI(
+
+# Responses are cached on disk by (model, temperature, prompt); set to None to always call the model
+LLM_CACHE_PATH = "./cache/llm_responses.sqlite"
+
+llm = make_llm(
     model="",
     base_url="",
     api_key="",
     temperature=0.3,
     timeout=120,
+    cache_path=LLM_CACHE_PATH,
 )
 
+CONCURRENCY = 50     # ✔ Upper bound of generate_cot requests in flight at the same time
+RESUME = False       # ✔ Continue from the existing JSONL checkpoints instead of starting from zero
+RETRY_FAILED = False # ✔ When resuming, also regenerate records that failed last time
+TELEMETRY_PROM_FILE = None  # ✔ e.g. "./cache/metrics/cot.prom": also write the call statistics for Prometheus
 
+
+# The fixed rules come first and the per-record narrative/conclusion last, so backends with
+# automatic prefix caching reuse the prefill of the rules across all records.
 PROMPT_TEMPLATE_EN  = """
 You are a professional aviation accident investigator, familiar with the standard analytical style used by the NTSB (National Transportation Safety Board).
 
@@ -83,17 +100,21 @@ Please produce the reasoning chain strictly according to the above rules:
 """
 
 
+# ✔ The requests actually in flight adapt to the endpoint (up to CONCURRENCY): more while latency
+#   and errors are healthy, half as many on 429 / 5xx / timeouts, and Retry-After is honored
+cot_limiter = AdaptiveLimiter(initial=8, max_limit=CONCURRENCY, name="cot")
+
+
 # =============================
 # Define asynchronous calls + retry logic
 # =============================
-@retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=2, max=10))
 async def generate_cot(record):
     prompt = PROMPT_TEMPLATE_EN.format(
         narrative=record.get("narr_accp", "") + "\n\n" + record.get("narr_accf", ""),
         official_cause=record.get("narr_cause", ""),
     )
 
-    response = await llm.ainvoke(prompt)
+    response = await cot_limiter.call(lambda: llm.ainvoke(prompt), attempts=3, label="cot")
 
     if hasattr(response, "content"):
         content = response.content
@@ -106,83 +127,80 @@ async def generate_cot(record):
     }
 
 # =============================
-# Main process: Save every N successes + save failed records separately
+# Main process: stream every result to JSONL + save failed records separately
 # =============================
 async def main():
     input_path = "./evaluation/generate_COT_eva/sample.json"
     output_path = "./evaluation/generate_COT_eva/results/DeepSeek-V3.2_cot.json"
     fail_path = "./evaluation/generate_COT_eva/results/DeepSeek-V3.2_cot_fail.json"
 
-    SAVE_EVERY_N = 10  # ✔ Save after every N successful records
+    FSYNC_EVERY_N = 100  # ✔ Force the JSONL checkpoints to disk after every N records
 
-    async with aiofiles.open(input_path, "r", encoding="utf-8") as f:
-        data = json.loads(await f.read())
+    with open_corpus(input_path) as corpus:
+        data = list(corpus)
 
     print(f"Read {len(data)} accident records, starting to generate the Chain-of-Thought...")
 
-    semaphore = asyncio.Semaphore(50)
-
-    results = []         # All results (successes + failures)
-    failed_records = []  # All failed records (saved separately)
+    # ---- Resume: skip every ev_id that already has a result in the checkpoint ----
+    pending = data
+    if RESUME:
+        previous = load_latest(jsonl_path_for(output_path), key=lambda r: r.get("ev_id"))
+        done = {k for k, r in previous.items() if not (RETRY_FAILED and "error" in r)}
+        pending = [r for r in data if r.get("ev_id") not in done]
+        print(f"Resuming: {len(done)} records already done, {len(pending)} left to generate")
 
-    success_count = 0
+    # Every result is appended as one line, so a checkpoint costs the same at record 10 and record 20,000
+    mode = "a" if RESUME else "w"
+    output_sink = JsonlSink(jsonl_path_for(output_path), mode=mode, fsync_every=FSYNC_EVERY_N)
+    fail_sink = JsonlSink(jsonl_path_for(fail_path), mode=mode, fsync_every=FSYNC_EVERY_N)
 
     async def process_record(record):
-        nonlocal success_count
+        ev_id = record.get("ev_id")
 
-        async with semaphore:
-            ev_id = record.get("ev_id")
+        try:
+            result = await generate_cot(record)
+            print(f"Successfully generated: {ev_id}")
+            return result
 
-            try:
-                result = await generate_cot(record)
-                print(f"Successfully generated: {ev_id}")
-                success_count += 1
-                return result
+        except Exception as e:
+            # The limiter re-raises the last error once the retries are used up
+            error_msg = f"{type(e).__name__}: {e}"
 
-            except Exception as e:
-                # Parsing RetryError
-                if isinstance(e, RetryError):
-                    original = e.last_attempt.exception()
-                    error_msg = f"{type(original).__name__}: {original}"
-                else:
-                    error_msg = f"{type(e).__name__}: {e}"
+            print(f"{ev_id} generation failed: {error_msg}")
 
-                print(f"{ev_id} generation failed: {error_msg}")
+            fail_obj = {
+                "ev_id": ev_id,
+                "error": error_msg
+            }
+            fail_sink.write(fail_obj)
 
-                fail_obj = {
-                    "ev_id": ev_id,
-                    "error": error_msg
-                }
-                failed_records.append(fail_obj)
+            return fail_obj
 
-                return fail_obj
+    def on_result(idx, result):
+        output_sink.write(result)
 
     # =============================
-    # Process each record, save every N successes
+    # Keep CONCURRENCY records in flight, append each result as it finishes
     # =============================
-    for r in data:
-        result = await process_record(r)
-        results.append(result)
-
-        # ---- Save automatically after every N successes ----
-        if success_count > 0 and success_count % SAVE_EVERY_N == 0:
-            print(f"Reached {SAVE_EVERY_N} successful records, automatically saving...")
-            async with aiofiles.open(output_path, "w", encoding="utf-8") as f:
-                await f.write(json.dumps(results, indent=4, ensure_ascii=False))
-            async with aiofiles.open(fail_path, "w", encoding="utf-8") as f:
-                await f.write(json.dumps(failed_records, indent=4, ensure_ascii=False))
+    try:
+        await bounded_map(process_record, pending, CONCURRENCY, on_result=on_result)
+    finally:
+        output_sink.close()
+        fail_sink.close()
 
     # =============================
-    # Final save (complete results + failed records)
+    # Compaction: JSONL checkpoints -> the usual pretty JSON (input / ev_id order)
     # =============================
-    print("All processing complete, saving final results...")
-
-    async with aiofiles.open(output_path, "w", encoding="utf-8") as f:
-        await f.write(json.dumps(results, indent=4, ensure_ascii=False))
+    print("All processing complete, compacting final results...")
 
-    async with aiofiles.open(fail_path, "w", encoding="utf-8") as f:
-        await f.write(json.dumps(failed_records, indent=4, ensure_ascii=False))
+    order = [r.get("ev_id") for r in data]
+    results = compact_jsonl(output_sink.path, output_path, key=lambda r: r.get("ev_id"), order=order)
+    succeeded = {r.get("ev_id") for r in results if "error" not in r}
+    compact_jsonl(fail_sink.path, fail_path, key=lambda r: r.get("ev_id"), order=order, exclude=succeeded)
 
+    print(f"LLM cache: {llm.cache_stats()}")
+    print(f"Concurrency: {cot_limiter.stats()}")
+    TELEMETRY.report(prometheus_path=TELEMETRY_PROM_FILE)
     print(f"All results saved:\n- Success + Failure: {output_path}\n- Failure List: {fail_path}")
 
 
@@ -0,0 +1,183 @@
+"""
+Tokenize the SFT / DPO training JSONL once, into memory-mapped token stores
+
+Reads the build_training_data.py output (COT/sft_data, COT/dpo_data), renders
+every sample with the model's chat template, tokenizes it in batches across a
+process pool and writes one store per split (utils/token_store.py):
+
+    COT/sft_data/tokenized/train, val    SFT samples + packs of up to MAX_LENGTH tokens
+    COT/dpo_data/tokenized/train, val    DPO samples (chosen / rejected)
+
+Only the assistant reply is marked for the loss. A store is rebuilt only when
+its source files, the tokenizer or MAX_LENGTH change. train/train_packed.py
+trains from the SFT stores without tokenizing again.
+"""
+import os
+import sys
+import glob
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from utils.batching import pack_sequences
+from utils.json_stream import iter_records
+from utils.token_store import TokenStore, TokenStoreWriter
+
+from build_training_data import SFT_DIR, DPO_DIR, TOKENIZER_PATH, MAX_LENGTH, NUM_PROC, CHUNK_SIZE, chunked
+
+# ================= Configuration Area =================
+TOKENIZED_SUBDIR = "tokenized"   # Stores go to <SFT_DIR>/tokenized/<split>, <DPO_DIR>/tokenized/<split>
+PACK_SFT = True                  # Also plan packs of up to MAX_LENGTH tokens for the SFT stores
+FORCE = False                    # Rebuild even when the stores are up to date
+# ======================================================
+
+DATASETS = [
+    # kind, folder, fields
+    ("sft", SFT_DIR, ["input_ids"]),
+    ("dpo", DPO_DIR, ["chosen", "rejected"]),
+]
+
+
+# =============================
+# Tokenization (process pool)
+# =============================
+_tokenizer = None
+
+
+def _init_worker(tokenizer_path):
+    global _tokenizer
+    # The pool is the parallelism; keep each worker's tokenizer single-threaded
+    os.environ["TOKENIZERS_PARALLELISM"] = "false"
+    from transformers import AutoTokenizer
+    _tokenizer = AutoTokenizer.from_pretrained(tokenizer_path, use_fast=True, trust_remote_code=True)
+
+
+def conversations_of(sample, kind):
+    if kind == "dpo":
+        rejected = sample["messages"][:-1] + [{"role": "assistant", "content": sample["rejected_response"]}]
+        return [sample["messages"], rejected]
+    return [sample["messages"]]
+
+
+def _common_prefix(a, b):
+    n = min(len(a), len(b))
+    i = 0
+    while i < n and a[i] == b[i]:
+        i += 1
+    return i
+
+
+def encode_chunk(samples, kind):
+    """Per sample, (token ids, prompt length) of each conversation; tokens after the prompt are trained on."""
+    texts = []
+    for sample in samples:
+        for messages in conversations_of(sample, kind):
+            # The prompt (generation prompt included) and the whole conversation, in the same batch
+            texts.append(_tokenizer.apply_chat_template(messages[:-1], tokenize=False, add_generation_prompt=True))
+            texts.append(_tokenizer.apply_chat_template(messages, tokenize=False))
+    ids = _tokenizer(texts, add_special_tokens=False)["input_ids"]
+
+    out, k = [], 0
+    for sample in samples:
+        sequences = []
+        for _ in conversations_of(sample, kind):
+            prompt, full = ids[k], ids[k + 1]
+            k += 2
+            # The prompt is normally an exact prefix; a template that renders it differently still gets a sane boundary
+            sequences.append((np.asarray(full, dtype=np.uint32), _common_prefix(prompt, full)))
+        out.append(sequences)
+    return out
+
+
+# =============================
+# Stores
+# =============================
+def split_sources(folder, split):
+    single = os.path.join(folder, f"{split}.jsonl")
+    shards = sorted(glob.glob(os.path.join(folder, f"{split}-[0-9][0-9][0-9][0-9][0-9].jsonl")))
+    return ([single] if os.path.exists(single) else []) + shards
+
+
+def store_fingerprint(sources):
+    return {
+        "sources": [{"path": os.path.abspath(p), "size": os.stat(p).st_size, "mtime": os.stat(p).st_mtime}
+                    for p in sources],
+        "tokenizer": os.path.abspath(TOKENIZER_PATH),
+        "max_length": MAX_LENGTH,
+    }
+
+
+def is_fresh(out_dir, fingerprint):
+    if FORCE or not os.path.exists(os.path.join(out_dir, "manifest.json")):
+        return False
+    manifest = TokenStore(out_dir).manifest
+    return all(manifest.get(k) == v for k, v in fingerprint.items())
+
+
+def build_store(pool, kind, fields, sources, out_dir, fingerprint):
+    writer = TokenStoreWriter(out_dir, fields)
+    lengths = []
+    counts = Counter()
+
+    def write_chunk(encoded):
+        for sequences in encoded:
+            counts["read"] += 1
+            if max(len(ids) for ids, _ in sequences) > MAX_LENGTH:
+                counts["too_long"] += 1
+                continue
+            writer.add([(ids, np.arange(len(ids)) >= prompt_len) for ids, prompt_len in sequences])
+            lengths.append(len(sequences[0][0]))
+            counts["tokens"] += sum(len(ids) for ids, _ in sequences)
+
+    samples = (s for path in sources for s in iter_records(path))
+    # A few chunks per worker in flight, written back in input order
+    pending = deque()
+    for chunk in chunked(samples, CHUNK_SIZE):
+        pending.append(pool.submit(encode_chunk, chunk, kind))
+        if len(pending) >= 2 * NUM_PROC:
+            write_chunk(pending.popleft().result())
+    while pending:
+        write_chunk(pending.popleft().result())
+
+    packs = pack_sequences(lengths, MAX_LENGTH) if kind == "sft" and PACK_SFT else None
+    writer.close(packs=packs, **fingerprint)
+
+    total = sum(lengths)
+    print(f"{out_dir}: {len(lengths)} samples, {counts['tokens']} tokens"
+          + (f", {counts['too_long']} longer than {MAX_LENGTH} dropped" if counts["too_long"] else ""))
+    if packs is not None and packs:
+        print(f"   {len(packs)} packs ({total / (len(packs) * MAX_LENGTH):.1%} of each {MAX_LENGTH}-token step used, "
+              f"vs {total / (max(1, len(lengths)) * MAX_LENGTH):.1%} with one sample per step)")
+
+
+def main():
+    if not TOKENIZER_PATH:
+        raise ValueError("Pre-tokenization needs TOKENIZER_PATH (build_training_data.py)")
+
+    jobs = []
+    for kind, folder, fields in DATASETS:
+        for split in ("train", "val"):
+            sources = split_sources(folder, split)
+            if not sources:
+                continue
+            out_dir = os.path.join(folder, TOKENIZED_SUBDIR, split)
+            fingerprint = store_fingerprint(sources)
+            if is_fresh(out_dir, fingerprint):
+                print(f"{out_dir}: up to date")
+                continue
+            jobs.append((kind, fields, sources, out_dir, fingerprint))
+
+    if not jobs:
+        return
+
+    # One pool for all stores: each worker loads the tokenizer once
+    with ProcessPoolExecutor(max_workers=NUM_PROC, initializer=_init_worker, initargs=(TOKENIZER_PATH,)) as pool:
+        for kind, fields, sources, out_dir, fingerprint in jobs:
+            print(f"Tokenizing {kind} {os.path.basename(out_dir)}: {', '.join(sources)}")
+            build_store(pool, kind, fields, sources, out_dir, fingerprint)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,286 @@
+"""
+End-to-End Load Benchmark against the Local Stand-In Server (mock_server.py)
+Runs generate_COT.py, both evaluate.py scripts and the Ollama runner unchanged on synthetic
+records at several concurrency settings, reports records/sec and compares with a saved baseline
+"""
+import io
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import platform
+import argparse
+import tempfile
+import contextlib
+import importlib.util
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, ROOT)
+
+import mock_server
+from mock_server import MockServer
+from utils.adaptive_limiter import AdaptiveLimiter
+from utils import llm_client
+from utils.llm_client import make_llm
+from utils.telemetry import TELEMETRY, percentile
+
+# ================= Configuration Area =================
+NUM_RECORDS = 200
+CONCURRENCY_LEVELS = [4, 16, 64]
+TARGETS = ["generate_cot", "judge_cot", "judge_contrast", "ollama"]
+NARRATIVE_TOKENS = 600
+
+# mock_server.py settings for the runs; the defaults there model a slow, fault-free server
+SERVER_SETTINGS = {
+    "DECODE_TOKENS_PER_S": 400,
+    "BASE_LATENCY_S": 0.02,
+    "LATENCY_DISTRIBUTION": "lognormal",
+    "RATE_LIMIT_RATE": 0.01,
+    "ERROR_RATE": 0.0,
+    "RETRY_AFTER_S": 0.5,
+}
+
+# records/sec of every (target, concurrency) from the last --update-baseline run
+BASELINE_FILE = os.path.join(os.path.dirname(__file__), "load_baseline.json")
+REGRESSION_TOLERANCE = 0.15     # Flag runs more than 15% slower than the baseline
+VERBOSE = False                 # Show the scripts' own output
+# ======================================================
+
+
+def load_script(name, relative_path, base_url):
+    """
+    Import a repo script under a unique module name (both evaluators are called evaluate.py).
+    Its make_llm(...) client is built for the mock server instead of the configured endpoint,
+    with the script's own temperature / timeout and no response cache (every run must reach
+    the server).
+    """
+    def mock_llm(**kwargs):
+        return make_llm(**dict(kwargs, model="mock", base_url=base_url, api_key="EMPTY", cache_path=None))
+
+    spec = importlib.util.spec_from_file_location(name, os.path.join(ROOT, relative_path))
+    module = importlib.util.module_from_spec(spec)
+    llm_client.make_llm = mock_llm
+    try:
+        spec.loader.exec_module(module)
+    finally:
+        llm_client.make_llm = make_llm
+    return module
+
+
+def synthetic_records(n, seed=0):
+    rng = random.Random(seed)
+    words = ["pilot", "reported", "engine", "lost", "power", "during", "the", "approach", "runway",
+             "airplane", "landed", "short", "fuel", "tank", "examination", "revealed", "wind", "gust"]
+
+    def text(tokens):
+        return " ".join(rng.choice(words) for _ in range(tokens * 4 // 6))
+
+    return [{
+        "ev_id": f"2000{i:06d}X",
+        "Aircraft_Key": "1",
+        "narr_accp": text(NARRATIVE_TOKENS),
+        "narr_accf": text(NARRATIVE_TOKENS // 4),
+        "narr_cause": text(40),
+        "chain_of_thought": "\n".join(f"{k}. {text(40)}" for k in range(1, 6)),
+        "answer": text(60),
+    } for i in range(n)]
+
+
+def write_inputs(records):
+    """The same records at every input path the scripts read (relative to the working directory)."""
+    for path in ("./evaluation/generate_COT_eva/sample.json",           # generate_COT.py, judge_cot raw data
+                 "./evaluation/generate_COT/results/DeepSeek-V3.2_cot.json",  # judge_cot CoT file
+                 "./evaluation/contrast_eva/contrast_sample.json",      # judge_contrast raw data, Ollama input
+                 "./evaluation/contrast_eva/process_results/Qwen3-8B.json"):  # judge_contrast answers
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(records, f, ensure_ascii=False)
+
+
+def failed_records(workdir):
+    total = 0
+    for folder, _, files in os.walk(workdir):
+        for name in files:
+            if name.endswith("_fail.json"):
+                with open(os.path.join(folder, name), "r", encoding="utf-8") as f:
+                    total += len(json.load(f))
+    return total
+
+
+# =============================
+# Targets: point each script at the server with the given concurrency
+# =============================
+def setup_generate_cot(base_url, concurrency):
+    mod = load_script("bench_generate_cot", "COT/generate_COT.py", base_url)
+    mod.CONCURRENCY = concurrency
+    mod.cot_limiter = AdaptiveLimiter(initial=min(8, concurrency), max_limit=concurrency, name="cot")
+    return mod.main
+
+
+def setup_judge(name, path):
+    def setup(base_url, concurrency):
+        mod = load_script(name, path, base_url)
+        mod.REQUEST_CONCURRENCY = concurrency
+        mod.RECORD_CONCURRENCY = max(1, concurrency // 2)
+        mod.judge_limiter = AdaptiveLimiter(initial=min(16, concurrency), max_limit=concurrency, name="judge")
+        return mod.main
+    return setup
+
+
+def setup_ollama(base_url, concurrency):
+    mod = load_script("bench_ollama", "evaluation/contrast_eva/generate_response_ollama.py", base_url)
+    mod.MODELS_CONFIG = [{
+        "model_name": "mock",
+        "base_url": base_url,
+        "api_key": "EMPTY",
+        "output_file": "./evaluation/contrast_eva/mock.json",
+    }]
+    mod.ENDPOINT_CONCURRENCY = concurrency
+    mod.ENDPOINT_LIMITS = {}
+    return mod.run_evaluation
+
+
+SETUPS = {
+    "generate_cot": setup_generate_cot,
+    "judge_cot": setup_judge("bench_judge_cot", "evaluation/generate_COT_eva/evaluate.py"),
+    "judge_contrast": setup_judge("bench_judge_contrast", "evaluation/contrast_eva/evaluate.py"),
+    "ollama": setup_ollama,
+}
+
+
+# =============================
+# One run: fresh server, fresh working directory
+# =============================
+async def run_one(target, concurrency, records):
+    server = await MockServer(port=0).start()
+    TELEMETRY.reset()
+    cwd = os.getcwd()
+
+    with tempfile.TemporaryDirectory(prefix=f"load_bench_{target}_") as workdir:
+        os.chdir(workdir)
+        try:
+            write_inputs(records)
+            entry = SETUPS[target](server.base_url, concurrency)
+
+            sink = None if VERBOSE else io.StringIO()
+            with contextlib.redirect_stdout(sink or sys.stdout), contextlib.redirect_stderr(sink or sys.stderr):
+                start = time.perf_counter()
+                await entry()
+                wall = time.perf_counter() - start
+
+            failed = failed_records(workdir)
+        finally:
+            os.chdir(cwd)
+            await server.stop()
+
+    latencies = server.latencies
+    return {
+        "target": target,
+        "concurrency": concurrency,
+        "records": len(records),
+        "failed": failed,
+        "wall_s": wall,
+        "records_per_s": len(records) / wall,
+        "requests_per_s": server.stats["requests"] / wall,
+        "latency_p50_ms": 1000 * (percentile(latencies, 0.5) or 0),
+        "latency_p95_ms": 1000 * (percentile(latencies, 0.95) or 0),
+        "rate_limited": server.stats["rate_limited"],
+        "server_errors": server.stats["errors"],
+        "retries": sum(r["retries"] for r in TELEMETRY.summary()),
+    }
+
+
+# =============================
+# Baseline
+# =============================
+def run_settings(num_records):
+    return {"records": num_records, "narrative_tokens": NARRATIVE_TOKENS, "server": SERVER_SETTINGS}
+
+
+def machine_info():
+    """Where a baseline was recorded: records/sec are only comparable on similar machines."""
+    return {"platform": platform.platform(), "processor": platform.processor() or platform.machine(),
+            "cpus": os.cpu_count(), "python": platform.python_version()}
+
+
+def load_baseline(settings, quiet=False):
+    if not os.path.exists(BASELINE_FILE):
+        return {}
+    with open(BASELINE_FILE, "r", encoding="utf-8") as f:
+        baseline = json.load(f)
+    if baseline.get("settings") != settings:
+        if not quiet:
+            print(f"Baseline {BASELINE_FILE} was recorded with other settings; not comparing")
+        return {}
+    if not quiet and baseline.get("machine") and baseline["machine"] != machine_info():
+        print(f"Baseline recorded on another machine ({baseline['machine']}); compare with care")
+    return baseline.get("records_per_s", {})
+
+
+def save_baseline(settings, rows):
+    # Runs of a subset of targets / levels update their entries and keep the others
+    values = load_baseline(settings, quiet=True)
+    values.update({f"{r['target']}@{r['concurrency']}": round(r["records_per_s"], 3) for r in rows})
+    with open(BASELINE_FILE, "w", encoding="utf-8") as f:
+        json.dump({"settings": settings, "machine": machine_info(), "records_per_s": values}, f, indent=4)
+    print(f"Baseline saved: {BASELINE_FILE}")
+
+
+def print_table(rows, baseline):
+    if not baseline:
+        print(f"No baseline to compare against ({BASELINE_FILE} missing or recorded with other settings); "
+              f"regressions are not checked")
+    print(f"{'target':<15} {'conc':>5} {'rec/s':>8} {'req/s':>8} {'p50':>8} {'p95':>8} "
+          f"{'429':>5} {'5xx':>5} {'retry':>6} {'failed':>6} {'vs base':>9}")
+    regressions = []
+    for r in rows:
+        key = f"{r['target']}@{r['concurrency']}"
+        delta = ""
+        if key in baseline:
+            change = r["records_per_s"] / baseline[key] - 1
+            delta = f"{change:+.1%}"
+            if change < -REGRESSION_TOLERANCE:
+                delta += " !"
+                regressions.append(key)
+        elif baseline:
+            delta = "no base"
+        print(f"{r['target']:<15} {r['concurrency']:>5} {r['records_per_s']:>8.2f} {r['requests_per_s']:>8.1f} "
+              f"{r['latency_p50_ms']:>6.0f}ms {r['latency_p95_ms']:>6.0f}ms {r['rate_limited']:>5} "
+              f"{r['server_errors']:>5} {r['retries']:>6} {r['failed']:>6} {delta:>9}")
+    return regressions
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="End-to-end load benchmark against the mock server")
+    parser.add_argument("--targets", nargs="+", default=TARGETS, choices=list(SETUPS))
+    parser.add_argument("--concurrency", nargs="+", type=int, default=CONCURRENCY_LEVELS)
+    parser.add_argument("--records", type=int, default=NUM_RECORDS)
+    parser.add_argument("--update-baseline", action="store_true", help=f"Write the results to {BASELINE_FILE}")
+    args = parser.parse_args()
+
+    for name, value in SERVER_SETTINGS.items():
+        setattr(mock_server, name, value)
+
+    records = synthetic_records(args.records)
+    settings = run_settings(args.records)
+
+    rows = []
+    for target in args.targets:
+        for concurrency in args.concurrency:
+            print(f"Running {target} at concurrency {concurrency}...")
+            rows.append(await run_one(target, concurrency, records))
+
+    print(f"\n{args.records} records, server settings {SERVER_SETTINGS}")
+    regressions = print_table(rows, load_baseline(settings))
+
+    if args.update_baseline:
+        save_baseline(settings, rows)
+    if regressions:
+        print(f"Slower than the baseline by more than {REGRESSION_TOLERANCE:.0%}: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,332 @@
+"""
+Local OpenAI-Compatible Stand-In Server (chat completions)
+Simulates prefill/decode timing, automatic prefix caching, latency jitter and
+injected failures (HTTP 429 with Retry-After, HTTP 500), returns deterministic outputs
+"""
+import re
+import json
+import time
+import random
+import asyncio
+import hashlib
+from collections import OrderedDict
+
+# ================= Configuration Area =================
+HOST = "127.0.0.1"
+PORT = 8000
+
+CHARS_PER_TOKEN = 4             # Rough tokenizer: 1 token ~ 4 characters
+PREFILL_TOKENS_PER_S = 20000    # Prefill speed for tokens that are not in the prefix cache
+DECODE_TOKENS_PER_S = 60        # Per-request decode speed
+MAX_RUNNING = 64                # Requests processed at once; the rest wait in a queue
+PREFIX_CACHE = True             # Automatic prefix caching on/off
+PREFIX_BLOCK_TOKENS = 16        # Cache granularity (like vLLM's block size)
+PREFIX_CACHE_BLOCKS = 200000    # LRU capacity of the prefix cache, in blocks
+GENERATION_TOKENS = 200         # Length of a free-text answer
+
+# Latency model: every request takes BASE_LATENCY_S plus its prefill/decode time, and the decode
+# time is multiplied by a random factor with mean 1:
+#   "fixed" (no jitter), "lognormal" (LATENCY_SIGMA spread) or "exponential"
+BASE_LATENCY_S = 0.0
+LATENCY_DISTRIBUTION = "fixed"
+LATENCY_SIGMA = 0.5
+# Straggler requests: this share of requests is TAIL_FACTOR x slower
+TAIL_RATE = 0.0
+TAIL_FACTOR = 10.0
+
+# Fault injection (shares of requests)
+RATE_LIMIT_RATE = 0.0           # Answered with HTTP 429 + Retry-After
+ERROR_RATE = 0.0                # Answered with HTTP 500
+RETRY_AFTER_S = 1.0             # Retry-After of the injected 429s
+# Requests allowed to wait for one of the MAX_RUNNING slots; beyond that the server answers
+# 429 like an overloaded endpoint (None = unbounded queue)
+MAX_WAITING = None
+SEED = 0                        # Seed of the jitter / fault draws
+# ======================================================
+
+
+def count_tokens(text):
+    return max(1, len(text) // CHARS_PER_TOKEN)
+
+
+def _stable_int(text):
+    return int(hashlib.sha1(text.encode("utf-8")).hexdigest()[:8], 16)
+
+
+# =============================
+# Deterministic outputs
+# =============================
+def fake_completion(prompt):
+    """
+    Judge prompts get a stable score (JSON for batched prompts), anything
+    else gets a stable <think> + answer text of GENERATION_TOKENS tokens.
+    """
+    metrics = re.findall(r"### Metric: (\w+)", prompt)
+    if metrics and "JSON object" in prompt:
+        return json.dumps({m: 1 + _stable_int(prompt + m) % 5 for m in metrics})
+
+    if re.search(r"output only a number", prompt, re.IGNORECASE):
+        return str(1 + _stable_int(prompt) % 5)
+
+    rng = random.Random(_stable_int(prompt))
+    words = ["the", "pilot", "reported", "engine", "power", "loss", "during", "approach",
+             "runway", "aircraft", "landing", "fuel", "stall", "control", "wind", "descent"]
+    n_words = max(4, GENERATION_TOKENS * CHARS_PER_TOKEN // 6)
+    steps = []
+    for i in range(1, 6):
+        steps.append(f"{i}. " + " ".join(rng.choice(words) for _ in range(n_words // 6)) + ".")
+    answer = " ".join(rng.choice(words) for _ in range(n_words // 6)).capitalize() + "."
+    return "<think>\n" + "\n".join(steps) + "\n</think>\n\n" + answer
+
+
+# =============================
+# Latency and faults
+# =============================
+def latency_factor(rng):
+    if LATENCY_DISTRIBUTION == "lognormal":
+        # mu = -sigma^2 / 2 keeps the mean at 1
+        factor = rng.lognormvariate(-LATENCY_SIGMA ** 2 / 2, LATENCY_SIGMA)
+    elif LATENCY_DISTRIBUTION == "exponential":
+        factor = rng.expovariate(1.0)
+    else:
+        factor = 1.0
+    if TAIL_RATE and rng.random() < TAIL_RATE:
+        factor *= TAIL_FACTOR
+    return factor
+
+
+def injected_fault(rng):
+    """(status, error type) for a request that should fail, else None."""
+    draw = rng.random()
+    if draw < RATE_LIMIT_RATE:
+        return 429, "rate_limit_exceeded"
+    if draw < RATE_LIMIT_RATE + ERROR_RATE:
+        return 500, "server_error"
+    return None
+
+
+# =============================
+# Prefix cache simulation
+# =============================
+class PrefixCache:
+    def __init__(self, capacity_blocks):
+        self.capacity = capacity_blocks
+        self.blocks = OrderedDict()
+
+    def lookup_and_insert(self, text):
+        """Number of leading tokens already cached; all blocks of `text` are cached afterwards."""
+        block_chars = PREFIX_BLOCK_TOKENS * CHARS_PER_TOKEN
+        h = hashlib.sha1()
+        cached, still_hitting = 0, True
+
+        for start in range(0, len(text) - block_chars + 1, block_chars):
+            h.update(text[start:start + block_chars].encode("utf-8"))
+            digest = h.digest()  # hash of the whole prefix up to this block
+
+            if still_hitting and digest in self.blocks:
+                cached += PREFIX_BLOCK_TOKENS
+                self.blocks.move_to_end(digest)
+            else:
+                still_hitting = False
+                self.blocks[digest] = True
+                if len(self.blocks) > self.capacity:
+                    self.blocks.popitem(last=False)
+
+        return cached
+
+
+# =============================
+# Server
+# =============================
+class MockServer:
+    def __init__(self, host=HOST, port=PORT):
+        self.host = host
+        self.port = port
+        self.cache = PrefixCache(PREFIX_CACHE_BLOCKS)
+        self.running = asyncio.Semaphore(MAX_RUNNING)
+        self.rng = random.Random(SEED)
+        self.waiting = 0
+        self.stats = {"requests": 0, "prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0,
+                      "rate_limited": 0, "errors": 0}
+        # Seconds from arrival to the last byte, per answered request
+        self.latencies = []
+        self._server = None
+        self._connections = {}  # writer -> handler task
+
+    @property
+    def base_url(self):
+        return f"http://{self.host}:{self.port}/v1"
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        # Port 0 -> pick a free port
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            # Close idle keep-alive connections too, so their handlers end instead of being cancelled
+            handlers = list(self._connections.values())
+            for writer in list(self._connections):
+                writer.close()
+            await asyncio.gather(*handlers, return_exceptions=True)
+            await self._server.wait_closed()
+
+    async def serve_forever(self):
+        await self.start()
+        print(f"Mock OpenAI server listening on {self.base_url}")
+        async with self._server:
+            await self._server.serve_forever()
+
+    # ---- HTTP plumbing ----
+    async def _handle(self, reader, writer):
+        self._connections[writer] = asyncio.current_task()
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode("latin-1").split(" ", 2)
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    k, v = line.decode("latin-1").split(":", 1)
+                    headers[k.strip().lower()] = v.strip()
+
+                body = b""
+                if "content-length" in headers:
+                    body = await reader.readexactly(int(headers["content-length"]))
+
+                if method == "POST" and path.rstrip("/").endswith("/chat/completions"):
+                    await self._chat(json.loads(body or b"{}"), writer)
+                elif method == "GET" and path.rstrip("/").endswith("/models"):
+                    await self._send_json(writer, 200, {"object": "list", "data": [{"id": "mock", "object": "model"}]})
+                else:
+                    await self._send_json(writer, 404, {"error": {"message": f"Unknown route {path}"}})
+
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self._connections.pop(writer, None)
+            writer.close()
+
+    async def _send_json(self, writer, status, obj, extra_headers=None):
+        data = json.dumps(obj).encode("utf-8")
+        reason = {200: "OK", 404: "Not Found", 429: "Too Many Requests", 500: "Internal Server Error"}.get(status, "Error")
+        head = [f"HTTP/1.1 {status} {reason}",
+                "Content-Type: application/json",
+                f"Content-Length: {len(data)}"]
+        head += [f"{k}: {v}" for k, v in (extra_headers or {}).items()]
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + data)
+        await writer.drain()
+
+    async def _reject(self, writer, status, kind):
+        self.stats["rate_limited" if status == 429 else "errors"] += 1
+        headers = {"Retry-After": f"{RETRY_AFTER_S:g}"} if status == 429 else None
+        await self._send_json(writer, status, {"error": {"message": f"Injected {kind}", "type": kind}}, headers)
+
+    # ---- Chat completions ----
+    async def _chat(self, req, writer):
+        arrived = time.perf_counter()
+
+        fault = injected_fault(self.rng)
+        if fault is None and MAX_WAITING is not None and self.waiting >= MAX_WAITING:
+            fault = 429, "overloaded"
+        if fault is not None:
+            await asyncio.sleep(BASE_LATENCY_S)
+            await self._reject(writer, *fault)
+            return
+
+        messages = req.get("messages", [])
+        prompt = "\n".join(f"{m.get('role')}: {m.get('content')}" for m in messages)
+        model = req.get("model") or "mock"
+        completion = fake_completion(prompt)
+
+        prompt_tokens = count_tokens(prompt)
+        completion_tokens = count_tokens(completion)
+
+        decode_s = completion_tokens / DECODE_TOKENS_PER_S * latency_factor(self.rng)
+
+        self.waiting += 1
+        try:
+            await self.running.acquire()
+        finally:
+            self.waiting -= 1
+
+        try:
+            cached = self.cache.lookup_and_insert(prompt) if PREFIX_CACHE else 0
+            # Prefill: only the tokens that missed the prefix cache cost time
+            await asyncio.sleep(BASE_LATENCY_S + (prompt_tokens - cached) / PREFILL_TOKENS_PER_S)
+
+            self.stats["requests"] += 1
+            self.stats["prompt_tokens"] += prompt_tokens
+            self.stats["cached_tokens"] += cached
+            self.stats["completion_tokens"] += completion_tokens
+
+            usage = {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+                "prompt_tokens_details": {"cached_tokens": cached},
+            }
+            rid = f"chatcmpl-{_stable_int(prompt + str(time.time())):x}"
+
+            if req.get("stream"):
+                await self._stream(writer, rid, model, completion, usage, decode_s)
+            else:
+                await asyncio.sleep(decode_s)
+                await self._send_json(writer, 200, {
+                    "id": rid,
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": model,
+                    "choices": [{
+                        "index": 0,
+                        "message": {"role": "assistant", "content": completion},
+                        "finish_reason": "stop",
+                    }],
+                    "usage": usage,
+                })
+            self.latencies.append(time.perf_counter() - arrived)
+        finally:
+            self.running.release()
+
+    async def _stream(self, writer, rid, model, completion, usage, decode_s):
+        head = ["HTTP/1.1 200 OK", "Content-Type: text/event-stream",
+                "Cache-Control: no-cache", "Transfer-Encoding: chunked"]
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1"))
+
+        async def send_event(obj):
+            data = f"data: {obj if isinstance(obj, str) else json.dumps(obj)}\n\n".encode("utf-8")
+            writer.write(f"{len(data):x}\r\n".encode("latin-1") + data + b"\r\n")
+            await writer.drain()
+
+        def chunk(delta, finish=None):
+            return {"id": rid, "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+                    "choices": [{"index": 0, "delta": delta, "finish_reason": finish}]}
+
+        await send_event(chunk({"role": "assistant", "content": ""}))
+
+        # One event per ~token, paced at the (jittered) decode speed
+        step = CHARS_PER_TOKEN
+        per_token = decode_s / max(1, -(-len(completion) // step))
+        for i in range(0, len(completion), step):
+            await send_event(chunk({"content": completion[i:i + step]}))
+            await asyncio.sleep(per_token)
+
+        final = chunk({}, finish="stop")
+        final["usage"] = usage
+        await send_event(final)
+        await send_event("[DONE]")
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+
+
+if __name__ == "__main__":
+    asyncio.run(MockServer().serve_forever())
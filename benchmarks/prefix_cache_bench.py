@@ -0,0 +1,121 @@
+"""
+Benchmark: Classic vs Prefix Prompt Layout for the Judge Prompts
+Reports time-to-first-token and throughput against the local stand-in server (mock_server.py)
+"""
+import os
+import sys
+import time
+import random
+import asyncio
+import statistics
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "evaluation", "contrast_eva"))
+
+from openai import AsyncOpenAI
+from mock_server import MockServer, count_tokens
+import evaluate  # evaluation/contrast_eva/evaluate.py
+
+# ================= Configuration Area =================
+NUM_RECORDS = 50
+NARRATIVE_TOKENS = 3000     # Roughly the long narratives that motivated the prefix layout
+COT_TOKENS = 600
+CONCURRENCY = 64            # Judge requests in flight
+# Point at a real vLLM/SGLang server instead of the stand-in (None = start mock_server in-process)
+BASE_URL = None
+MODEL = "mock"
+# ======================================================
+
+
+def synthetic_records(n, seed=0):
+    rng = random.Random(seed)
+    words = ["pilot", "reported", "engine", "lost", "power", "during", "the", "approach", "runway",
+             "airplane", "landed", "short", "fuel", "tank", "examination", "revealed", "wind", "gust"]
+
+    def text(tokens):
+        return " ".join(rng.choice(words) for _ in range(tokens * 4 // 6))
+
+    return [{
+        "narrative": text(NARRATIVE_TOKENS),
+        "cot": "\n".join(f"{i}. {text(COT_TOKENS // 6)}" for i in range(1, 7)),
+        "answer": text(60),
+        "cause": text(40),
+    } for _ in range(n)]
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+
+async def run_layout(layout, records, base_url):
+    evaluate.PROMPT_LAYOUT = layout
+    client = AsyncOpenAI(base_url=base_url, api_key="EMPTY")
+    semaphore = asyncio.Semaphore(CONCURRENCY)
+    ttfts, prompt_tokens = [], 0
+
+    async def one(prompt):
+        async with semaphore:
+            start = time.perf_counter()
+            stream = await client.chat.completions.create(
+                model=MODEL, messages=[{"role": "user", "content": prompt}], stream=True, max_tokens=4,
+            )
+            first = None
+            async for chunk in stream:
+                if first is None and chunk.choices and chunk.choices[0].delta.content:
+                    first = time.perf_counter() - start
+            ttfts.append(first if first is not None else time.perf_counter() - start)
+
+    # Same shape as evaluate_single: all metric prompts of a record go out together
+    all_prompts = []
+    for r in records:
+        prompts = evaluate.build_prompts(r, evaluate.ANSWER_METRICS + evaluate.COT_METRICS)
+        all_prompts.extend(prompts.values())
+    prompt_tokens = sum(count_tokens(p) for p in all_prompts)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(p) for p in all_prompts))
+    wall = time.perf_counter() - start
+
+    return {
+        "layout": layout,
+        "requests": len(all_prompts),
+        "wall_s": wall,
+        "req_per_s": len(all_prompts) / wall,
+        "prompt_tok_per_s": prompt_tokens / wall,
+        "ttft_p50_ms": 1000 * percentile(ttfts, 50),
+        "ttft_p95_ms": 1000 * percentile(ttfts, 95),
+        "ttft_mean_ms": 1000 * statistics.mean(ttfts),
+    }
+
+
+async def main():
+    records = synthetic_records(NUM_RECORDS)
+    rows = []
+
+    for layout in ("classic", "prefix"):
+        server = None
+        base_url = BASE_URL
+        if base_url is None:
+            # Fresh server per layout, so both start with a cold prefix cache
+            server = await MockServer(port=0).start()
+            base_url = server.base_url
+
+        row = await run_layout(layout, records, base_url)
+        if server is not None:
+            row["cached_ratio"] = server.stats["cached_tokens"] / max(1, server.stats["prompt_tokens"])
+            await server.stop()
+        rows.append(row)
+
+    print(f"{NUM_RECORDS} records x 9 metrics, concurrency {CONCURRENCY}")
+    print(f"{'layout':<8} {'req':>6} {'wall s':>8} {'req/s':>8} {'prompt tok/s':>13} "
+          f"{'TTFT p50':>9} {'TTFT p95':>9} {'cached':>7}")
+    for r in rows:
+        cached = f"{r['cached_ratio']:.1%}" if "cached_ratio" in r else "n/a"
+        print(f"{r['layout']:<8} {r['requests']:>6} {r['wall_s']:>8.2f} {r['req_per_s']:>8.1f} "
+              f"{r['prompt_tok_per_s']:>13.0f} {r['ttft_p50_ms']:>7.0f}ms {r['ttft_p95_ms']:>7.0f}ms {cached:>7}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,8 +1,24 @@
 import pandas as pd
 import json
+import os
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+# ================= Configuration Area =================
+INPUT_FILE = "narratives-pre2008.xlsx"
+
+# "full":    read the whole sheet with pd.read_excel and write one indented JSON list (original behaviour)
+# "chunked": stream the rows with openpyxl read-only and write every CHUNK_ROWS rows as soon as they
+#            are cleaned, so peak memory is about one chunk instead of several times the file
+MODE = "full"
+# Output of the chunked mode: *.jsonl (one record per line), *.parquet (needs pyarrow) or *.json
+OUTPUT_FILE = "narratives-pre2008.json"
+CHUNK_ROWS = 20000
+
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+# ======================================================
 
-# Read Excel file
-df = pd.read_excel("narratives-pre2008.xlsx")
 
 # Clean text
 def clean_text(x):
@@ -15,19 +31,180 @@ def clean_text(x):
         )
     return x
 
-df = df.applymap(clean_text)
 
-# Convert Timestamp to string (to avoid JSON errors)
-df = df.applymap(lambda x: x.strftime("%Y-%m-%d %H:%M:%S") if hasattr(x, "strftime") else x)
+def convert_full(input_path, output_path):
+    # Read Excel file
+    df = pd.read_excel(input_path)
+
+    df = df.applymap(clean_text)
+
+    # Convert Timestamp to string (to avoid JSON errors)
+    df = df.applymap(lambda x: x.strftime(DATE_FORMAT) if hasattr(x, "strftime") else x)
+
+    # Convert to dict
+    data = df.to_dict(orient="records")
+
+    # Beautify JSON output
+    json_str = json.dumps(data, ensure_ascii=False, indent=4)
+
+    # Save file
+    with open(output_path, "w", encoding="utf-8") as f:
+        f.write(json_str)
+
+
+# =============================
+# Chunked conversion
+# =============================
+def iter_excel_chunks(path, chunk_rows):
+    """DataFrames of at most chunk_rows rows from the first sheet, read with openpyxl in read-only mode."""
+    from openpyxl import load_workbook
+
+    wb = load_workbook(path, read_only=True, data_only=True)
+    try:
+        rows = wb.worksheets[0].iter_rows(values_only=True)
+        header = [str(h) if h is not None else f"Unnamed: {i}" for i, h in enumerate(next(rows, ()))]
+
+        chunk = []
+        for row in rows:
+            if all(v is None for v in row):
+                continue  # read-only sheets may report trailing empty rows
+            chunk.append(row[:len(header)])
+            if len(chunk) >= chunk_rows:
+                # dtype=object keeps the cell values as they are (ints stay ints, empty cells stay None)
+                yield pd.DataFrame(chunk, columns=header, dtype=object)
+                chunk = []
+        if chunk:
+            yield pd.DataFrame(chunk, columns=header, dtype=object)
+    finally:
+        wb.close()
+
+
+def clean_frame(df):
+    """Vectorized clean_text + timestamp formatting, column by column."""
+    for col in df.columns:
+        s = df[col]
+        kind = pd.api.types.infer_dtype(s, skipna=True)
+
+        if kind == "string":
+            s = s.str.replace(r"_x000[da]_|\r", "", regex=True).str.replace("\n", " ", regex=False)
+        elif kind in ("datetime", "datetime64", "date"):
+            s = pd.to_datetime(s).dt.strftime(DATE_FORMAT)
+        elif kind not in ("integer", "floating", "boolean", "decimal", "empty"):
+            # Mixed columns, time-of-day cells, ...: clean only the cells that need it
+            s = s.copy()
+            is_str = s.map(type).eq(str)
+            if is_str.any():
+                s[is_str] = s[is_str].str.replace(r"_x000[da]_|\r", "", regex=True).str.replace("\n", " ", regex=False)
+            has_time = s.map(lambda x: hasattr(x, "strftime"))
+            if has_time.any():
+                s[has_time] = s[has_time].map(lambda x: x.strftime(DATE_FORMAT))
+
+        # Empty cells are null in the output, never NaN
+        df[col] = s.astype(object).where(s.notna(), None)
+    return df
+
+
+class _JsonlWriter:
+    def __init__(self, path):
+        self._f = open(path, "w", encoding="utf-8")
+
+    def write(self, df):
+        self._f.writelines(json.dumps(r, ensure_ascii=False) + "\n" for r in df.to_dict(orient="records"))
+
+    def close(self):
+        self._f.close()
+
+
+class _JsonWriter:
+    def __init__(self, path):
+        from utils.json_stream import JsonArrayWriter
+        self._writer = JsonArrayWriter(path)
+
+    def write(self, df):
+        for r in df.to_dict(orient="records"):
+            self._writer.write(r)
+
+    def close(self):
+        self._writer.close()
+
+
+class _ParquetWriter:
+    """
+    Column types are inferred from the first chunk (clean_frame leaves every column as object):
+    whole numbers -> int64, other numbers -> float64, booleans -> bool, everything else
+    (text, dates, mixed str/int cells such as ev_id "x" / 20019, all-empty) -> string.
+    Later chunks are cast to that schema.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._writer = None
+        self.schema = None
+        self.kinds = None
+
+    @staticmethod
+    def _column_kind(s):
+        kind = pd.api.types.infer_dtype(s, skipna=True)
+        if kind == "integer":
+            return "int"
+        if kind in ("floating", "decimal", "mixed-integer-float"):
+            return "float"
+        if kind == "boolean":
+            return "bool"
+        return "str"
+
+    def _cast(self, df):
+        df = df.copy()
+        for col, kind in self.kinds.items():
+            s = df[col]
+            try:
+                if kind == "int":
+                    df[col] = pd.to_numeric(s).astype("Int64")
+                elif kind == "float":
+                    df[col] = pd.to_numeric(s).astype("float64")
+                elif kind == "bool":
+                    df[col] = s.astype("boolean")
+                else:
+                    df[col] = s.map(lambda x: x if x is None else str(x)).astype(object)
+            except (TypeError, ValueError) as e:
+                raise ValueError(f"Column {col!r} was {kind} in the first chunk but a later chunk does not fit "
+                                 f"({e}); raise CHUNK_ROWS so the first chunk sees every kind of value") from e
+        return df
+
+    def write(self, df):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        if self._writer is None:
+            self.kinds = {col: self._column_kind(df[col]) for col in df.columns}
+            types = {"int": pa.int64(), "float": pa.float64(), "bool": pa.bool_(), "str": pa.string()}
+            self.schema = pa.schema([pa.field(col, types[kind]) for col, kind in self.kinds.items()])
+            self._writer = pq.ParquetWriter(self.path, self.schema)
+        self._writer.write_table(pa.Table.from_pandas(self._cast(df), schema=self.schema, preserve_index=False))
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+
+
+def convert_chunked(input_path, output_path, chunk_rows=CHUNK_ROWS):
+    ext = os.path.splitext(output_path)[1]
+    writer = {".jsonl": _JsonlWriter, ".parquet": _ParquetWriter}.get(ext, _JsonWriter)(output_path)
 
-# Convert to dict
-data = df.to_dict(orient="records")
+    total = 0
+    try:
+        for df in iter_excel_chunks(input_path, chunk_rows):
+            writer.write(clean_frame(df))
+            total += len(df)
+            print(f"Converted {total} rows...")
+    finally:
+        writer.close()
 
-# Beautify JSON output
-json_str = json.dumps(data, ensure_ascii=False, indent=4)
 
-# Save file
-with open("narratives-pre2008.json", "w", encoding="utf-8") as f:
-    f.write(json_str)
+if __name__ == "__main__":
+    if MODE == "chunked":
+        convert_chunked(INPUT_FILE, OUTPUT_FILE)
+    else:
+        convert_full(INPUT_FILE, OUTPUT_FILE)
 
-print("Conversion complete!")
+    print("Conversion complete!")
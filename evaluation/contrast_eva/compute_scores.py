@@ -1,69 +1,325 @@
 """
 Calculate the Average Scores of Results
+
+Score files (JSON lists or JSONL checkpoints) are streamed into one float
+column per metric (NaN = missing / None), so memory is 8 bytes per score and
+every statistic below is a vectorized NumPy call:
+  - mean, valid and missing counts per metric
+  - bootstrap confidence interval of the mean
+  - paired comparisons between every two files on the records both scored
+    (bootstrap CI of the mean difference + sign-flip permutation p-value)
+The results are printed and written as CSV tables.
 """
 import os
-import json
+import sys
+import csv
+from array import array
+
+import numpy as np
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+from utils.json_stream import iter_records
+
+# ================= Configuration Area =================
+BOOTSTRAP_SAMPLES = 10000
+CONFIDENCE = 0.95
+SEED = 0
+# Machine-readable tables (None to skip); kept outside the results folder so they are never read as inputs
+SUMMARY_FILE = "evaluation/contrast_eva/score_summary.csv"
+COMPARISON_FILE = "evaluation/contrast_eva/score_comparisons.csv"
+# ======================================================
+
+# Scores are multiples of 0.25, so a metric column has at most a handful of distinct values
+MAX_DISCRETE_VALUES = 64
+
+
+# =============================
+# Streaming columnar loading
+# =============================
+class ScoreColumns:
+    """(ev_id, Aircraft_Key) keys plus a float64 column per metric, NaN where a score is missing."""
+
+    def __init__(self, keys, columns):
+        self.keys = keys
+        self.columns = columns
+        self.n = len(keys)
+
+    @property
+    def metrics(self):
+        return list(self.columns)
+
+
+def load_score_columns(path):
+    keys = []
+    columns = {}  # metric -> array('d'), grown one record at a time
+    # A JSONL checkpoint gets a new line every time a record is rescored (resumed or RETRY_FAILED
+    # runs); like checkpoint.load_latest, the last line of a key wins, at the key's first position
+    rows = {} if path.endswith(".jsonl") else None
+
+    for item in iter_records(path):
+        key = (str(item.get("ev_id")), str(item.get("Aircraft_Key")))
+        row = rows.get(key) if rows is not None else None
+        if row is None:
+            row = len(keys)
+            keys.append(key)
+            if rows is not None:
+                rows[key] = row
+        scores = item.get("scores") or {}
+
+        for k, v in scores.items():
+            # Skip the "error" string and anything else that is not a score
+            if k == "error" or not (v is None or isinstance(v, (int, float))):
+                continue
+            if k not in columns:
+                # A metric seen for the first time: earlier records did not have it
+                columns[k] = array("d", [np.nan]) * len(keys)
+
+        for k, col in columns.items():
+            v = scores.get(k)
+            v = np.nan if v is None else float(v)
+            if row < len(col):
+                col[row] = v
+            else:
+                col.append(v)
+
+    return ScoreColumns(keys, {k: np.frombuffer(col, dtype=np.float64) if len(col) else np.empty(0)
+                               for k, col in columns.items()})
+
+
+# =============================
+# Bootstrap
+# =============================
+def bootstrap_means(values, samples, rng):
+    """
+    Bootstrap distribution of the mean of `values` (no NaN). With few distinct
+    values, resampling n records is a multinomial draw over the value counts,
+    so the cost is samples x distinct values instead of samples x n.
+    """
+    n = len(values)
+    uniq, counts = np.unique(values, return_counts=True)
+
+    if len(uniq) <= MAX_DISCRETE_VALUES:
+        draws = rng.multinomial(n, counts / n, size=samples)
+        return draws @ uniq / n
+
+    # Continuous scores: plain index resampling, in chunks to bound memory
+    out = np.empty(samples)
+    chunk = max(1, 2_000_000 // n)
+    for start in range(0, samples, chunk):
+        stop = min(samples, start + chunk)
+        idx = rng.integers(0, n, size=(stop - start, n))
+        out[start:stop] = values[idx].mean(axis=1)
+    return out
+
+
+def confidence_interval(boot, confidence=CONFIDENCE):
+    alpha = (1 - confidence) / 2
+    low, high = np.quantile(boot, [alpha, 1 - alpha])
+    return float(low), float(high)
+
+
+def sign_flip_p_value(diffs, samples, rng):
+    """
+    Two-sided paired permutation test of mean(diffs) == 0. Flipping signs at
+    random only changes how many copies of each distinct |diff| are positive,
+    which is a binomial draw per distinct value.
+    """
+    nonzero = diffs[diffs != 0]
+    if len(nonzero) == 0:
+        return 1.0
+
+    observed = abs(nonzero.sum())
+    uniq, counts = np.unique(np.abs(nonzero), return_counts=True)
+
+    if len(uniq) <= MAX_DISCRETE_VALUES:
+        positive = rng.binomial(counts, 0.5, size=(samples, len(uniq)))
+        sums = (2 * positive - counts) @ uniq
+    else:
+        signs = rng.choice(np.array([-1.0, 1.0]), size=(samples, len(nonzero)))
+        sums = signs @ np.abs(nonzero)
+
+    # +1: the observed assignment is one of the permutations
+    return float((np.sum(np.abs(sums) >= observed - 1e-12) + 1) / (samples + 1))
+
+
+# =============================
+# Summaries
+# =============================
+def summarize(name, data, rng, samples=BOOTSTRAP_SAMPLES):
+    rows = []
+    for metric, col in data.columns.items():
+        valid = col[~np.isnan(col)]
+        row = {
+            "file": name,
+            "metric": metric,
+            "records": data.n,
+            "valid": len(valid),
+            "missing": data.n - len(valid),
+            "mean": None,
+            "ci_low": None,
+            "ci_high": None,
+        }
+        if len(valid):
+            row["mean"] = float(valid.mean())
+            row["ci_low"], row["ci_high"] = confidence_interval(bootstrap_means(valid, samples, rng))
+        rows.append(row)
+    return rows
+
+
+def compare(name_a, a, name_b, b, rng, samples=BOOTSTRAP_SAMPLES):
+    """Paired comparison of two score files on the (ev_id, Aircraft_Key) records both contain."""
+    index_b = {k: i for i, k in enumerate(b.keys)}
+    pairs = [(i, index_b[k]) for i, k in enumerate(a.keys) if k in index_b]
+    if not pairs:
+        return []
+    ia, ib = (np.array(p) for p in zip(*pairs))
+
+    rows = []
+    for metric in a.metrics:
+        if metric not in b.columns:
+            continue
+        col_a, col_b = a.columns[metric][ia], b.columns[metric][ib]
+        both = ~(np.isnan(col_a) | np.isnan(col_b))
+        if not both.any():
+            continue
+        diffs = col_a[both] - col_b[both]
+
+        ci_low, ci_high = confidence_interval(bootstrap_means(diffs, samples, rng))
+        rows.append({
+            "file_a": name_a,
+            "file_b": name_b,
+            "metric": metric,
+            "pairs": len(diffs),
+            "mean_a": float(col_a[both].mean()),
+            "mean_b": float(col_b[both].mean()),
+            "mean_diff": float(diffs.mean()),
+            "ci_low": ci_low,
+            "ci_high": ci_high,
+            "p_value": sign_flip_p_value(diffs, samples, rng),
+        })
+    return rows
+
+
+def write_csv(path, rows):
+    if not path or not rows:
+        return
+    folder = os.path.dirname(path)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
+    print(f"Saved: {path}")
+
+
+def score_files(folder_path):
+    # *.json results, plus JSONL checkpoints that were never compacted; failures and
+    # judge_agreement.py reports are not scores
+    names = sorted(os.listdir(folder_path))
+    stems = {os.path.splitext(n)[0] for n in names if n.endswith(".json")}
+    files = []
+    for filename in names:
+        stem, ext = os.path.splitext(filename)
+        if stem.endswith(("_fail", "_judge_agreement")):
+            continue
+        if ext == ".json" or (ext == ".jsonl" and stem not in stems):
+            files.append(filename)
+    return files
+
 
 def compute_average_scores(folder_path):
     print(f" Analyzing folder: {folder_path}\n" + "="*40)
 
-    for filename in os.listdir(folder_path):
-        # Ignore non-json files and _fail.json files
-        if filename.endswith(".json") and not filename.endswith("_fail.json"):
-            file_path = os.path.join(folder_path, filename)
-
-            with open(file_path, "r", encoding="utf-8") as f:
-                try:
-                    data = json.load(f)
-                except json.JSONDecodeError:
-                    print(f"Unable to read file: {filename}")
-                    continue
-
-            # Use two dictionaries to track: total scores and valid count
-            metric_sums = {}
-            metric_counts = {}
-
-            total_items = len(data)
-
-            # Iterate over each data item
-            for item in data:
-                scores = item.get("scores", {})
-                
-                # Iterate over each scoring dimension of the data
-                for k, v in scores.items():
-                    # Key checks:
-                    # 1. v cannot be None
-                    # 2. v must be a number (int or float), to avoid interference from "error" field strings
-                    if v is not None and isinstance(v, (int, float)):
-                        metric_sums[k] = metric_sums.get(k, 0) + v
-                        metric_counts[k] = metric_counts.get(k, 0) + 1
-
-            # Calculate averages
-            avg_scores = {}
-            for k, total_score in metric_sums.items():
-                count = metric_counts.get(k, 0)
-                if count > 0:
-                    avg_scores[k] = total_score / count
-                else:
-                    avg_scores[k] = 0.0
-
-            # --- Output results ---
-            print(f"\nFile: {filename}")
-            print(f"   (Total data rows: {total_items})")
-            
-            # For readability, we sort the output by key name
-            for k in sorted(avg_scores.keys()):
-                # Print the valid sample count for reference
-                valid_count = metric_counts.get(k, 0)
-                print(f"   - {k:<20}: {avg_scores[k]:.4f} (Sample count: {valid_count})")
-            
-            print("-" * 40)
+    rng = np.random.default_rng(SEED)
+    loaded = {}
+    summary = []
+
+    for filename in score_files(folder_path):
+        file_path = os.path.join(folder_path, filename)
+        try:
+            data = load_score_columns(file_path)
+        except ValueError:
+            print(f"Unable to read file: {filename}")
+            continue
+
+        loaded[filename] = data
+        rows = summarize(filename, data, rng)
+        summary.extend(rows)
+
+        # --- Output results ---
+        print(f"\nFile: {filename}")
+        print(f"   (Total data rows: {data.n})")
+        # For readability, we sort the output by key name
+        for row in sorted(rows, key=lambda r: r["metric"]):
+            if row["mean"] is None:
+                print(f"   - {row['metric']:<20}: n/a    (Sample count: 0, missing {row['missing']})")
+                continue
+            print(f"   - {row['metric']:<20}: {row['mean']:.4f} "
+                  f"[{row['ci_low']:.4f}, {row['ci_high']:.4f}] "
+                  f"(Sample count: {row['valid']}, missing {row['missing']})")
+        print("-" * 40)
+
+    # --- Paired comparisons between every two files ---
+    comparisons = []
+    names = list(loaded)
+    for i, name_a in enumerate(names):
+        for name_b in names[i + 1:]:
+            comparisons.extend(compare(name_a, loaded[name_a], name_b, loaded[name_b], rng))
+
+    if comparisons:
+        print(f"\nPaired comparisons ({CONFIDENCE:.0%} bootstrap CI, sign-flip permutation p-value)")
+        for row in comparisons:
+            print(f"   {row['file_a']} vs {row['file_b']} | {row['metric']:<20}: "
+                  f"{row['mean_diff']:+.4f} [{row['ci_low']:+.4f}, {row['ci_high']:+.4f}] "
+                  f"p={row['p_value']:.4f} (pairs: {row['pairs']})")
+
+    write_csv(SUMMARY_FILE, summary)
+    write_csv(COMPARISON_FILE, comparisons)
+    return summary, comparisons
+
+
+# =============================
+# Running averages (used by run_pipeline.py while records stream in)
+# =============================
+def accumulate(scores, metric_sums, metric_counts):
+    # Iterate over each scoring dimension of the data
+    for k, v in scores.items():
+        # Key checks:
+        # 1. v cannot be None
+        # 2. v must be a number (int or float), to avoid interference from "error" field strings
+        if v is not None and isinstance(v, (int, float)):
+            metric_sums[k] = metric_sums.get(k, 0) + v
+            metric_counts[k] = metric_counts.get(k, 0) + 1
+
+
+def print_averages(filename, total_items, metric_sums, metric_counts):
+    # Calculate averages
+    avg_scores = {}
+    for k, total_score in metric_sums.items():
+        count = metric_counts.get(k, 0)
+        if count > 0:
+            avg_scores[k] = total_score / count
+        else:
+            avg_scores[k] = 0.0
+
+    # --- Output results ---
+    print(f"\nFile: {filename}")
+    print(f"   (Total data rows: {total_items})")
+
+    # For readability, we sort the output by key name
+    for k in sorted(avg_scores.keys()):
+        # Print the valid sample count for reference
+        valid_count = metric_counts.get(k, 0)
+        print(f"   - {k:<20}: {avg_scores[k]:.4f} (Sample count: {valid_count})")
+
+    print("-" * 40)
 
 # Example usage
 if __name__ == "__main__":
     # Ensure the path is correct
-    folder = "evaluation/contrast_eva/eva_results" 
-    
+    folder = "evaluation/contrast_eva/eva_results"
+
     if os.path.exists(folder):
         compute_average_scores(folder)
     else:
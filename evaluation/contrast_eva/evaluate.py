@@ -2,24 +2,62 @@
 Batch Evaluate Chain-of-Thought Scoring Script (Automatically Match Original Data + Output 0-1 Score System)
 """
 
+import os
+import sys
 import json
 import asyncio
 import aiofiles
-from langchain_openai import ChatOpenAI
-from tenacity import retry, stop_after_attempt, wait_exponential, RetryError
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+from utils.adaptive_limiter import AdaptiveLimiter
+from utils.async_pool import bounded_map
+from utils.llm_client import make_llm
+from utils.judge_prompts import all_fields, build_batched_prompt, build_prefixed_prompt, parse_batched_scores
+from utils.checkpoint import JsonlSink, compact_jsonl, jsonl_path_for, load_latest
+from utils.corpus import open_corpus
+from utils.score_store import write_scores
+from utils.telemetry import TELEMETRY
 
 # =============================
 # Initialize LLM
 # =============================
 
-llm = ChatOpenAI(
+# Responses are cached on disk by (model, temperature, prompt); set to None to always call the model
+LLM_CACHE_PATH = "./cache/llm_responses.sqlite"
+
+llm = make_llm(
     model="",
     base_url="",
     api_key="",
     temperature=0.3,
     timeout=120,
+    cache_path=LLM_CACHE_PATH,
 )
 
+RESUME = False        # Continue from the existing JSONL checkpoints, only scoring the missing metrics
+RETRY_FAILED = False  # When resuming, also retry failed records and metrics that came back as None
+
+# Also store the final scores in a Parquet score store (utils/score_store.py, needs pyarrow); None to skip
+SCORE_STORE = None  # e.g. "./evaluation/contrast_eva/score_store"
+
+# Call latency / token / cost summary is always printed; also write it in Prometheus text format here
+TELEMETRY_PROM_FILE = None  # e.g. "./cache/metrics/contrast_judge.prom"
+
+# "per_metric": one judge call per metric (default)
+# "batched":    one call returning all metrics as JSON; per-metric calls only for fields that fail to parse
+JUDGE_MODE = "per_metric"
+
+# "classic": the original templates (instruction first, then the record's context)
+# "prefix":  the record's narrative / CoT / answer / cause in a stable leading block shared by all
+#            of its metric prompts, rubric after it, so vLLM/SGLang prefix caching reuses the prefill
+PROMPT_LAYOUT = "classic"
+
+REQUEST_CONCURRENCY = 200  # Upper bound of judge requests in flight, across all records and metrics
+RECORD_CONCURRENCY = 100   # Records being scored at the same time (their metrics share the budget above)
+
+# Adapts the requests actually in flight (up to REQUEST_CONCURRENCY) to the endpoint: grows while
+# latency and errors are healthy, halves on 429 / 5xx / timeouts and honors Retry-After
+judge_limiter = AdaptiveLimiter(initial=16, max_limit=REQUEST_CONCURRENCY, name="judge")
 
 
 FAITHFULNESS_PROMPT = """
@@ -281,6 +319,18 @@ Output only a number from 1 to 5.
 """
 
 
+METRIC_TEMPLATES = {
+    "faithfulness": FAITHFULNESS_PROMPT,
+    "logicality": LOGICALITY_PROMPT,
+    "support": SUPPORT_PROMPT,
+    "completeness": COMPLETENESS_PROMPT,
+    "ntsb_style": NTSB_STYLE_PROMPT,
+    "causal_accuracy": CAUSAL_ACCURACY_PROMPT,
+    "causal_completeness": CAUSAL_COMPLETENESS_PROMPT,
+    "causal_precision": CAUSAL_PRECISION_PROMPT,
+    "cause_alignment": CAUSE_ALIGNMENT_PROMPT,
+}
+
 # =============================
 # 1–5 Convert to 0–1
 # =============================
@@ -290,25 +340,70 @@ def normalize(score):
 # =============================
 # Call Model
 # =============================
-@retry(stop=stop_after_attempt(3), wait=wait_exponential(min=2, max=10))
-async def ask_score(prompt):
-    resp = await llm.ainvoke(prompt)
+async def ask_score(prompt, metric=None):
+    # One limiter slot per attempt, so retry back-off does not hold a slot
+    async def attempt():
+        # Only valid scores go into the cache, so a retry after a malformed answer reaches the model again
+        resp = await llm.ainvoke(prompt, cache_if=lambda txt: txt.strip() in ["1", "2", "3", "4", "5"])
+
+        if hasattr(resp, "content"):
+            txt = resp.content.strip()
+        else:
+            raise TypeError("Model format error")
+
+        if txt not in ["1", "2", "3", "4", "5"]:
+            raise ValueError(f"Invalid score from model: {txt}")
+        return txt
+
+    txt = await judge_limiter.call(attempt, attempts=3, label=metric)
+    return normalize(int(txt))
 
-    if hasattr(resp, "content"):
-        txt = resp.content.strip()
-    else:
-        raise TypeError("Model format error")
 
-    if txt not in ["1", "2", "3", "4", "5"]:
-        raise ValueError(f"Invalid score from model: {txt}")
+# =============================
+# Batched rubric: all metrics in one JSON answer
+# =============================
+async def ask_scores_batched(templates, values):
+    metrics = list(templates)
+    prompt = build_batched_prompt(templates, values, fields=all_fields(METRIC_TEMPLATES))
 
-    return normalize(int(txt))
+    def complete(txt):
+        return None not in parse_batched_scores(txt, metrics).values()
+
+    # Single attempt (apart from overload retries): anything that does not parse is re-scored per metric by the caller
+    try:
+        resp = await judge_limiter.call(lambda: llm.ainvoke(prompt, cache_if=complete), attempts=1, label="batched")
+        parsed = parse_batched_scores(resp.content, metrics)
+    except Exception as e:
+        print(f"Batched judge call failed, falling back to per-metric calls: {e}")
+        return {}
+
+    return {m: normalize(v) for m, v in parsed.items() if v is not None}
+
+
+ANSWER_METRICS = ["causal_accuracy", "causal_completeness", "causal_precision", "cause_alignment"]
+COT_METRICS = ["faithfulness", "logicality", "support", "completeness", "ntsb_style"]
+
+
+def build_prompts(values, metrics):
+    # {metric: prompt} in the configured PROMPT_LAYOUT
+    if PROMPT_LAYOUT == "prefix":
+        fields = all_fields(METRIC_TEMPLATES)
+        return {m: build_prefixed_prompt(m, METRIC_TEMPLATES[m], values, fields) for m in metrics}
+    return {m: METRIC_TEMPLATES[m].format(**values) for m in metrics}
+
+
+def pending_metrics(scores, cot):
+    # Metrics of an already written record that still need a judge call
+    expected = ANSWER_METRICS + (COT_METRICS if cot and cot.strip() else [])
+    if RETRY_FAILED:
+        return [m for m in expected if scores.get(m) is None]
+    return [m for m in expected if m not in scores]
 
 
 # =============================
 # Calculate Scores for a Single Record
 # =============================
-async def evaluate_single(narrative, cot, cause, answer):
+async def evaluate_single(narrative, cot, cause, answer, metrics=None):
     # Initialize results dictionary, default all to None
     results = {
         "faithfulness": None,
@@ -323,40 +418,44 @@ async def evaluate_single(narrative, cot, cause, answer):
         "error": None
     }
 
-    # Prepare Prompt dictionary
-    prompts = {}
+    values = {"narrative": narrative, "cot": cot, "cause": cause, "answer": answer}
 
     # A. Answer-related metrics (always calculate if answer exists)
-    prompts.update({
-        "causal_accuracy": CAUSAL_ACCURACY_PROMPT.format(narrative=narrative, answer=answer),
-        "causal_completeness": CAUSAL_COMPLETENESS_PROMPT.format(narrative=narrative, answer=answer),
-        "causal_precision": CAUSAL_PRECISION_PROMPT.format(narrative=narrative, answer=answer),
-        "cause_alignment": CAUSE_ALIGNMENT_PROMPT.format(narrative=narrative, cause=cause, answer=answer),
-    })
+    keys = list(ANSWER_METRICS)
 
     # B. CoT-related metrics (only if cot is not empty)
     if cot and cot.strip():
-        prompts.update({
-            "faithfulness": FAITHFULNESS_PROMPT.format(narrative=narrative, cot=cot),
-            "logicality":   LOGICALITY_PROMPT.format(narrative=narrative, cot=cot),
-            "support":      SUPPORT_PROMPT.format(narrative=narrative, cot=cot, cause=cause),
-            "completeness": COMPLETENESS_PROMPT.format(narrative=narrative, cot=cot),
-            "ntsb_style":   NTSB_STYLE_PROMPT.format(cot=cot),
-        })
+        keys += COT_METRICS
     else:
         # Optional: print a log message for debugging if Cot is empty
         print(" CoT is empty, skipping CoT-related metrics")
-        pass
 
-    # Loop through the prompts and call the model
-    for key, p in prompts.items():
-        try:
-            results[key] = await ask_score(p)
-        except Exception as e:
+    # Only score the requested metrics (used when resuming a partially scored record)
+    if metrics is not None:
+        keys = [k for k in keys if k in metrics]
+
+    # Prepare Prompt dictionary
+    prompts = build_prompts(values, keys)
+
+    # Batched rubric: fill every field that parses, leave the rest to the per-metric calls below
+    if JUDGE_MODE == "batched" and len(prompts) > 1:
+        batched = await ask_scores_batched({k: METRIC_TEMPLATES[k] for k in prompts}, values)
+        for key, score in batched.items():
+            results[key] = score
+            del prompts[key]
+
+    # Send all metric prompts at once; judge_limiter bounds the requests actually in flight
+    keys = list(prompts)
+    outcomes = await asyncio.gather(*(ask_score(prompts[k], k) for k in keys), return_exceptions=True)
+
+    for key, out in zip(keys, outcomes):
+        if isinstance(out, Exception):
             results[key] = None
             # Log the error without overwriting previous ones
             current_error = results.get("error")
-            results["error"] = f"{current_error}; {key}:{str(e)}" if current_error else f"{key}:{str(e)}"
+            results["error"] = f"{current_error}; {key}:{str(out)}" if current_error else f"{key}:{str(out)}"
+        else:
+            results[key] = out
 
     print(results)
     return results
@@ -370,44 +469,58 @@ async def main():
     cot_path = f"./evaluation/contrast_eva/process_results/{file_name}.json"  # Contains ev_id, Aircraft_Key, answer, chain_of_thought
     raw_path = "./evaluation/contrast_eva/contrast_sample.json"             # Contains ev_id, Aircraft_Key, narr_accp, narr_cause
     
-    output_path = f"./evaluation/contrast_eva/eva_results/{file_name}_scores.json"
-    fail_path   = f"./evaluation/contrast_eva/eva_results/{file_name}_fail.json"
+    # Batched-rubric runs get their own files, so judge_agreement.py can compare the two modes
+    mode_tag = "_batched" if JUDGE_MODE == "batched" else ""
+    output_path = f"./evaluation/contrast_eva/eva_results/{file_name}{mode_tag}_scores.json"
+    fail_path   = f"./evaluation/contrast_eva/eva_results/{file_name}{mode_tag}_fail.json"
 
     print("Loading files...")
 
     async with aiofiles.open(cot_path, "r", encoding="utf-8") as f:
         cot_data = json.loads(await f.read())
 
-    async with aiofiles.open(raw_path, "r", encoding="utf-8") as f:
-        raw_data = json.loads(await f.read())
-
-    # Create a dictionary with (ev_id, Aircraft_Key) as the composite key
-    raw_dict = {}
-    for item in raw_data:
-        key = (str(item["ev_id"]), str(item["Aircraft_Key"]))
-        raw_dict[key] = item
+    # Indexed, mmap-backed raw data: lookups by (ev_id, Aircraft_Key) without loading the file
+    corpus = open_corpus(raw_path)
 
-    print(f"COT entries: {len(cot_data)}, Raw data entries: {len(raw_data)}")
+    print(f"COT entries: {len(cot_data)}, Raw data entries: {len(corpus)}")
     print("Starting matching by (ev_id + Aircraft_Key) and scoring...")
 
-    results = []
-    failures = []
+    def record_key(item):
+        return (str(item.get("ev_id")), str(item.get("Aircraft_Key")))
 
-    semaphore = asyncio.Semaphore(20)  # Limit concurrency to avoid API rate limits
+    # ---- Resume: what is already scored, per (ev_id, Aircraft_Key, metric) ----
+    previous, failed_before = {}, set()
+    if RESUME:
+        previous = load_latest(jsonl_path_for(output_path), key=record_key)
+        failed_before = set(load_latest(jsonl_path_for(fail_path), key=record_key)) - set(previous)
+        print(f"Resuming: {len(previous)} records already scored, {len(failed_before)} failed before")
+
+    mode = "a" if RESUME else "w"
+    output_sink = JsonlSink(jsonl_path_for(output_path), mode=mode)
+    fail_sink = JsonlSink(jsonl_path_for(fail_path), mode=mode)
 
     async def process(cot_item):
-        ev_id = str(cot_item.get("ev_id"))
-        ac_key = str(cot_item.get("Aircraft_Key"))
+        ev_id, ac_key = record_key(cot_item)
         
         cot_text = cot_item.get("chain_of_thought", "")
         answer_text = cot_item.get("answer", "")
         if not answer_text:
             answer_text = cot_item.get("model_output", "")
 
-        raw = raw_dict.get((ev_id, ac_key))
+        # ---- Skip work that a previous run already paid for ----
+        old = previous.get((ev_id, ac_key))
+        todo = None
+        if old is not None:
+            todo = pending_metrics(old.get("scores", {}), cot_text)
+            if not todo:
+                return
+        elif (ev_id, ac_key) in failed_before and not RETRY_FAILED:
+            return
+
+        raw = corpus.get(ev_id, ac_key)
 
         if raw is None:
-            failures.append({
+            fail_sink.write({
                 "ev_id": ev_id, 
                 "Aircraft_Key": ac_key, 
                 "error": "No matching (ev_id, Aircraft_Key) found in raw data"
@@ -417,35 +530,47 @@ async def main():
         narrative = (raw.get("narr_accp", "") + "\n" + raw.get("narr_accf", "")).strip()
         cause = raw.get("narr_cause", "")
 
-        async with semaphore:
-            try:
-                scores = await evaluate_single(narrative, cot_text, cause, answer_text)
-                print(f"Scored: {ev_id} | {ac_key}")
-
-                return {
-                    "ev_id": ev_id,
-                    "Aircraft_Key": ac_key,
-                    "scores": scores
-                }
+        try:
+            scores = await evaluate_single(narrative, cot_text, cause, answer_text, metrics=todo)
+            print(f"Scored: {ev_id} | {ac_key}")
+
+            if old is not None:
+                # Merge the newly scored metrics into the previous record
+                merged = dict(old.get("scores", {}))
+                merged.update({k: scores[k] for k in todo})
+                old_error = None if RETRY_FAILED else merged.get("error")
+                merged["error"] = "; ".join(e for e in (old_error, scores["error"]) if e) or None
+                scores = merged
+
+            output_sink.write({
+                "ev_id": ev_id,
+                "Aircraft_Key": ac_key,
+                "scores": scores
+            })
 
-            except Exception as e:
-                print(f"Error: {ev_id} - {e}")
-                failures.append({"ev_id": ev_id, "Aircraft_Key": ac_key, "error": str(e)})
-                return
+        except Exception as e:
+            print(f"Error: {ev_id} - {e}")
+            fail_sink.write({"ev_id": ev_id, "Aircraft_Key": ac_key, "error": str(e)})
+            return
 
-    tasks = [process(item) for item in cot_data]
-    all_res = await asyncio.gather(*tasks)
-    
-    results = [r for r in all_res if r is not None]
+    try:
+        await bounded_map(process, cot_data, RECORD_CONCURRENCY)
+    finally:
+        output_sink.close()
+        fail_sink.close()
+        corpus.close()
 
     print("Saving results...")
 
-    async with aiofiles.open(output_path, "w", encoding="utf-8") as f:
-        await f.write(json.dumps(results, indent=4, ensure_ascii=False))
-
-    async with aiofiles.open(fail_path, "w", encoding="utf-8") as f:
-        await f.write(json.dumps(failures, indent=4, ensure_ascii=False))
+    order = [record_key(item) for item in cot_data]
+    results = compact_jsonl(output_sink.path, output_path, key=record_key, order=order)
+    compact_jsonl(fail_sink.path, fail_path, key=record_key, order=order, exclude={record_key(r) for r in results})
+    if SCORE_STORE:
+        write_scores(results, SCORE_STORE, model=f"{file_name}{mode_tag}")
 
+    print(f"LLM cache: {llm.cache_stats()}")
+    print(f"Judge concurrency: {judge_limiter.stats()}")
+    TELEMETRY.report(prometheus_path=TELEMETRY_PROM_FILE)
     print("All tasks complete!")
 
 if __name__ == "__main__":
@@ -3,26 +3,63 @@ Generate Responses
 LoAR Fine-tuned Model
 """
 import os
-import json
+import sys
+import time
 from tqdm import tqdm  # Progress bar
 
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+from utils.batching import fixed_batches, padding_waste, token_budget_batches
+from utils.checkpoint import JsonlSink, compact_jsonl, jsonl_path_for, load_latest
+from utils.corpus import open_corpus
+from utils.cot_split import split_record
+from utils.inference_backends import InferRequest, infer_with_oom_split, make_backend
+from utils.lora_merge import get_merged_model
+from utils.score_store import write_generations
+from utils.telemetry import TELEMETRY
+
 # GPU Configuration
 os.environ['CUDA_VISIBLE_DEVICES'] = '0'
 
-from swift.llm import (
-    PtEngine, RequestConfig, safe_snapshot_download,
-    get_model_tokenizer, get_template, InferRequest
-)
-from swift.tuners import Swift
-
 ###########################################
 #               Configuration Parameters
 ###########################################
+# "pt":       swift PtEngine (static batches, plain PyTorch)
+# "vllm":     swift VllmEngine (continuous batching)
+# "lmdeploy": swift LmdeployEngine (continuous batching, needs merged weights)
+# "openai":   an OpenAI-compatible server, see OPENAI_BASE_URL / OPENAI_MODEL
+# "mock":     CPU-only fake generations, for dry runs and tests
+BACKEND = "pt"
+
 model_path = './meta-llama/Llama-3.1-8B-Instruct'
+model_type = 'llama3_1'
 # Ensure the checkpoint path is correct
-lora_checkpoint = safe_snapshot_download(
-    '/output/Llama-3.1-8B/loar/dpo/v1-20251128-221822/checkpoint-1458'
-)
+lora_checkpoint = '/output/Llama-3.1-8B/loar/dpo/v1-20251128-221822/checkpoint-1458'
+# Merge the LoRA into the base weights once (cached per base model + checkpoint) and load the merged
+# model on every later run: faster start-up and no extra LoRA matmuls while decoding
+MERGE_LORA = True
+
+# Checkpoint sweep in one process: load the base model once and switch LoRA adapters per batch.
+# Leave empty for the single lora_checkpoint above. MERGE_LORA does not apply here (one base, many adapters).
+LORA_ADAPTERS = {
+    # "sft": {
+    #     "checkpoint": "output/Qwen3-8B/loar/sft/v5-20251120-141155/checkpoint-6630",
+    #     "output_file": "./evaluation/contrast_eva/Qwen3-8B-sft.json",
+    # },
+    # "dpo": {
+    #     "checkpoint": "output/Qwen3-8B/loar/sft/dpo/v1-20251128-221822/checkpoint-1458",
+    #     "output_file": "./evaluation/contrast_eva/Qwen3-8B-dpo.json",
+    # },
+}
+
+# Extra engine arguments, e.g. {"vllm": {"gpu_memory_utilization": 0.9, "max_model_len": 8192}}
+ENGINE_KWARGS = {}
+
+# OpenAI-compatible server (BACKEND = "openai"); the model name may be a LoRA adapter served by vLLM
+OPENAI_BASE_URL = "http://127.0.0.1:8000/v1"
+OPENAI_MODEL = "Llama-3.1-8B"
+OPENAI_CONCURRENCY = 32
+# Stream the answers, so the call statistics include the time to first token
+OPENAI_STREAM = False
 
 # Modify input and output paths
 input_file = "./evaluation/contrast_eva/contrast_sample.json"  # Ensure the file name is correct
@@ -30,97 +67,221 @@ output_file = "./evaluation/contrast_eva/Llama-3.1-8B.json"
 
 BATCH = 4   # Adjust according to GPU memory, 4090D recommends 2 or 4
 
+# Results are appended to <output>.jsonl after every batch; with RESUME the records already
+# in it (by ev_id + Aircraft_Key) are skipped, RETRY_FAILED also redoes the ones in *_fail
+RESUME = False
+RETRY_FAILED = False
+
+# Write chain_of_thought / answer directly (the process_response.py format) instead of
+# the raw model_output, so the separate splitting pass is not needed
+SPLIT_COT = False
+
+# Also store the outputs in a Parquet generation store (utils/score_store.py, needs pyarrow); None to skip
+GENERATION_STORE = None  # e.g. "./evaluation/contrast_eva/generation_store"
+
+# Per-batch latency / token statistics are printed at the end; also write them in Prometheus text format here
+TELEMETRY_PROM_FILE = None  # e.g. "./cache/metrics/generate_loar.prom"
+
+# "bucketed": sort requests by tokenized prompt length and fill batches up to MAX_BATCH_TOKENS
+# "fixed":    the old behaviour, BATCH consecutive records in file order
+BATCHING = "bucketed"
+MAX_BATCH_TOKENS = 8192   # Padded prompt tokens per batch (batch size x longest prompt)
+MAX_BATCH_SIZE = 16       # Upper bound on requests per batch, even for very short prompts
+# Continuous-batching backends schedule internally; they get the requests in chunks of this size
+CHUNK_SIZE = 256
+
+# Configure inference parameters
+MAX_TOKENS = 2048
+TEMPERATURE = 0.3  # If deterministic responses are needed, you can lower the temperature
+
+
 ###########################################
 #           Load Model and Engine
 ###########################################
-print("Loading model...")
-model, tokenizer = get_model_tokenizer(model_path, model_type='llama3_1')
-model = Swift.from_pretrained(model, lora_checkpoint)
+def build_backend():
+    if BACKEND == "openai":
+        return make_backend(
+            "openai", base_url=OPENAI_BASE_URL, model=OPENAI_MODEL, concurrency=OPENAI_CONCURRENCY,
+            max_tokens=MAX_TOKENS, temperature=TEMPERATURE, stream=OPENAI_STREAM,
+        )
+    if BACKEND == "mock":
+        return make_backend("mock")
 
-template_type = model.model_meta.template
-# If you have a custom system prompt, you can add it here, otherwise, keep the default
-template = get_template(template_type, tokenizer, default_system=None)
+    path, adapter = model_path, lora_checkpoint
+    if LORA_ADAPTERS:
+        # Bare base model; adapters are picked per infer() call
+        adapter = None
+    elif MERGE_LORA and lora_checkpoint:
+        path, adapter = get_merged_model(model_path, lora_checkpoint, model_type=model_type), None
 
-engine = PtEngine.from_model_template(model, template, max_batch_size=BATCH)
+    return make_backend(
+        BACKEND,
+        model_path=path,
+        model_type=model_type,
+        lora_checkpoint=adapter,
+        max_batch_size=BATCH if BATCHING == "fixed" else MAX_BATCH_SIZE,
+        max_tokens=MAX_TOKENS,
+        temperature=TEMPERATURE,
+        engine_kwargs=ENGINE_KWARGS.get(BACKEND),
+        multi_lora=bool(LORA_ADAPTERS),
+        max_loras=max(1, len(LORA_ADAPTERS)),
+    )
 
-# Configure inference parameters
-request_config = RequestConfig(
-    max_tokens=2048,
-    temperature=0.3, 
-    # If deterministic responses are needed, you can lower the temperature
-)
 
 ###########################################
-#       Read JSON File
+#       Build Requests
 ###########################################
-print(f"Reading data from: {input_file}")
-with open(input_file, "r", encoding="utf-8") as f:
-    # Note: Assuming the input is a standard JSON list format [{}, {}]
-    records = json.load(f)
+def build_request(item):
+    # Get input text
+    content = item.get("narr_accp", "")
+
+    if not content:
+        return None  # Skip empty content
+
+    content = content + "\n\n Please analyze the causes that led to this accident."
+
+    # Construct messages format
+    # Swift/Qwen typically requires [{'role': 'user', 'content': ...}] format
+    messages = [{"role": "user", "content": content}]
+    return InferRequest(messages=messages)
+
+
+def plan_batches(backend, infer_requests):
+    if backend.continuous_batching:
+        # The engine batches and pads per step itself; just hand it large chunks in input order
+        return fixed_batches(len(infer_requests), CHUNK_SIZE)
+
+    # Tokenized prompt length of every request (chat template included)
+    lengths = [backend.count_tokens(req) for req in infer_requests]
+
+    fixed = fixed_batches(len(infer_requests), BATCH)
+    bucketed = token_budget_batches(lengths, MAX_BATCH_TOKENS, MAX_BATCH_SIZE)
+
+    print(f"Padding waste, fixed BATCH={BATCH} in file order: {padding_waste(lengths, fixed):.1%} ({len(fixed)} batches)")
+    print(f"Padding waste, bucketed by length (<= {MAX_BATCH_TOKENS} tokens): "
+          f"{padding_waste(lengths, bucketed):.1%} ({len(bucketed)} batches)")
+    print(f"Using {BATCHING} batching")
+
+    return bucketed if BATCHING == "bucketed" else fixed
 
-print(f"Loaded {len(records)} records\n")
 
 ###########################################
-#             Start Inference (Batch Processing)
+#             Inference (Batch Processing)
 ###########################################
+def record_key(item):
+    return (str(item.get("ev_id")), str(item.get("Aircraft_Key")))
+
 
-# List to store the final results
-final_results = []
+def generate(backend, records, output_path, adapter=None):
+    fail_path = os.path.splitext(output_path)[0] + "_fail.json"
 
-print("====== Starting Inference ======")
+    # Resume: skip every record already answered (or failed, unless RETRY_FAILED)
+    done = set()
+    if RESUME:
+        done = set(load_latest(jsonl_path_for(output_path), key=record_key))
+        if not RETRY_FAILED:
+            done |= set(load_latest(jsonl_path_for(fail_path), key=record_key))
+        print(f"Resuming: {len(done)} records already handled")
 
-# Use tqdm to show progress
-for idx in tqdm(range(0, len(records), BATCH), desc="Model Inference"):
-    # 1. Get current batch of data
-    batch_items = records[idx: idx + BATCH]
-    
-    # 2. Construct inference requests
     infer_requests = []
-    valid_batch_items = []  # To correspond requests with original data
-    
-    for item in batch_items:
-        # Get input text
-        content = item.get("narr_accp", "")
-        
-        if not content:
-            continue  # Skip empty content
-
-        content = content + "\n\n Please analyze the causes that led to this accident."
-            
-        # Construct messages format
-        # Swift/Qwen typically requires [{'role': 'user', 'content': ...}] format
-        messages = [{"role": "user", "content": content}]
-        
-        infer_requests.append(InferRequest(messages=messages))
-        valid_batch_items.append(item)
-
-    if not infer_requests:
-        continue
-
-    # 3. Perform batch inference
-    responses = engine.infer(infer_requests, request_config)
-
-    # 4. Process and save results
-    for original_item, resp in zip(valid_batch_items, responses):
-        generated_answer = resp.choices[0].message.content
-        
-        # Construct output object, including the required fields
-        result_obj = {
-            "ev_id": original_item.get("ev_id"),
-            "Aircraft_Key": original_item.get("Aircraft_Key"),
-            "narr_accp": original_item.get("narr_accp"),
-            "model_output": generated_answer  # Model generated answer
-        }
-        
-        final_results.append(result_obj)
+    valid_items = []  # To correspond requests with original data
 
-###########################################
-#           Save Results as JSON
-###########################################
-print(f"\nSaving results to: {output_file}")
+    for item in records:
+        req = build_request(item)
+        if req is not None and record_key(item) not in done:
+            infer_requests.append(req)
+            valid_items.append(item)
+
+    batches = plan_batches(backend, infer_requests)
+    generated_tokens = 0
+
+    mode = "a" if RESUME else "w"
+    output_sink = JsonlSink(jsonl_path_for(output_path), mode=mode)
+    fail_sink = JsonlSink(jsonl_path_for(fail_path), mode=mode)
+
+    label = backend.name if adapter is None else f"{backend.name}, adapter {adapter[0]}"
+    model_label = os.path.splitext(os.path.basename(output_path))[0]
+    print(f"====== Starting Inference ({label}) ======")
+    start_time = time.perf_counter()
+
+    # Use tqdm to show progress
+    try:
+        for batch in tqdm(batches, desc="Model Inference"):
+            # A CUDA OOM splits the batch and retries instead of killing the run
+            batch_start = time.perf_counter()
+            results = infer_with_oom_split(backend, [infer_requests[i] for i in batch], adapter=adapter)
+            TELEMETRY.record_generation(backend.name, model_label, results, time.perf_counter() - batch_start)
+
+            for i, res in zip(batch, results):
+                original_item = valid_items[i]
+                if res is None:
+                    fail_sink.write({
+                        "ev_id": original_item.get("ev_id"),
+                        "Aircraft_Key": original_item.get("Aircraft_Key"),
+                        "error": "CUDA out of memory",
+                    })
+                    continue
+
+                # Construct output object, including the required fields
+                record = {
+                    "ev_id": original_item.get("ev_id"),
+                    "Aircraft_Key": original_item.get("Aircraft_Key"),
+                    "narr_accp": original_item.get("narr_accp"),
+                    "model_output": res.text  # Model generated answer
+                }
+                output_sink.write(split_record(record) if SPLIT_COT else record)
+                generated_tokens += res.completion_tokens or 0
+
+            # Flush every batch to disk: a crash loses at most the batch in flight
+            output_sink.sync()
+            fail_sink.sync()
+    finally:
+        output_sink.close()
+        fail_sink.close()
+
+    elapsed = time.perf_counter() - start_time
+    print(f"\nGenerated {generated_tokens} tokens in {elapsed:.1f}s "
+          f"({generated_tokens / max(elapsed, 1e-9):.1f} tokens/sec, {label})")
+
+    ###########################################
+    #           Save Results as JSON
+    ###########################################
+    # JSONL checkpoint -> JSON list in the original input order
+    print(f"\nSaving results to: {output_path}")
+    order = [record_key(item) for item in records]
+    results = compact_jsonl(output_sink.path, output_path, key=record_key, order=order)
+    compact_jsonl(fail_sink.path, fail_path, key=record_key, order=order, exclude={record_key(r) for r in results})
+    if GENERATION_STORE:
+        write_generations(results, GENERATION_STORE, model=os.path.splitext(os.path.basename(output_path))[0])
+
+
+def main():
+    print(f"Loading model ({BACKEND} backend)...")
+    backend = build_backend()
+
+    ###########################################
+    #       Read JSON File
+    ###########################################
+    print(f"Reading data from: {input_file}")
+    # Shared indexed corpus (JSON list or JSONL); every run needs all records for length bucketing
+    with open_corpus(input_file) as corpus:
+        records = list(corpus)
+
+    print(f"Loaded {len(records)} records\n")
+
+    # One output file per adapter in a sweep, otherwise the single output_file
+    if LORA_ADAPTERS:
+        runs = [((name, cfg["checkpoint"]), cfg["output_file"]) for name, cfg in LORA_ADAPTERS.items()]
+    else:
+        runs = [(None, output_file)]
+
+    for adapter, path in runs:
+        generate(backend, records, path, adapter=adapter)
+
+    backend.close()
+    TELEMETRY.report(prometheus_path=TELEMETRY_PROM_FILE)
+    print("\n==== Task Complete ====")
 
-with open(output_file, "w", encoding="utf-8") as fout:
-    # ensure_ascii=False ensures Chinese characters display correctly, indent=4 ensures a neat format
-    json.dump(final_results, fout, ensure_ascii=False, indent=4)
 
-print("\n==== Task Complete ====")
+if __name__ == "__main__":
+    main()
@@ -3,11 +3,21 @@ Generate Responses
 Ollama Model
 """
 import os
-import json
+import sys
+import asyncio
 from tqdm import tqdm
 from langchain_openai import ChatOpenAI
 from langchain_core.prompts import ChatPromptTemplate
 
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+from utils.adaptive_limiter import AdaptiveLimiter
+from utils.async_pool import bounded_map
+from utils.checkpoint import JsonlSink, compact_jsonl, jsonl_path_for, load_latest
+from utils.corpus import open_corpus
+from utils.cot_split import split_record
+from utils.score_store import write_generations
+from utils.telemetry import TELEMETRY
+
 # ==========================================
 # 1. Configuration Area: Define multiple model configurations
 # ==========================================
@@ -24,9 +34,32 @@ MODELS_CONFIG = [
     },
 ]
 
+# All model configs run at the same time. Requests in flight are limited per endpoint (base_url),
+# so several models served by one server share its limit, while different servers run in parallel.
+# The limit adapts between 1 and this maximum: it grows while latency is healthy and halves on
+# 429 / 5xx / timeouts (honoring Retry-After).
+ENDPOINT_CONCURRENCY = 8
+# Optional per-endpoint overrides, e.g. {"http://192.168.2.4:11434/v1": 4}
+ENDPOINT_LIMITS = {}
+
 # Evaluation dataset
 INPUT_FILE = "./evaluation/contrast_eva/contrast_sample.json"
 
+# Resume from the JSONL checkpoints next to each output_file instead of starting from zero
+RESUME = False
+# When resuming, also retry the records listed in the *_fail file
+RETRY_FAILED = False
+
+# Write chain_of_thought / answer directly (the process_response.py format) instead of
+# the raw model_output, so the separate splitting pass is not needed
+SPLIT_COT = False
+
+# Also store the outputs in a Parquet generation store (utils/score_store.py, needs pyarrow); None to skip
+GENERATION_STORE = None  # e.g. "./evaluation/contrast_eva/generation_store"
+
+# Per-model latency / token statistics are printed at the end; also write them in Prometheus text format here
+TELEMETRY_PROM_FILE = None  # e.g. "./cache/metrics/generate_ollama.prom"
+
 # ==========================================
 # 2. Define Prompt Template
 # ==========================================
@@ -58,80 +91,128 @@ prompt_template = ChatPromptTemplate.from_messages([
 # 3. Main Execution Logic
 # ==========================================
 
-def run_evaluation():
+def record_key(item):
+    return (str(item.get("ev_id")), str(item.get("Aircraft_Key")))
+
+
+async def run_model(config, records, endpoint_limiter, position=0):
+    current_model = config["model_name"]
+    current_base_url = config["base_url"]
+    output_path = config["output_file"]
+    fail_path = os.path.splitext(output_path)[0] + "_fail.json"
+
+    print(f"Processing model: {current_model} | API address: {current_base_url}")
+
+    # Initialize LangChain LLM
+    # Set temperature as 0.3, as in your previous code
+    llm = ChatOpenAI(
+        model=current_model,
+        openai_api_base=current_base_url, # Note: in LangChain the parameter name is usually openai_api_base or base_url
+        openai_api_key=config["api_key"],
+        temperature=0.3,
+        max_retries=0  # Retries go through the endpoint limiter, which backs off on 429 / 5xx / timeouts
+    )
+
+    # Construct chain (Chain)
+    chain = prompt_template | llm
+
+    # Resume: skip every (ev_id, Aircraft_Key) this model already answered
+    done = set()
+    if RESUME:
+        done = set(load_latest(jsonl_path_for(output_path), key=record_key))
+        if not RETRY_FAILED:
+            done |= set(load_latest(jsonl_path_for(fail_path), key=record_key))
+        print(f"[{current_model}] Resuming: {len(done)} records already handled")
+
+    pending = [item for item in records if item.get("narr_accp", "") and record_key(item) not in done]
+
+    mode = "a" if RESUME else "w"
+    output_sink = JsonlSink(jsonl_path_for(output_path), mode=mode)
+    fail_sink = JsonlSink(jsonl_path_for(fail_path), mode=mode)
+
+    # Use tqdm to show the current model's progress (one bar per model)
+    progress = tqdm(total=len(pending), desc=f"Running {current_model}", position=position)
+
+    async def process(item):
+        try:
+            # Call LangChain; the endpoint limiter is shared by every model on this server
+            response = await endpoint_limiter.call(
+                lambda: chain.ainvoke({"content": item.get("narr_accp", "")}), attempts=3, model=current_model
+            )
+            generated_answer = response.content
+
+            # Streamed to the JSONL checkpoint as soon as it completes
+            record = {
+                "ev_id": item.get("ev_id"),
+                "Aircraft_Key": item.get("Aircraft_Key"),
+                "narr_accp": item.get("narr_accp"),
+                "model_output": generated_answer,
+                "model_name": current_model # Record which model generated the output
+            }
+            if SPLIT_COT:
+                record = dict(split_record(record), model_name=current_model)
+            output_sink.write(record)
+
+        except Exception as e:
+            print(f"\n[Error] {current_model} error processing ID {item.get('ev_id')}: {e}")
+            # Record the failure so a resumed run can retry it on request
+            fail_sink.write({
+                "ev_id": item.get("ev_id"),
+                "Aircraft_Key": item.get("Aircraft_Key"),
+                "error": f"{type(e).__name__}: {e}",
+            })
+        finally:
+            progress.update(1)
+
+    # The worker count only needs to cover the endpoint limit; the limiter does the real bounding
+    workers = ENDPOINT_LIMITS.get(current_base_url, ENDPOINT_CONCURRENCY)
+    try:
+        await bounded_map(process, pending, workers)
+    finally:
+        progress.close()
+        output_sink.close()
+        fail_sink.close()
+
+    # Save the current model's results (JSONL checkpoint -> JSON list in input order)
+    print(f"Saving results to: {output_path}")
+    order = [record_key(item) for item in records]
+    results = compact_jsonl(output_sink.path, output_path, key=record_key, order=order)
+    compact_jsonl(fail_sink.path, fail_path, key=record_key, order=order, exclude={record_key(r) for r in results})
+    if GENERATION_STORE:
+        write_generations(results, GENERATION_STORE, model=os.path.splitext(os.path.basename(output_path))[0])
+
+    print(f"Model {current_model} task completed.")
+
+
+async def run_evaluation():
     # 1. Read input data
     if not os.path.exists(INPUT_FILE):
         print(f"Error: Input file {INPUT_FILE} not found")
         return
 
     print(f"Reading data: {INPUT_FILE}")
-    with open(INPUT_FILE, "r", encoding="utf-8") as f:
-        records = json.load(f)
+    with open_corpus(INPUT_FILE) as corpus:
+        records = list(corpus)
     print(f"Loaded {len(records)} records")
 
-    # 2. Iterate through the list of models and execute sequentially
+    # 2. One adaptive limiter per endpoint, then run every model config concurrently
+    endpoint_limiters = {}
     for config in MODELS_CONFIG:
-        current_model = config["model_name"]
-        current_base_url = config["base_url"]
-        output_path = config["output_file"]
-        
-        print(f"\n" + "="*50)
-        print(f"Processing model: {current_model}")
-        print(f"API address: {current_base_url}")
-        print(f"="*50)
-
-        # Initialize LangChain LLM
-        # Set temperature as 0.3, as in your previous code
-        llm = ChatOpenAI(
-            model=current_model,
-            openai_api_base=current_base_url, # Note: in LangChain the parameter name is usually openai_api_base or base_url
-            openai_api_key=config["api_key"],
-            temperature=0.3,
-            max_retries=3  # Simple retry mechanism
-        )
-
-        # Construct chain (Chain)
-        chain = prompt_template | llm
-
-        final_results = []
-        
-        # Start inference loop
-        # Use tqdm to show the current model's progress
-        for item in tqdm(records, desc=f"Running {current_model}"):
-            content = item.get("narr_accp", "")
-            
-            if not content:
-                continue
-
-            try:
-                # Call LangChain
-                response = chain.invoke({"content": content})
-                generated_answer = response.content
-
-                result_obj = {
-                    "ev_id": item.get("ev_id"),
-                    "Aircraft_Key": item.get("Aircraft_Key"),
-                    "narr_accp": item.get("narr_accp"),
-                    "model_output": generated_answer,
-                    "model_name": current_model # Record which model generated the output
-                }
-                final_results.append(result_obj)
-
-            except Exception as e:
-                print(f"\n[Error] Error processing ID {item.get('ev_id')}: {e}")
-                # In case of error, choose to either record an empty result or skip
-                continue
-
-        # 3. Save the current model's results
-        print(f"Saving results to: {output_path}")
-        os.makedirs(os.path.dirname(output_path), exist_ok=True)
-        
-        with open(output_path, "w", encoding="utf-8") as fout:
-            json.dump(final_results, fout, ensure_ascii=False, indent=4)
-            
-        print(f"Model {current_model} task completed.")
+        url = config["base_url"]
+        if url not in endpoint_limiters:
+            limit = ENDPOINT_LIMITS.get(url, ENDPOINT_CONCURRENCY)
+            endpoint_limiters[url] = AdaptiveLimiter(initial=max(1, limit // 2), max_limit=limit, name=url)
+
+    await asyncio.gather(*(
+        run_model(config, records, endpoint_limiters[config["base_url"]], position=i)
+        for i, config in enumerate(MODELS_CONFIG)
+    ))
+
+    for url, limiter in endpoint_limiters.items():
+        print(f"Concurrency {url}: {limiter.stats()}")
+    TELEMETRY.report(prometheus_path=TELEMETRY_PROM_FILE)
 
     print("\nAll model tasks completed!")
 
 if __name__ == "__main__":
-    run_evaluation()
+    asyncio.run(run_evaluation())
@@ -1,14 +1,17 @@
 """
 Separate the chain of thought and the answer from the model's response
 """
-import json
-import re
 import os
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+from utils.cot_split import split_record
+from utils.json_stream import iter_records, open_record_writer
 
 # ================= Configuration Area =================
 
 input_file = ""
-# Output file path
+# Output file path (*.json -> JSON list, *.jsonl -> one record per line)
 output_file = ""
 # ===========================================
 
@@ -19,62 +22,23 @@ def process_cot_data(input_path, output_path):
         return
 
     print(f"Reading file: {input_path} ...")
-    
+
+    # 2. Stream records through the <think> splitter (utils/cot_split.py): the input is
+    # decoded one record at a time and every split record is written out immediately,
+    # so memory does not grow with the size of the output file
+    count = 0
     try:
-        with open(input_path, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-    except json.JSONDecodeError:
+        with open_record_writer(output_path) as writer:
+            for item in iter_records(input_path):
+                writer.write(split_record(item))
+                count += 1
+    except ValueError:
+        # json.JSONDecodeError is a ValueError
         print("Error: Invalid JSON file format, please check the file content.")
         return
 
-    processed_data = []
-    
-    # 2. Compile regular expression
-    # r'<think>(.*?)</think>\s*(.*)'
-    # (.*?) : Non-greedy match, extract content inside <think>
-    # \s* : Ignore any whitespace characters (newlines, spaces, etc.) after the closing tag
-    # (.*)  : Extract the remaining content as the final answer
-    # re.DOTALL : Allow the dot to match newline characters, which is important for multi-line text
-    pattern = re.compile(r'<think>(.*?)</think>\s*(.*)', re.DOTALL)
-
-    print(f"Processing {len(data)} records...")
-
-    for item in data:
-        raw_output = item.get("model_output", "")
-        
-        # Initialize new fields
-        chain_of_thought = ""
-        final_answer = raw_output  # Default, if no tags are found, the entire content is treated as the answer
-
-        if raw_output:
-            match = pattern.search(raw_output)
-            if match:
-                # Extract content inside <think> tag and trim whitespace
-                chain_of_thought = match.group(1).strip()
-                # Extract the content after the <think> tag
-                final_answer = match.group(2).strip()
-            else:
-                # If no <think> tag is found in the data, print a simple message
-                print(f"Note: ID {item.get('ev_id')} did not contain a <think> tag, skipping separation.")
-
-        # Construct the new object
-        new_item = {
-            "ev_id": item.get("ev_id"),
-            "Aircraft_Key": item.get("Aircraft_Key"),
-            "narr_accp": item.get("narr_accp"),
-            # Newly added chain of thought field
-            "chain_of_thought": chain_of_thought,
-            # Extracted clean answer (here named as 'answer', you can rename it if needed)
-            "answer": final_answer
-        }
-        
-        processed_data.append(new_item)
-
     # 3. Save the result
-    print(f"Saving results to: {output_path}")
-    with open(output_path, 'w', encoding='utf-8') as f:
-        json.dump(processed_data, f, ensure_ascii=False, indent=4)
-
+    print(f"Saved {count} records to: {output_path}")
     print("==== Processing complete ====")
 
 # Execute function
@@ -0,0 +1,264 @@
+"""
+End-to-end contrast evaluation in one process: generate -> split -> judge -> aggregate
+
+Records stream through the stages over bounded asyncio queues, so judging starts
+with the first finished batch and the wall-clock time is roughly that of the
+slowest stage instead of the sum of all four scripts. Generation settings come
+from generate_response_loar.py, judge settings from evaluate.py.
+"""
+import os
+import sys
+import time
+import asyncio
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+from utils.checkpoint import JsonlSink, compact_jsonl, jsonl_path_for, load_latest
+from utils.corpus import open_corpus
+from utils.cot_split import split_record
+from utils.inference_backends import infer_with_oom_split
+from utils.score_store import write_generations, write_scores
+from utils.telemetry import TELEMETRY
+
+import generate_response_loar as generator
+import evaluate as judge
+from compute_scores import accumulate, print_averages
+
+# =============================
+# Configuration
+# =============================
+PROCESS_DIR = "./evaluation/contrast_eva/process_results"
+RESULTS_DIR = "./evaluation/contrast_eva/eva_results"
+
+# Also write the raw generations (generator output_file) and the split records
+# (process_results/<name>.json); the scores are always written
+SAVE_INTERMEDIATE = True
+
+# Skip records that already have scores in the JSONL checkpoint of a previous run
+RESUME = False
+
+# Records waiting between two stages; a full queue pauses the stage in front of it
+QUEUE_SIZE = 256
+
+# Generation and judge call statistics are printed at the end; also write them in Prometheus text format here
+TELEMETRY_PROM_FILE = None  # e.g. "./cache/metrics/pipeline.prom"
+
+_DONE = object()
+
+
+class Run:
+    """One generator output (a single model, or one adapter of a sweep) and its files."""
+
+    def __init__(self, adapter, output_file):
+        self.adapter = adapter
+        self.name = os.path.splitext(os.path.basename(output_file))[0]
+        self.output_file = output_file
+
+        mode_tag = "_batched" if judge.JUDGE_MODE == "batched" else ""
+        self.score_model = f"{self.name}{mode_tag}"
+        self.split_path = os.path.join(PROCESS_DIR, f"{self.name}.json")
+        self.score_path = os.path.join(RESULTS_DIR, f"{self.score_model}_scores.json")
+        self.fail_path = os.path.join(RESULTS_DIR, f"{self.score_model}_fail.json")
+
+        self.metric_sums = {}
+        self.metric_counts = {}
+        self.scored = 0
+
+        self.done = set()
+        if RESUME:
+            previous = load_latest(jsonl_path_for(self.score_path), key=generator.record_key)
+            self.done = set(previous)
+            # Averages cover the whole run, not only the records scored this time
+            for scored in previous.values():
+                accumulate(scored.get("scores", {}), self.metric_sums, self.metric_counts)
+            self.scored = len(previous)
+
+        mode = "a" if RESUME else "w"
+        self.generation_sink = JsonlSink(jsonl_path_for(output_file), mode=mode) if SAVE_INTERMEDIATE else None
+        self.split_sink = JsonlSink(jsonl_path_for(self.split_path), mode=mode) if SAVE_INTERMEDIATE else None
+        self.score_sink = JsonlSink(jsonl_path_for(self.score_path), mode=mode)
+        self.fail_sink = JsonlSink(jsonl_path_for(self.fail_path), mode=mode)
+
+    def sinks(self):
+        return [s for s in (self.generation_sink, self.split_sink, self.score_sink, self.fail_sink) if s]
+
+    def close(self):
+        for sink in self.sinks():
+            sink.close()
+
+    def compact(self, records):
+        order = [generator.record_key(item) for item in records]
+        key = generator.record_key
+        if SAVE_INTERMEDIATE:
+            compact_jsonl(self.generation_sink.path, self.output_file, key=key, order=order)
+            split = compact_jsonl(self.split_sink.path, self.split_path, key=key, order=order)
+            if generator.GENERATION_STORE:
+                write_generations(split, generator.GENERATION_STORE, model=self.name)
+        results = compact_jsonl(self.score_sink.path, self.score_path, key=key, order=order)
+        compact_jsonl(self.fail_sink.path, self.fail_path, key=key, order=order,
+                      exclude={key(r) for r in results})
+        if judge.SCORE_STORE:
+            write_scores(results, judge.SCORE_STORE, model=self.score_model)
+
+
+# =============================
+# Stage 1: generation
+# =============================
+async def generate_stage(backend, runs, records, out_queue):
+    # Batches run one at a time in a worker thread, so the event loop keeps judging meanwhile
+    for run in runs:
+        items, requests = [], []
+        for item in records:
+            req = generator.build_request(item)
+            if req is not None and generator.record_key(item) not in run.done:
+                items.append(item)
+                requests.append(req)
+
+        print(f"====== Generating {len(requests)} responses ({run.name}) ======")
+        for batch in generator.plan_batches(backend, requests):
+            batch_start = time.perf_counter()
+            results = await asyncio.to_thread(
+                infer_with_oom_split, backend, [requests[i] for i in batch], run.adapter
+            )
+            TELEMETRY.record_generation(backend.name, run.name, results, time.perf_counter() - batch_start)
+            for i, res in zip(batch, results):
+                item = items[i]
+                if res is None:
+                    run.fail_sink.write({
+                        "ev_id": item.get("ev_id"),
+                        "Aircraft_Key": item.get("Aircraft_Key"),
+                        "error": "CUDA out of memory",
+                    })
+                    continue
+
+                record = {
+                    "ev_id": item.get("ev_id"),
+                    "Aircraft_Key": item.get("Aircraft_Key"),
+                    "narr_accp": item.get("narr_accp"),
+                    "model_output": res.text
+                }
+                if run.generation_sink:
+                    run.generation_sink.write(record)
+                await out_queue.put((run, item, record))
+
+    await out_queue.put(_DONE)
+
+
+# =============================
+# Stage 2: CoT / answer split
+# =============================
+async def split_stage(in_queue, out_queue, judge_workers):
+    while True:
+        entry = await in_queue.get()
+        if entry is _DONE:
+            break
+
+        run, item, record = entry
+        split = split_record(record)
+        if run.split_sink:
+            run.split_sink.write(split)
+        await out_queue.put((run, item, split))
+
+    for _ in range(judge_workers):
+        await out_queue.put(_DONE)
+
+
+# =============================
+# Stage 3: judge
+# =============================
+async def judge_worker(in_queue, out_queue):
+    while True:
+        entry = await in_queue.get()
+        if entry is _DONE:
+            return
+
+        run, item, split = entry
+        ev_id, ac_key = generator.record_key(item)
+        narrative = (item.get("narr_accp", "") + "\n" + item.get("narr_accf", "")).strip()
+        cause = item.get("narr_cause", "")
+
+        try:
+            scores = await judge.evaluate_single(narrative, split["chain_of_thought"], cause, split["answer"])
+        except Exception as e:
+            print(f"Error: {ev_id} - {e}")
+            run.fail_sink.write({"ev_id": ev_id, "Aircraft_Key": ac_key, "error": str(e)})
+            continue
+
+        await out_queue.put((run, {"ev_id": ev_id, "Aircraft_Key": ac_key, "scores": scores}))
+
+
+async def judge_stage(in_queue, out_queue, workers):
+    # evaluate.judge_limiter still bounds the judge requests in flight
+    await asyncio.gather(*(judge_worker(in_queue, out_queue) for _ in range(workers)))
+    await out_queue.put(_DONE)
+
+
+# =============================
+# Stage 4: aggregation
+# =============================
+async def aggregate_stage(in_queue):
+    while True:
+        entry = await in_queue.get()
+        if entry is _DONE:
+            return
+
+        run, scored = entry
+        run.score_sink.write(scored)
+        accumulate(scored["scores"], run.metric_sums, run.metric_counts)
+        run.scored += 1
+
+
+async def run_pipeline(backend, runs, records):
+    generated = asyncio.Queue(QUEUE_SIZE)
+    split = asyncio.Queue(QUEUE_SIZE)
+    scored = asyncio.Queue(QUEUE_SIZE)
+
+    tasks = [
+        asyncio.create_task(generate_stage(backend, runs, records, generated)),
+        asyncio.create_task(split_stage(generated, split, judge.RECORD_CONCURRENCY)),
+        asyncio.create_task(judge_stage(split, scored, judge.RECORD_CONCURRENCY)),
+        asyncio.create_task(aggregate_stage(scored)),
+    ]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        # One failed stage would leave the others blocked on their queues
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+def main():
+    backend = generator.build_backend()
+
+    print(f"Reading data from: {generator.input_file}")
+    with open_corpus(generator.input_file) as corpus:
+        records = list(corpus)
+    print(f"Loaded {len(records)} records\n")
+
+    if generator.LORA_ADAPTERS:
+        runs = [Run((name, cfg["checkpoint"]), cfg["output_file"]) for name, cfg in generator.LORA_ADAPTERS.items()]
+    else:
+        runs = [Run(None, generator.output_file)]
+
+    start_time = time.perf_counter()
+    try:
+        asyncio.run(run_pipeline(backend, runs, records))
+    finally:
+        for run in runs:
+            run.close()
+        backend.close()
+
+    print(f"\nPipeline finished in {time.perf_counter() - start_time:.1f}s")
+    for run in runs:
+        run.compact(records)
+        print_averages(os.path.basename(run.score_path), run.scored, run.metric_sums, run.metric_counts)
+
+    print(f"LLM cache: {judge.llm.cache_stats()}")
+    print(f"Judge concurrency: {judge.judge_limiter.stats()}")
+    TELEMETRY.report(prometheus_path=TELEMETRY_PROM_FILE)
+    print("\n==== Task Complete ====")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,20 +2,59 @@
 Batch Evaluate Chain-of-Thought (COT) Scoring Script (Automatically Match Original Data + Output 0-1 Score System)
 """
 
+import os
+import sys
 import json
 import asyncio
 import aiofiles
-from langchain_openai import ChatOpenAI
-from tenacity import retry, stop_after_attempt, wait_exponential, RetryError
 
-llm = ChatOpenAI(
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+from utils.adaptive_limiter import AdaptiveLimiter
+from utils.async_pool import bounded_map
+from utils.llm_client import make_llm
+from utils.judge_prompts import all_fields, build_batched_prompt, build_prefixed_prompt, parse_batched_scores
+from utils.checkpoint import JsonlSink, compact_jsonl, jsonl_path_for, load_latest
+from utils.corpus import open_corpus
+from utils.score_store import write_scores
+from utils.telemetry import TELEMETRY
+
+# Responses are cached on disk by (model, temperature, prompt); set to None to always call the model
+LLM_CACHE_PATH = "./cache/llm_responses.sqlite"
+
+llm = make_llm(
     model="",
     base_url="",
     api_key="",
     temperature=0.3,
     timeout=120,
+    cache_path=LLM_CACHE_PATH,
 )
 
+RESUME = False        # Continue from the existing JSONL checkpoints, only scoring the missing metrics
+RETRY_FAILED = False  # When resuming, also retry failed records and metrics that came back as None
+
+# Also store the final scores in a Parquet score store (utils/score_store.py, needs pyarrow); None to skip
+SCORE_STORE = None  # e.g. "./evaluation/generate_COT_eva/score_store"
+
+# Call latency / token / cost summary is always printed; also write it in Prometheus text format here
+TELEMETRY_PROM_FILE = None  # e.g. "./cache/metrics/cot_judge.prom"
+
+# "per_metric": one judge call per metric (default)
+# "batched":    one call returning all metrics as JSON; per-metric calls only for fields that fail to parse
+JUDGE_MODE = "per_metric"
+
+# "classic": the original templates (instruction first, then the record's context)
+# "prefix":  the record's narrative / CoT / cause in a stable leading block shared by all five
+#            metric prompts, rubric after it, so vLLM/SGLang prefix caching reuses the prefill
+PROMPT_LAYOUT = "classic"
+
+REQUEST_CONCURRENCY = 100  # Upper bound of judge requests in flight, across all records and metrics
+RECORD_CONCURRENCY = 50    # Records being scored at the same time (their metrics share the budget above)
+
+# Adapts the requests actually in flight (up to REQUEST_CONCURRENCY) to the endpoint: grows while
+# latency and errors are healthy, halves on 429 / 5xx / timeouts and honors Retry-After
+judge_limiter = AdaptiveLimiter(initial=16, max_limit=REQUEST_CONCURRENCY, name="judge")
+
 FAITHFULNESS_PROMPT = """
 You are an aviation accident investigation expert, and you are now to assess whether a chain of thought is faithful to the accident narrative.
 
@@ -138,6 +177,14 @@ You are an investigator familiar with NTSB writing style. Please determine wheth
 Please output only a number from 1 to 5. Do not output explanations or other information.
 """
 
+METRIC_TEMPLATES = {
+    "faithfulness": FAITHFULNESS_PROMPT,
+    "logicality": LOGICALITY_PROMPT,
+    "support": SUPPORT_PROMPT,
+    "completeness": COMPLETENESS_PROMPT,
+    "ntsb_style": NTSB_STYLE_PROMPT,
+}
+
 # =============================
 # Convert 1–5 to 0–1
 # =============================
@@ -147,39 +194,93 @@ def normalize(score):
 # =============================
 # Call the model
 # =============================
-@retry(stop=stop_after_attempt(3), wait=wait_exponential(min=2, max=10))
-async def ask_score(prompt):
-    resp = await llm.ainvoke(prompt)
+async def ask_score(prompt, metric=None):
+    # One limiter slot per attempt, so retry back-off does not hold a slot
+    async def attempt():
+        # Only valid scores go into the cache, so a retry after a malformed answer reaches the model again
+        resp = await llm.ainvoke(prompt, cache_if=lambda txt: txt.strip() in ["1", "2", "3", "4", "5"])
+
+        if hasattr(resp, "content"):
+            txt = resp.content.strip()
+        else:
+            raise TypeError("Model format error")
+
+        if txt not in ["1", "2", "3", "4", "5"]:
+            raise ValueError(f"Invalid score from model: {txt}")
+        return txt
+
+    txt = await judge_limiter.call(attempt, attempts=3, label=metric)
+    return normalize(int(txt))
 
-    if hasattr(resp, "content"):
-        txt = resp.content.strip()
-    else:
-        raise TypeError("Model format error")
 
-    if txt not in ["1", "2", "3", "4", "5"]:
-        raise ValueError(f"Invalid score from model: {txt}")
+# =============================
+# Batched rubric: all metrics in one JSON answer
+# =============================
+async def ask_scores_batched(templates, values):
+    metrics = list(templates)
+    prompt = build_batched_prompt(templates, values, fields=all_fields(METRIC_TEMPLATES))
+
+    def complete(txt):
+        return None not in parse_batched_scores(txt, metrics).values()
+
+    # Single attempt (apart from overload retries): anything that does not parse is re-scored per metric by the caller
+    try:
+        resp = await judge_limiter.call(lambda: llm.ainvoke(prompt, cache_if=complete), attempts=1, label="batched")
+        parsed = parse_batched_scores(resp.content, metrics)
+    except Exception as e:
+        print(f"Batched judge call failed, falling back to per-metric calls: {e}")
+        return {}
+
+    return {m: normalize(v) for m, v in parsed.items() if v is not None}
+
+
+METRICS = ["faithfulness", "logicality", "support", "completeness", "ntsb_style"]
+
+
+def build_prompts(values, metrics):
+    # {metric: prompt} in the configured PROMPT_LAYOUT
+    if PROMPT_LAYOUT == "prefix":
+        fields = all_fields(METRIC_TEMPLATES)
+        return {m: build_prefixed_prompt(m, METRIC_TEMPLATES[m], values, fields) for m in metrics}
+    return {m: METRIC_TEMPLATES[m].format(**values) for m in metrics}
+
+
+def pending_metrics(scores):
+    # Metrics of an already written record that still need a judge call
+    if RETRY_FAILED:
+        return [m for m in METRICS if scores.get(m) is None]
+    return [m for m in METRICS if m not in scores]
 
-    return normalize(int(txt))
 
 # =============================
 # Calculate the five scores for a single record
 # =============================
-async def evaluate_single(narrative, cot, cause):
-    prompts = {
-        "faithfulness": FAITHFULNESS_PROMPT.format(narrative=narrative, cot=cot),
-        "logicality":   LOGICALITY_PROMPT.format(narrative=narrative, cot=cot),
-        "support":      SUPPORT_PROMPT.format(narrative=narrative, cot=cot, cause=cause),
-        "completeness": COMPLETENESS_PROMPT.format(narrative=narrative, cot=cot),
-        "ntsb_style":   NTSB_STYLE_PROMPT.format(cot=cot),
-    }
+async def evaluate_single(narrative, cot, cause, metrics=None):
+    values = {"narrative": narrative, "cot": cot, "cause": cause}
+
+    # Only score the requested metrics (used when resuming a partially scored record)
+    keys = METRICS if metrics is None else [k for k in METRICS if k in metrics]
+    prompts = build_prompts(values, keys)
 
     results = {}
-    for key, p in prompts.items():
-        try:
-            results[key] = await ask_score(p)
-        except Exception as e:
+
+    # Batched rubric: fill every field that parses, leave the rest to the per-metric calls below
+    if JUDGE_MODE == "batched" and len(prompts) > 1:
+        batched = await ask_scores_batched({k: METRIC_TEMPLATES[k] for k in prompts}, values)
+        for key, score in batched.items():
+            results[key] = score
+            del prompts[key]
+
+    # Send all five prompts at once; judge_limiter bounds the requests actually in flight
+    keys = list(prompts)
+    outcomes = await asyncio.gather(*(ask_score(prompts[k], k) for k in keys), return_exceptions=True)
+
+    for key, out in zip(keys, outcomes):
+        if isinstance(out, Exception):
             results[key] = None
-            results["error"] = str(e)
+            results["error"] = str(out)
+        else:
+            results[key] = out
 
     print(results)
     return results
@@ -195,8 +296,10 @@ async def main():
     # B: Raw NTSB Data File (Contains narrative + cause)
     raw_path = "./evaluation/generate_COT_eva/sample.json"
 
-    output_path = "./evaluation/generate_COT_eva/eva_results/DeepSeek-V3.2_scores.json"
-    fail_path   = "./evaluation/generate_COT_eva/eva_results/DeepSeek-V3.2_scores_fail.json"
+    # Batched-rubric runs get their own files, so judge_agreement.py can compare the two modes
+    mode_tag = "_batched" if JUDGE_MODE == "batched" else ""
+    output_path = f"./evaluation/generate_COT_eva/eva_results/DeepSeek-V3.2{mode_tag}_scores.json"
+    fail_path   = f"./evaluation/generate_COT_eva/eva_results/DeepSeek-V3.2{mode_tag}_scores_fail.json"
 
     print(" Loading files...")
 
@@ -205,65 +308,94 @@ async def main():
         cot_data = json.loads(await f.read())
 
     # -------- Load Raw Data File --------
-    async with aiofiles.open(raw_path, "r", encoding="utf-8") as f:
-        raw_data = json.loads(await f.read())
-
-    # -------- Convert raw data to dict — to quickly find by ev_id --------
-    raw_dict = {item["ev_id"]: item for item in raw_data}
+    # -------- Indexed, mmap-backed raw data — to quickly find by ev_id --------
+    corpus = open_corpus(raw_path)
 
-    print(f"COT entries: {len(cot_data)}, Raw data entries: {len(raw_data)}")
+    print(f"COT entries: {len(cot_data)}, Raw data entries: {len(corpus)}")
     print(" Starting to match by ev_id and score...")
 
-    results = []
-    failures = []
+    def record_key(item):
+        return item.get("ev_id")
 
-    semaphore = asyncio.Semaphore(100)
+    # -------- Resume: what is already scored, per (ev_id, metric) --------
+    previous, failed_before = {}, set()
+    if RESUME:
+        previous = load_latest(jsonl_path_for(output_path), key=record_key)
+        failed_before = set(load_latest(jsonl_path_for(fail_path), key=record_key)) - set(previous)
+        print(f"Resuming: {len(previous)} records already scored, {len(failed_before)} failed before")
+
+    mode = "a" if RESUME else "w"
+    output_sink = JsonlSink(jsonl_path_for(output_path), mode=mode)
+    fail_sink = JsonlSink(jsonl_path_for(fail_path), mode=mode)
 
     async def process(cot_item):
         ev_id = cot_item.get("ev_id")
         cot   = cot_item.get("chain_of_thought", "")
 
+        # -------- Skip work that a previous run already paid for --------
+        old = previous.get(ev_id)
+        todo = None
+        if old is not None:
+            todo = pending_metrics(old.get("scores", {}))
+            if not todo:
+                return
+        elif ev_id in failed_before and not RETRY_FAILED:
+            return
+
         # -------- Find the narrative and cause --------
-        raw = raw_dict.get(ev_id)
+        raw = corpus.get(ev_id)
 
         if raw is None:
             print(f"Original narrative not found: {ev_id}")
-            failures.append({"ev_id": ev_id, "error": "Missing original data"})
+            fail_sink.write({"ev_id": ev_id, "error": "Missing original data"})
             return
 
         narrative = (raw.get("narr_accp", "") + "\n" + raw.get("narr_accf", "")).strip()
         cause = raw.get("narr_cause", "")
 
-        async with semaphore:
-            try:
-                scores = await evaluate_single(narrative, cot, cause)
-                print(f"Scoring completed: {ev_id}")
-
-                return {
-                    "ev_id": ev_id,
-                    "scores": scores
-                }
+        try:
+            scores = await evaluate_single(narrative, cot, cause, metrics=todo)
+            print(f"Scoring completed: {ev_id}")
+
+            if old is not None:
+                # Merge the newly scored metrics into the previous record
+                merged = dict(old.get("scores", {}))
+                if RETRY_FAILED:
+                    merged.pop("error", None)
+                merged.update(scores)
+                scores = merged
+
+            # Written as soon as the record is scored
+            output_sink.write({
+                "ev_id": ev_id,
+                "scores": scores
+            })
 
-            except Exception as e:
-                print(f" Scoring failed: {ev_id} - {e}")
-                failures.append({"ev_id": ev_id, "error": str(e)})
-                return
+        except Exception as e:
+            print(f" Scoring failed: {ev_id} - {e}")
+            fail_sink.write({"ev_id": ev_id, "error": str(e)})
+            return
 
-    # -------- Process each record --------
-    for item in cot_data:
-        res = await process(item)
-        if res:
-            results.append(res)
+    # -------- Score RECORD_CONCURRENCY records at a time --------
+    try:
+        await bounded_map(process, cot_data, RECORD_CONCURRENCY)
+    finally:
+        output_sink.close()
+        fail_sink.close()
+        corpus.close()
 
     # -------- Save --------
     print(" Saving results...")
 
-    async with aiofiles.open(output_path, "w", encoding="utf-8") as f:
-        await f.write(json.dumps(results, indent=4, ensure_ascii=False))
-
-    async with aiofiles.open(fail_path, "w", encoding="utf-8") as f:
-        await f.write(json.dumps(failures, indent=4, ensure_ascii=False))
+    order = [record_key(item) for item in cot_data]
+    results = compact_jsonl(output_sink.path, output_path, key=record_key, order=order)
+    compact_jsonl(fail_sink.path, fail_path, key=record_key, order=order, exclude={record_key(r) for r in results})
+    if SCORE_STORE:
+        write_scores(results, SCORE_STORE, model=f"DeepSeek-V3.2{mode_tag}")
 
+    print(f" LLM cache: {llm.cache_stats()}")
+    print(f" Judge concurrency: {judge_limiter.stats()}")
+    TELEMETRY.report(prometheus_path=TELEMETRY_PROM_FILE)
     print(" All completed!")
     print(f"Result file: {output_path}")
     print(f"Failure file: {fail_path}")
@@ -0,0 +1,132 @@
+"""
+Agreement Report: Per-Metric Judge Calls vs Batched-Rubric Judge Calls
+"""
+import os
+import sys
+import json
+import math
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from utils.checkpoint import iter_jsonl
+
+# ================= Configuration Area =================
+# Same records scored twice: JUDGE_MODE = "per_metric" and JUDGE_MODE = "batched"
+per_metric_file = "./evaluation/contrast_eva/eva_results/Qwen3-8B_scores.json"
+batched_file = "./evaluation/contrast_eva/eva_results/Qwen3-8B_batched_scores.json"
+# Optional machine-readable copy of the report (None to skip)
+report_file = "./evaluation/contrast_eva/eva_results/Qwen3-8B_judge_agreement.json"
+# ======================================================
+
+
+def load_scores(path):
+    if path.endswith(".jsonl"):
+        data = iter_jsonl(path)
+    else:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+
+    scores = {}
+    for item in data:
+        key = (str(item.get("ev_id")), str(item.get("Aircraft_Key", "")))
+        scores[key] = item.get("scores", {})
+    return scores
+
+
+def to_points(v):
+    # 0-1 normalized score back to the 1-5 scale
+    return int(round(v * 4 + 1))
+
+
+def pearson(xs, ys):
+    n = len(xs)
+    mx, my = sum(xs) / n, sum(ys) / n
+    sxy = sum((x - mx) * (y - my) for x, y in zip(xs, ys))
+    sxx = sum((x - mx) ** 2 for x in xs)
+    syy = sum((y - my) ** 2 for y in ys)
+    if sxx == 0 or syy == 0:
+        return None
+    return sxy / math.sqrt(sxx * syy)
+
+
+def quadratic_kappa(xs, ys, k=5):
+    # Cohen's kappa with quadratic weights on the 1-5 scale
+    n = len(xs)
+    observed = [[0] * k for _ in range(k)]
+    for x, y in zip(xs, ys):
+        observed[x - 1][y - 1] += 1
+    hist_x = [sum(row) for row in observed]
+    hist_y = [sum(observed[i][j] for i in range(k)) for j in range(k)]
+
+    num = den = 0.0
+    for i in range(k):
+        for j in range(k):
+            w = (i - j) ** 2 / (k - 1) ** 2
+            num += w * observed[i][j]
+            den += w * hist_x[i] * hist_y[j] / n
+    if den == 0:
+        return None
+    return 1 - num / den
+
+
+def agreement_report(per_metric_path, batched_path):
+    a = load_scores(per_metric_path)
+    b = load_scores(batched_path)
+    shared = [k for k in a if k in b]
+
+    metrics = sorted({
+        m for k in shared for m, v in a[k].items()
+        if isinstance(v, (int, float)) and not isinstance(v, bool)
+    })
+
+    report = {}
+    for m in metrics:
+        pairs = [
+            (a[k][m], b[k][m]) for k in shared
+            if isinstance(a[k].get(m), (int, float)) and isinstance(b[k].get(m), (int, float))
+        ]
+        if not pairs:
+            continue
+
+        xs = [to_points(x) for x, _ in pairs]
+        ys = [to_points(y) for _, y in pairs]
+        diffs = [y - x for x, y in zip(xs, ys)]
+        n = len(pairs)
+
+        r = pearson(xs, ys)
+        kappa = quadratic_kappa(xs, ys)
+        report[m] = {
+            "n": n,
+            "exact_agreement": round(sum(d == 0 for d in diffs) / n, 4),
+            "within_one_point": round(sum(abs(d) <= 1 for d in diffs) / n, 4),
+            "mean_abs_diff_points": round(sum(abs(d) for d in diffs) / n, 4),
+            "mean_diff_points": round(sum(diffs) / n, 4),  # > 0: batched mode scores higher
+            "pearson_r": None if r is None else round(r, 4),
+            "quadratic_kappa": None if kappa is None else round(kappa, 4),
+        }
+
+    return {"records_compared": len(shared), "metrics": report}
+
+
+if __name__ == "__main__":
+    for path in (per_metric_file, batched_file):
+        if not os.path.exists(path):
+            print(f"Error: File {path} not found")
+            sys.exit(1)
+
+    result = agreement_report(per_metric_file, batched_file)
+
+    print(f"Records scored in both modes: {result['records_compared']}")
+    print(f"{'metric':<20} {'n':>6} {'exact':>7} {'±1':>7} {'MAD':>7} {'bias':>7} {'r':>7} {'kappa':>7}")
+    print("-" * 72)
+    fmt = lambda v: "   n/a" if v is None else f"{v:7.3f}"
+    for m, row in result["metrics"].items():
+        print(
+            f"{m:<20} {row['n']:>6} {fmt(row['exact_agreement'])} {fmt(row['within_one_point'])} "
+            f"{fmt(row['mean_abs_diff_points'])} {fmt(row['mean_diff_points'])} "
+            f"{fmt(row['pearson_r'])} {fmt(row['quadratic_kappa'])}"
+        )
+
+    if report_file:
+        with open(report_file, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=4, ensure_ascii=False)
+        print(f"\nReport saved to: {report_file}")
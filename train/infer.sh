@@ -1,6 +1,14 @@
+set -euo pipefail
+
+# Merge the LoRA adapters into the base weights once (cached under ./cache/merged_models),
+# then run inference on the merged model: no per-token LoRA overhead, faster start-up on reruns
+ADAPTERS=output_dpo/Qwen3-8B/v4-20251121-235442/checkpoint-1442
+MERGED=$(CUDA_VISIBLE_DEVICES=0 python -m utils.lora_merge --adapters ${ADAPTERS})
+[ -d "$MERGED" ] || { echo "merge failed" >&2; exit 1; }
+
 CUDA_VISIBLE_DEVICES=0 \
 swift infer \
-    --adapters output_dpo/Qwen3-8B/v4-20251121-235442/checkpoint-1442 \
+    --model ${MERGED} \
     --stream true \
     --temperature 0 \
     --max_new_tokens 2048
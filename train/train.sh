@@ -26,6 +26,10 @@ swift sft \
     --model_author aviation \
     --model_name aviation-sft
 
+# Same SFT run from the pre-tokenized, packed data (no tokenization at start-up, several samples per step)
+# python COT/pretokenize.py
+# CUDA_VISIBLE_DEVICES=0 python train/train_packed.py
+
 # Qwen3-8B/loar/dpo
 CUDA_VISIBLE_DEVICES=0 \
 swift rlhf \
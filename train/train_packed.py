@@ -0,0 +1,130 @@
+"""
+LoRA SFT from the pre-tokenized, packed stores (COT/pretokenize.py)
+
+Same model and hyper-parameters as the `swift sft` run in train.sh, but the
+data comes from the memory-mapped token stores: no tokenization at start-up,
+and every step trains on a pack of samples filling up to MAX_LENGTH tokens
+instead of a single sample. Packed samples are separated by position_ids that
+restart at 0, which flash attention treats as separate sequences.
+
+    python COT/build_training_data.py
+    python COT/pretokenize.py
+    CUDA_VISIBLE_DEVICES=0 python train/train_packed.py
+"""
+import os
+import sys
+from functools import partial
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from utils.token_store import (LengthGroupedSampler, PackedDataset, SequenceDataset, TokenStore,
+                               collate_packed, collate_padded)
+
+# ================= Configuration Area =================
+MODEL_PATH = "./Qwen/Qwen3-8B"
+TRAIN_STORE = "./COT/sft_data/tokenized/train"
+VAL_STORE = "./COT/sft_data/tokenized/val"
+OUTPUT_DIR = "output/Qwen3-8B/loar/sft_packed"
+
+# True: one pack (up to MAX_LENGTH tokens of whole samples) per item, padding-free batches
+# False: one sample per item, padded batches of similar length (length-grouped sampler)
+PACKING = True
+
+NUM_TRAIN_EPOCHS = 2
+PER_DEVICE_BATCH_SIZE = 1
+GRADIENT_ACCUMULATION_STEPS = 2
+LEARNING_RATE = 1e-4
+WARMUP_RATIO = 0.05
+LORA_RANK = 8
+LORA_ALPHA = 32
+EVAL_STEPS = 200
+SAVE_STEPS = 500
+SAVE_TOTAL_LIMIT = 3
+LOGGING_STEPS = 20
+DATALOADER_NUM_WORKERS = 4
+SEED = 42
+# ======================================================
+
+
+def build_datasets():
+    train_store, val_store = TokenStore(TRAIN_STORE), TokenStore(VAL_STORE)
+    if PACKING:
+        return PackedDataset(train_store), PackedDataset(val_store), train_store.pack_lengths()
+    return SequenceDataset(train_store), SequenceDataset(val_store), list(train_store.lengths())
+
+
+def main():
+    import torch
+    from peft import LoraConfig, get_peft_model
+    from transformers import AutoModelForCausalLM, AutoTokenizer, Trainer, TrainingArguments
+
+    train_dataset, eval_dataset, train_lengths = build_datasets()
+    print(f"Train items: {len(train_dataset)} ({'packs' if PACKING else 'samples'}), eval items: {len(eval_dataset)}")
+
+    tokenizer = AutoTokenizer.from_pretrained(MODEL_PATH, trust_remote_code=True)
+    model = AutoModelForCausalLM.from_pretrained(
+        MODEL_PATH,
+        torch_dtype=torch.bfloat16,
+        # Needed for packing: varlen attention from the position_ids restarts
+        attn_implementation="flash_attention_2",
+        trust_remote_code=True,
+    )
+    model = get_peft_model(model, LoraConfig(
+        r=LORA_RANK, lora_alpha=LORA_ALPHA, target_modules="all-linear", task_type="CAUSAL_LM",
+    ))
+    model.print_trainable_parameters()
+
+    if PACKING:
+        collator = collate_packed
+    else:
+        pad_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+        collator = partial(collate_padded, pad_token_id=pad_id)
+
+    class StoreTrainer(Trainer):
+        def get_train_dataloader(self):
+            from torch.utils.data import DataLoader
+
+            # Similar lengths in a batch: little padding unpacked, similar pack sizes packed
+            sampler = LengthGroupedSampler(train_lengths, self.args.per_device_train_batch_size, seed=self.args.seed)
+            return self.accelerator.prepare(DataLoader(
+                self.train_dataset,
+                batch_sampler=sampler,
+                collate_fn=self.data_collator,
+                num_workers=self.args.dataloader_num_workers,
+                pin_memory=True,
+            ))
+
+    args = TrainingArguments(
+        output_dir=OUTPUT_DIR,
+        num_train_epochs=NUM_TRAIN_EPOCHS,
+        per_device_train_batch_size=PER_DEVICE_BATCH_SIZE,
+        per_device_eval_batch_size=PER_DEVICE_BATCH_SIZE,
+        gradient_accumulation_steps=GRADIENT_ACCUMULATION_STEPS,
+        learning_rate=LEARNING_RATE,
+        warmup_ratio=WARMUP_RATIO,
+        eval_strategy="steps",
+        eval_steps=EVAL_STEPS,
+        save_steps=SAVE_STEPS,
+        save_total_limit=SAVE_TOTAL_LIMIT,
+        logging_steps=LOGGING_STEPS,
+        bf16=True,
+        dataloader_num_workers=DATALOADER_NUM_WORKERS,
+        # The stores already hold exactly the model inputs
+        remove_unused_columns=False,
+        seed=SEED,
+        report_to="none",
+    )
+
+    trainer = StoreTrainer(
+        model=model,
+        args=args,
+        train_dataset=train_dataset,
+        eval_dataset=eval_dataset,
+        data_collator=collator,
+    )
+    trainer.train()
+    trainer.save_model(OUTPUT_DIR)
+    tokenizer.save_pretrained(OUTPUT_DIR)
+
+
+if __name__ == "__main__":
+    main()
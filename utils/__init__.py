@@ -0,0 +1,3 @@
+"""
+Shared helpers for the CausalAir generation and evaluation scripts
+"""
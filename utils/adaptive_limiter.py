@@ -0,0 +1,224 @@
+"""
+Adaptive (AIMD) concurrency limit for LLM endpoints
+
+Instead of a fixed Semaphore(N) plus per-task retries, every request to an
+endpoint goes through one AdaptiveLimiter:
+
+  - slow start: the limit grows by one per success until the first sign of overload,
+    then by about one per round trip (additive increase, +1/limit per success)
+  - on HTTP 429, 5xx, timeouts and connection errors the limit is multiplied by
+    `backoff` (multiplicative decrease), at most once per round trip: requests
+    that were already in flight when the limit dropped do not cut it again
+  - latency climbing well above the best latency seen so far also counts as
+    overload, so the limit stops growing before the endpoint starts failing
+  - a Retry-After header pauses all new requests to the endpoint until it expires
+
+    limiter = AdaptiveLimiter(initial=16, max_limit=200)
+    result = await limiter.call(lambda: llm.ainvoke(prompt), attempts=3)
+"""
+import time
+import random
+import asyncio
+import email.utils
+
+from utils.telemetry import TELEMETRY
+
+OVERLOAD = "overload"
+ERROR = "error"
+
+
+# =============================
+# Error classification
+# =============================
+def status_code_of(e):
+    code = getattr(e, "status_code", None)
+    if code is None:
+        code = getattr(getattr(e, "response", None), "status_code", None)
+    return code if isinstance(code, int) else None
+
+
+def retry_after_of(e):
+    """Seconds from a Retry-After (or retry-after-ms) header on the error's response, else None."""
+    headers = getattr(getattr(e, "response", None), "headers", None)
+    if not headers:
+        return None
+    try:
+        ms = headers.get("retry-after-ms")
+        if ms is not None:
+            return max(0.0, float(ms) / 1000)
+
+        value = headers.get("retry-after")
+        if value is None:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            # HTTP date form
+            when = email.utils.parsedate_to_datetime(value)
+            return max(0.0, when.timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def classify_error(e):
+    """OVERLOAD for errors that mean "send less" (429, 5xx, timeouts, connection drops), else ERROR."""
+    code = status_code_of(e)
+    if code is not None:
+        return OVERLOAD if code == 429 or code >= 500 else ERROR
+    if isinstance(e, (asyncio.TimeoutError, TimeoutError, ConnectionError)):
+        return OVERLOAD
+    # openai / httpx exceptions, without importing either
+    name = type(e).__name__
+    if "Timeout" in name or "Connection" in name or "RateLimit" in name:
+        return OVERLOAD
+    return ERROR
+
+
+# =============================
+# Limiter
+# =============================
+class AdaptiveLimiter:
+    def __init__(self, initial=8, min_limit=1, max_limit=256, backoff=0.5,
+                 latency_tolerance=3.0, fast_sample=0.05, name="llm"):
+        self.name = name
+        self.limit = float(max(min_limit, min(initial, max_limit)))
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff = backoff
+        # A request slower than latency_tolerance x the baseline latency counts as congestion
+        self.latency_tolerance = latency_tolerance
+        # Faster answers (cache hits) say nothing about the endpoint and are not used for latency
+        self.fast_sample = fast_sample
+
+        self.in_flight = 0
+        self._slow_start = True
+        self._last_decrease = 0.0
+        self._pause_until = 0.0
+        self._latency = None     # EWMA of request latency
+        self._baseline = None    # lowest EWMA seen, slowly relaxed upwards
+        self._cond = asyncio.Condition()
+
+        self.stats_counters = {"ok": 0, "overload": 0, "error": 0, "retries": 0, "decreases": 0}
+        self.peak_limit = self.limit
+
+    # ---------- admission ----------
+    async def acquire(self):
+        async with self._cond:
+            while True:
+                wait = self._pause_until - time.monotonic()
+                if wait <= 0 and self.in_flight < int(self.limit):
+                    break
+                if wait > 0:
+                    try:
+                        await asyncio.wait_for(self._cond.wait(), timeout=wait)
+                    except asyncio.TimeoutError:
+                        pass
+                else:
+                    await self._cond.wait()
+            self.in_flight += 1
+        return time.monotonic()
+
+    async def release(self, started, outcome, retry_after=None):
+        now = time.monotonic()
+        async with self._cond:
+            self.in_flight -= 1
+            if outcome == OVERLOAD:
+                self.stats_counters["overload"] += 1
+                self._decrease(started, now)
+                if retry_after:
+                    self._pause_until = max(self._pause_until, now + retry_after)
+            elif outcome == ERROR:
+                # Application errors (bad request, unparsable answer) say nothing about load
+                self.stats_counters["error"] += 1
+            else:
+                self.stats_counters["ok"] += 1
+                self._on_success(started, now)
+            self._cond.notify_all()
+
+    def _decrease(self, started, now):
+        # Only one cut per round trip: requests sent before the last cut already saw it
+        if started < self._last_decrease:
+            return
+        self.limit = max(self.min_limit, self.limit * self.backoff)
+        self._last_decrease = now
+        self._slow_start = False
+        self.stats_counters["decreases"] += 1
+
+    def _on_success(self, started, now):
+        latency = now - started
+        if latency >= self.fast_sample:
+            self._latency = latency if self._latency is None else 0.9 * self._latency + 0.1 * latency
+            if self._baseline is None or self._latency < self._baseline:
+                self._baseline = self._latency
+            else:
+                # Let the baseline follow a model / endpoint that got slower for good
+                self._baseline *= 1.001
+
+            if self._latency > self.latency_tolerance * self._baseline:
+                self._decrease(started, now)
+                return
+
+        # Grow only while the limit is actually in use
+        if self.in_flight + 1 < int(self.limit):
+            return
+        self.limit = min(self.max_limit, self.limit + (1.0 if self._slow_start else 1.0 / self.limit))
+        self.peak_limit = max(self.peak_limit, self.limit)
+
+    # ---------- calls with retries ----------
+    async def call(self, func, attempts=3, overload_attempts=8, min_wait=2.0, max_wait=10.0, label=None, model=None):
+        """
+        await func() inside a slot. Overload errors are retried up to
+        overload_attempts times, after Retry-After or a jittered exponential
+        wait; any other exception is retried up to `attempts` times. The last
+        exception is raised when the budget runs out.
+
+        The call is recorded in TELEMETRY under (limiter name, model, label).
+        """
+        rec, token = TELEMETRY.start(self.name, model, label)
+        failures = overloads = 0
+        try:
+            while True:
+                queued = time.monotonic()
+                started = await self.acquire()
+                rec.queue_wait += started - queued
+                try:
+                    result = await func()
+                except asyncio.CancelledError:
+                    await self.release(started, ERROR)
+                    raise
+                except Exception as e:
+                    rec.latency = time.monotonic() - started
+                    outcome = classify_error(e)
+                    retry_after = retry_after_of(e) if outcome == OVERLOAD else None
+                    await self.release(started, outcome, retry_after)
+
+                    if outcome == OVERLOAD:
+                        overloads += 1
+                        if overloads >= overload_attempts:
+                            rec.error = type(e).__name__
+                            raise
+                        wait = retry_after if retry_after is not None else min(max_wait, min_wait * 2 ** (overloads - 1))
+                    else:
+                        failures += 1
+                        if failures >= attempts:
+                            rec.error = type(e).__name__
+                            raise
+                        wait = min(max_wait, min_wait * 2 ** (failures - 1))
+
+                    self.stats_counters["retries"] += 1
+                    rec.retries += 1
+                    # Jitter so the retries of one burst do not come back as another burst
+                    await asyncio.sleep(wait * random.uniform(0.5, 1.0))
+                    continue
+
+                rec.latency = time.monotonic() - started
+                if rec.prompt_tokens is None:
+                    rec.observe_usage(result)
+                await self.release(started, None)
+                return result
+        finally:
+            TELEMETRY.finish(rec, token)
+
+    def stats(self):
+        return dict(self.stats_counters, limit=round(self.limit, 1), peak_limit=round(self.peak_limit, 1),
+                    latency=None if self._latency is None else round(self._latency, 3))
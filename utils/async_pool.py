@@ -0,0 +1,42 @@
+"""
+Bounded-concurrency scheduling for the asynchronous LLM scripts
+"""
+import asyncio
+import inspect
+
+
+# =============================
+# Worker pool: keep N calls in flight
+# =============================
+async def bounded_map(func, items, concurrency, on_result=None):
+    """
+    Run `func(item)` for every item with at most `concurrency` calls in flight.
+
+    A fixed pool of workers pulls from one shared iterator, so only
+    `concurrency` coroutines exist at any time no matter how large `items` is.
+    `on_result(index, result)` (plain or async) is called as soon as each call
+    finishes; the returned list is always in input order.
+    """
+    iterator = iter(enumerate(items))
+    results = {}
+
+    async def worker():
+        # next() on the shared iterator is synchronous, so workers never get the same item
+        for idx, item in iterator:
+            result = await func(item)
+            results[idx] = result
+
+            if on_result is not None:
+                ret = on_result(idx, result)
+                if inspect.isawaitable(ret):
+                    await ret
+
+    workers = [asyncio.create_task(worker()) for _ in range(max(1, int(concurrency)))]
+    try:
+        await asyncio.gather(*workers)
+    except BaseException:
+        for w in workers:
+            w.cancel()
+        raise
+
+    return [results[i] for i in sorted(results)]
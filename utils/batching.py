@@ -0,0 +1,124 @@
+"""
+Length-aware batch scheduling for local (padded) batch inference, and
+sequence packing / length-grouped batches for training
+"""
+
+
+def fixed_batches(n, batch_size):
+    """The old behaviour: consecutive slices of `batch_size` in file order."""
+    return [list(range(i, min(i + batch_size, n))) for i in range(0, n, batch_size)]
+
+
+def token_budget_batches(lengths, max_batch_tokens, max_batch_size=None):
+    """
+    Group request indices into batches of similar length.
+
+    Requests are sorted longest first and packed greedily while
+    len(batch) * longest_in_batch stays within `max_batch_tokens` (the padded
+    size the engine actually allocates). Long prompts therefore get small
+    batches and short prompts large ones; a prompt longer than the budget
+    gets a batch of its own. Longest-first also means an out-of-memory
+    batch shows up at the start of a run, not hours in.
+    """
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=True)
+
+    batches = []
+    current, current_max = [], 0
+    for i in order:
+        new_max = max(current_max, lengths[i])
+        too_many = max_batch_size is not None and len(current) >= max_batch_size
+        if current and (too_many or (len(current) + 1) * new_max > max_batch_tokens):
+            batches.append(current)
+            current, new_max = [], lengths[i]
+        current.append(i)
+        current_max = new_max
+
+    if current:
+        batches.append(current)
+    return batches
+
+
+def padding_waste(lengths, batches):
+    """Share of the padded batch tokens that are padding (0 = no waste)."""
+    padded = sum(len(b) * max(lengths[i] for i in b) for b in batches if b)
+    real = sum(lengths[i] for b in batches for i in b)
+    return 1 - real / padded if padded else 0.0
+
+
+# =============================
+# Training: sequence packing and length-grouped batches
+# =============================
+def pack_sequences(lengths, max_tokens):
+    """
+    Best-fit-decreasing bin packing of sequence indices into packs of at most
+    `max_tokens` tokens (longer sequences get a pack of their own).
+
+    Every sequence goes into the fullest pack it still fits in. Packs are
+    bucketed by free space with a segment tree over 0..max_tokens, so
+    placing a sequence costs O(log max_tokens) however many packs exist.
+    """
+    size = 1
+    while size < max_tokens + 1:
+        size *= 2
+    tree = [0] * (2 * size)  # number of packs with exactly `free` tokens left, summed per node
+    by_free = [[] for _ in range(max_tokens + 1)]
+
+    def update(free, delta):
+        node = free + size
+        while node:
+            tree[node] += delta
+            node //= 2
+
+    def smallest_free_at_least(need, node=1, lo=0, hi=None):
+        # Leftmost non-empty bucket in [need, max_tokens]
+        hi = size - 1 if hi is None else hi
+        if hi < need or tree[node] == 0:
+            return None
+        if lo == hi:
+            return lo
+        mid = (lo + hi) // 2
+        found = smallest_free_at_least(need, 2 * node, lo, mid)
+        return found if found is not None else smallest_free_at_least(need, 2 * node + 1, mid + 1, hi)
+
+    packs = []
+    for i in sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=True):
+        n = lengths[i]
+        free = smallest_free_at_least(n) if n <= max_tokens else None
+        if free is None:
+            packs.append([i])
+            pack_id, left = len(packs) - 1, max_tokens - n
+        else:
+            pack_id = by_free[free].pop()
+            update(free, -1)
+            packs[pack_id].append(i)
+            left = free - n
+        if left > 0:
+            by_free[left].append(pack_id)
+            update(left, 1)
+    return packs
+
+
+def length_grouped_batches(lengths, batch_size, mega_batch_mult=50, seed=0):
+    """
+    Shuffled batches of similar-length indices (for padded training batches).
+
+    Indices are shuffled, cut into mega-batches of batch_size * mega_batch_mult,
+    sorted by length inside each mega-batch and cut into batches, so batches
+    stay random across the epoch while padding stays small. The batch holding
+    the longest sequence comes first, so an out-of-memory shows up at step one.
+    """
+    import random
+
+    order = list(range(len(lengths)))
+    random.Random(seed).shuffle(order)
+
+    mega = batch_size * mega_batch_mult
+    batches = []
+    for start in range(0, len(order), mega):
+        group = sorted(order[start:start + mega], key=lambda i: lengths[i], reverse=True)
+        batches += [group[j:j + batch_size] for j in range(0, len(group), batch_size)]
+
+    if batches:
+        longest = max(range(len(batches)), key=lambda b: lengths[batches[b][0]])
+        batches[0], batches[longest] = batches[longest], batches[0]
+    return batches
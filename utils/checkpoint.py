@@ -0,0 +1,138 @@
+"""
+Append-only JSONL checkpoints + compaction into the pretty JSON result files
+"""
+import os
+import json
+import time
+
+
+def jsonl_path_for(json_path):
+    # results/foo.json -> results/foo.jsonl
+    return os.path.splitext(json_path)[0] + ".jsonl"
+
+
+def _ends_without_newline(path):
+    if os.path.getsize(path) == 0:
+        return False
+    with open(path, "rb") as f:
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) != b"\n"
+
+
+# =============================
+# Append-only sink
+# =============================
+class JsonlSink:
+    """
+    Append one JSON object per line; the cost of a write never depends on how
+    many records came before it.
+
+    Every line is flushed to the OS immediately, and fsync'ed to disk after
+    `fsync_every` records or `fsync_interval` seconds, whichever comes first.
+    mode="w" starts a fresh file, mode="a" continues an existing one.
+    """
+
+    def __init__(self, path, mode="w", fsync_every=100, fsync_interval=5.0):
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+
+        self.path = path
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self._f = open(path, mode, encoding="utf-8")
+        if mode == "a" and _ends_without_newline(path):
+            # A crash may have left half a line; never glue the next record onto it
+            self._f.write("\n")
+        self._pending = 0
+        self._last_sync = time.monotonic()
+
+    def write(self, obj):
+        self._f.write(json.dumps(obj, ensure_ascii=False) + "\n")
+        self._f.flush()
+        self._pending += 1
+
+        if self._pending >= self.fsync_every or time.monotonic() - self._last_sync >= self.fsync_interval:
+            self.sync()
+
+    def sync(self):
+        if self._f.closed:
+            return
+        self._f.flush()
+        os.fsync(self._f.fileno())
+        self._pending = 0
+        self._last_sync = time.monotonic()
+
+    def close(self):
+        if not self._f.closed:
+            self.sync()
+            self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# =============================
+# Reading + compaction
+# =============================
+def iter_jsonl(path):
+    """Yield the objects of a JSONL file, skipping a torn last line left by a crash."""
+    if not os.path.exists(path):
+        return
+
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                print(f"Skipping unreadable line in {path}")
+
+
+def load_latest(jsonl_path, key):
+    """{key: last record written for that key} from an existing JSONL checkpoint."""
+    latest = {}
+    for obj in iter_jsonl(jsonl_path):
+        latest[key(obj)] = obj
+    return latest
+
+
+def compact_jsonl(jsonl_path, json_path, key=None, order=None, exclude=None):
+    """
+    Turn a JSONL checkpoint into the usual indented JSON list.
+
+    If `key` is given, the last line written for each key wins; `order` (an
+    iterable of keys) puts the records back into input order, and records
+    with unknown keys are appended afterwards. The JSON file is replaced
+    atomically, so a crash during compaction never leaves it half-written.
+    Keys in `exclude` are dropped, e.g. failures that succeeded on a resumed run.
+    """
+    if key is None:
+        records = list(iter_jsonl(jsonl_path))
+    else:
+        latest = load_latest(jsonl_path, key)
+        for k in exclude or ():
+            latest.pop(k, None)
+
+        records = []
+        if order is not None:
+            for k in order:
+                if k in latest:
+                    records.append(latest.pop(k))
+        records.extend(latest.values())
+
+    folder = os.path.dirname(json_path)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+
+    tmp_path = json_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(records, f, indent=4, ensure_ascii=False)
+    os.replace(tmp_path, json_path)
+
+    return records
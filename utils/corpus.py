@@ -0,0 +1,219 @@
+"""
+Indexed, memory-mapped narrative corpus
+
+The raw NTSB files (contrast_sample.json, sample.json, ...) are converted once
+into a compact store next to the other caches:
+
+    records.jsonl  one compact JSON object per line, in the original order
+    index.bin      open-addressing hash table (linear probing) of fixed-size slots
+                   hash64 | offset | length, for the keys ev_id and (ev_id, Aircraft_Key)
+
+Both files are mmap'ed, so a lookup hashes the key, probes a few slots and
+decodes one line; the corpus itself is never loaded. The store is rebuilt
+when the source file changes (size / mtime).
+
+    corpus = open_corpus("./evaluation/contrast_eva/contrast_sample.json")
+    raw = corpus.get(ev_id, aircraft_key)
+"""
+import os
+import json
+import mmap
+import shutil
+import struct
+import hashlib
+import argparse
+from array import array
+
+from utils.json_stream import iter_records
+
+CORPUS_CACHE_ROOT = "./cache/corpus"
+
+_MAGIC = b"CORPIDX1"
+_HEADER = struct.Struct("<8sQQ")   # magic, slot count, record count
+_SLOT = struct.Struct("<QQI4x")    # key hash, record offset, record length
+_EMPTY = 0xFFFFFFFFFFFFFFFF        # offset of an unused slot
+
+
+def _key_hash(ev_id, aircraft_key=None):
+    # ev_id alone and (ev_id, Aircraft_Key) live in the same table under different prefixes
+    text = f"e\x00{ev_id}" if aircraft_key is None else f"k\x00{ev_id}\x00{aircraft_key}"
+    return int.from_bytes(hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+def _record_keys(item):
+    return str(item.get("ev_id")), str(item.get("Aircraft_Key"))
+
+
+def _fingerprint(source_path):
+    st = os.stat(source_path)
+    return {"source": os.path.abspath(source_path), "size": st.st_size, "mtime": st.st_mtime}
+
+
+def corpus_dir(source_path, cache_root=CORPUS_CACHE_ROOT):
+    digest = hashlib.sha256(os.path.abspath(source_path).encode("utf-8")).hexdigest()[:16]
+    base = os.path.splitext(os.path.basename(source_path))[0]
+    return os.path.join(cache_root, f"{base}-{digest}")
+
+
+# =============================
+# Build
+# =============================
+def build_corpus(source_path, out_dir):
+    """Stream source_path (JSON list or JSONL) into records.jsonl + index.bin in out_dir."""
+    tmp_dir = out_dir + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    hashes, offsets, lengths = array("Q"), array("Q"), array("I")
+    count = 0
+
+    with open(os.path.join(tmp_dir, "records.jsonl"), "wb") as f:
+        offset = 0
+        for item in iter_records(source_path):
+            line = json.dumps(item, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+            ev_id, ac_key = _record_keys(item)
+            for h in (_key_hash(ev_id), _key_hash(ev_id, ac_key)):
+                hashes.append(h)
+                offsets.append(offset)
+                lengths.append(len(line))
+
+            f.write(line + b"\n")
+            offset += len(line) + 1
+            count += 1
+
+    # Load factor <= 0.5 keeps probe sequences short
+    n_slots = 1
+    while n_slots < 2 * len(hashes) or n_slots < 8:
+        n_slots *= 2
+    mask = n_slots - 1
+
+    table = bytearray(_SLOT.pack(0, _EMPTY, 0) * n_slots)
+    for h, off, length in zip(hashes, offsets, lengths):
+        slot = h & mask
+        while True:
+            slot_hash, slot_off, _ = _SLOT.unpack_from(table, slot * _SLOT.size)
+            if slot_off == _EMPTY or slot_hash == h:
+                # A repeated key points at its last record, like the dicts this replaces
+                _SLOT.pack_into(table, slot * _SLOT.size, h, off, length)
+                break
+            slot = (slot + 1) & mask
+
+    with open(os.path.join(tmp_dir, "index.bin"), "wb") as f:
+        f.write(_HEADER.pack(_MAGIC, n_slots, count))
+        f.write(table)
+
+    with open(os.path.join(tmp_dir, "manifest.json"), "w", encoding="utf-8") as f:
+        json.dump(dict(_fingerprint(source_path), records=count), f, indent=4)
+
+    shutil.rmtree(out_dir, ignore_errors=True)
+    os.replace(tmp_dir, out_dir)
+    return count
+
+
+# =============================
+# Read
+# =============================
+class Corpus:
+    """Read-only view of a built corpus directory."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._data_file = open(os.path.join(directory, "records.jsonl"), "rb")
+        self._index_file = open(os.path.join(directory, "index.bin"), "rb")
+
+        # mmap cannot map an empty file
+        size = os.fstat(self._data_file.fileno()).st_size
+        self._data = mmap.mmap(self._data_file.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+        self._index = mmap.mmap(self._index_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self._n_slots, self._count = _HEADER.unpack_from(self._index, 0)
+        if magic != _MAGIC:
+            raise ValueError(f"{directory}: not a corpus index")
+        self._mask = self._n_slots - 1
+
+    def __len__(self):
+        return self._count
+
+    def _find(self, h, matches):
+        slot = h & self._mask
+        while True:
+            slot_hash, off, length = _SLOT.unpack_from(self._index, _HEADER.size + slot * _SLOT.size)
+            if off == _EMPTY:
+                return None
+            if slot_hash == h:
+                item = json.loads(self._data[off:off + length])
+                # 64-bit hashes practically never collide, but never return the wrong record
+                if matches(item):
+                    return item
+            slot = (slot + 1) & self._mask
+
+    def get(self, ev_id, aircraft_key=None, default=None):
+        """The record of (ev_id, Aircraft_Key), or of ev_id alone when aircraft_key is None."""
+        ev_id = str(ev_id)
+        if aircraft_key is None:
+            item = self._find(_key_hash(ev_id), lambda r: _record_keys(r)[0] == ev_id)
+        else:
+            key = (ev_id, str(aircraft_key))
+            item = self._find(_key_hash(*key), lambda r: _record_keys(r) == key)
+        return default if item is None else item
+
+    def __contains__(self, key):
+        if isinstance(key, tuple):
+            return self.get(*key) is not None
+        return self.get(key) is not None
+
+    def __iter__(self):
+        """All records in the original order, decoded one line at a time."""
+        pos, end = 0, len(self._data)
+        while pos < end:
+            nl = self._data.find(b"\n", pos)
+            nl = end if nl == -1 else nl
+            yield json.loads(self._data[pos:nl])
+            pos = nl + 1
+
+    def close(self):
+        if isinstance(self._data, mmap.mmap):
+            self._data.close()
+        self._index.close()
+        self._data_file.close()
+        self._index_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_corpus(source_path, cache_root=CORPUS_CACHE_ROOT):
+    """Corpus for a raw JSON / JSONL file, (re)building the store if it is missing or stale."""
+    directory = corpus_dir(source_path, cache_root)
+    manifest_path = os.path.join(directory, "manifest.json")
+
+    fresh = False
+    if os.path.exists(manifest_path):
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        fresh = all(manifest.get(k) == v for k, v in _fingerprint(source_path).items())
+
+    if not fresh:
+        print(f"Indexing corpus: {source_path}")
+        count = build_corpus(source_path, directory)
+        print(f"Indexed {count} records -> {directory}")
+
+    return Corpus(directory)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build (or refresh) the indexed corpus for raw JSON / JSONL files")
+    parser.add_argument("files", nargs="+")
+    parser.add_argument("--cache_root", default=CORPUS_CACHE_ROOT)
+    args = parser.parse_args()
+
+    for path in args.files:
+        with open_corpus(path, args.cache_root) as corpus:
+            print(f"{path}: {len(corpus)} records in {corpus.directory}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""
+Split a model response into its chain of thought (<think>...</think>) and the final answer
+"""
+
+THINK_OPEN = "<think>"
+THINK_CLOSE = "</think>"
+
+
+def split_think(text):
+    """
+    (chain_of_thought, answer, found_tag) for one response, in a single
+    left-to-right pass with str.find (no backtracking regex).
+
+    - Every <think>...</think> block goes to the chain of thought (joined by a
+      blank line when a model emits several); the text outside them is the answer.
+    - An unclosed <think> (generation hit max_tokens) makes the rest of the text
+      chain of thought, with an empty answer.
+    - A leading </think> without an opening tag (chat templates that put <think>
+      in the prompt) closes a block that started at the beginning of the text.
+    """
+    if not text:
+        return "", text or "", False
+
+    thoughts = []
+    answer_parts = []
+    found = False
+    pos = 0
+
+    first_open = text.find(THINK_OPEN)
+    first_close = text.find(THINK_CLOSE)
+    if first_close != -1 and (first_open == -1 or first_close < first_open):
+        thoughts.append(text[:first_close])
+        pos = first_close + len(THINK_CLOSE)
+        found = True
+
+    while True:
+        start = text.find(THINK_OPEN, pos)
+        if start == -1:
+            answer_parts.append(text[pos:])
+            break
+
+        found = True
+        answer_parts.append(text[pos:start])
+        start += len(THINK_OPEN)
+        end = text.find(THINK_CLOSE, start)
+        if end == -1:
+            thoughts.append(text[start:])
+            break
+
+        thoughts.append(text[start:end])
+        pos = end + len(THINK_CLOSE)
+
+    if not found:
+        return "", text, False
+
+    chain_of_thought = "\n\n".join(t.strip() for t in thoughts if t.strip())
+    answer = "".join(answer_parts).strip()
+    return chain_of_thought, answer, True
+
+
+def split_record(item, warn=True):
+    """A generator output record -> the record process_response.py writes."""
+    raw_output = item.get("model_output", "")
+    chain_of_thought, final_answer, found = split_think(raw_output)
+
+    if raw_output and not found and warn:
+        print(f"Note: ID {item.get('ev_id')} did not contain a <think> tag, skipping separation.")
+
+    return {
+        "ev_id": item.get("ev_id"),
+        "Aircraft_Key": item.get("Aircraft_Key"),
+        "narr_accp": item.get("narr_accp"),
+        "chain_of_thought": chain_of_thought,
+        "answer": final_answer
+    }
@@ -0,0 +1,315 @@
+"""
+Inference backends for the local generators, all behind one interface:
+
+    backend.infer([InferRequest(messages), ...], adapter=None) -> [GenerationResult(text, tokens), ...]
+
+`adapter` = (name, checkpoint path) runs the batch with that LoRA adapter on top of the
+already-loaded base model, so several checkpoints can be evaluated with one model load.
+
+- "pt":       swift PtEngine, static padded batches in plain PyTorch (the original setup)
+- "vllm":     swift VllmEngine, continuous batching + paged KV cache
+- "lmdeploy": swift LmdeployEngine, continuous batching (TurboMind)
+- "openai":   any OpenAI-compatible HTTP server (vLLM / SGLang / swift deploy / Ollama)
+- "mock":     deterministic CPU-only stand-in, no model or GPU needed
+"""
+import time
+import asyncio
+import hashlib
+
+
+class InferRequest:
+    def __init__(self, messages):
+        self.messages = messages
+
+
+class GenerationResult:
+    def __init__(self, text, prompt_tokens=None, completion_tokens=None, latency=None, ttft=None, queue_wait=None):
+        self.text = text
+        self.prompt_tokens = prompt_tokens
+        self.completion_tokens = completion_tokens
+        # Per-request timings (seconds), when the backend measures them; static batches leave them None
+        self.latency = latency
+        self.ttft = ttft
+        self.queue_wait = queue_wait
+
+
+# =============================
+# Base class
+# =============================
+class Backend:
+    name = "base"
+    # True: the engine schedules requests itself, so callers should hand over large chunks
+    # False: every infer() call is one padded batch, so callers should build length-aware batches
+    continuous_batching = False
+
+    def infer(self, requests, adapter=None):
+        raise NotImplementedError
+
+    def count_tokens(self, request):
+        # Fallback estimate when no tokenizer is available: ~4 characters per token
+        return max(1, sum(len(m.get("content", "")) for m in request.messages) // 4)
+
+    def close(self):
+        pass
+
+
+# =============================
+# swift engines (pt / vllm / lmdeploy)
+# =============================
+class SwiftBackend(Backend):
+    """
+    swift.llm engines share the same infer() API; only construction differs.
+    `lora_checkpoint` is applied with Swift.from_pretrained for "pt" and as a
+    LoRA adapter request for "vllm"; LMDeploy needs a merged model.
+    With multi_lora=True the base model is loaded bare and adapters are
+    chosen per infer() call (max_loras adapters resident at once for vLLM).
+    """
+
+    def __init__(self, engine_type, model_path, model_type=None, lora_checkpoint=None,
+                 max_batch_size=4, max_tokens=2048, temperature=0.3, engine_kwargs=None,
+                 multi_lora=False, max_loras=4):
+        from swift.llm import RequestConfig, safe_snapshot_download
+
+        self.name = engine_type
+        self.continuous_batching = engine_type in ("vllm", "lmdeploy")
+        self.request_config = RequestConfig(max_tokens=max_tokens, temperature=temperature)
+        self.adapter_request = None
+        self._adapter_requests = {}
+        engine_kwargs = dict(engine_kwargs or {})
+
+        if multi_lora and engine_type == "lmdeploy":
+            raise ValueError("The lmdeploy backend does not switch LoRA adapters; use pt or vllm")
+
+        if lora_checkpoint:
+            lora_checkpoint = safe_snapshot_download(lora_checkpoint)
+
+        if engine_type == "pt":
+            from swift.llm import PtEngine, get_model_tokenizer, get_template
+            from swift.tuners import Swift
+
+            model, tokenizer = get_model_tokenizer(model_path, model_type=model_type)
+            if lora_checkpoint:
+                model = Swift.from_pretrained(model, lora_checkpoint)
+            # If you have a custom system prompt, you can add it here, otherwise, keep the default
+            template = get_template(model.model_meta.template, tokenizer, default_system=None)
+            self.engine = PtEngine.from_model_template(model, template, max_batch_size=max_batch_size)
+
+        elif engine_type == "vllm":
+            from swift.llm import VllmEngine, AdapterRequest
+
+            if multi_lora:
+                engine_kwargs.setdefault("max_loras", max_loras)
+            self.engine = VllmEngine(
+                model_path, model_type=model_type, enable_lora=bool(lora_checkpoint) or multi_lora,
+                **engine_kwargs
+            )
+            if lora_checkpoint:
+                self.adapter_request = AdapterRequest("lora", lora_checkpoint)
+
+        elif engine_type == "lmdeploy":
+            from swift.llm import LmdeployEngine
+
+            if lora_checkpoint:
+                raise ValueError("The lmdeploy backend needs a merged model; pass the merged weights as model_path")
+            self.engine = LmdeployEngine(model_path, model_type=model_type, **engine_kwargs)
+
+        else:
+            raise ValueError(f"Unknown swift engine type: {engine_type}")
+
+        template = getattr(self.engine, "default_template", None)
+        self.tokenizer = template.tokenizer if template is not None else self.engine.tokenizer
+
+    def count_tokens(self, request):
+        return len(self.tokenizer.apply_chat_template(request.messages, tokenize=True, add_generation_prompt=True))
+
+    def _adapter(self, adapter):
+        # One AdapterRequest per adapter name; the engine loads the weights on first use and keeps them
+        from swift.llm import AdapterRequest, safe_snapshot_download
+
+        name, path = adapter
+        if name not in self._adapter_requests:
+            self._adapter_requests[name] = AdapterRequest(name, safe_snapshot_download(path))
+        return self._adapter_requests[name]
+
+    def infer(self, requests, adapter=None):
+        from swift.llm import InferRequest as SwiftInferRequest
+
+        kwargs = {}
+        if adapter is not None:
+            kwargs["adapter_request"] = self._adapter(adapter)
+        elif self.adapter_request is not None:
+            kwargs["adapter_request"] = self.adapter_request
+
+        responses = self.engine.infer(
+            [SwiftInferRequest(messages=r.messages) for r in requests], self.request_config, **kwargs
+        )
+
+        results = []
+        for resp in responses:
+            usage = getattr(resp, "usage", None)
+            results.append(GenerationResult(
+                resp.choices[0].message.content,
+                prompt_tokens=getattr(usage, "prompt_tokens", None),
+                completion_tokens=getattr(usage, "completion_tokens", None),
+            ))
+        return results
+
+
+# =============================
+# OpenAI-compatible HTTP server
+# =============================
+class OpenAIBackend(Backend):
+    """
+    Sends each request to /v1/chat/completions, `concurrency` at a time; the server does the batching.
+    An adapter is addressed by its name, as served with e.g. `vllm serve ... --lora-modules name=path`.
+    With stream=True the answers are streamed, which also measures the time to first token.
+    """
+
+    name = "openai"
+    continuous_batching = True
+
+    def __init__(self, base_url, model, api_key="EMPTY", concurrency=32, max_tokens=2048, temperature=0.3,
+                 timeout=600, stream=False):
+        self.base_url = base_url
+        self.model = model
+        self.api_key = api_key
+        self.concurrency = concurrency
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.timeout = timeout
+        self.stream = stream
+
+    async def _create(self, client, model, req):
+        if not self.stream:
+            resp = await client.chat.completions.create(
+                model=model, messages=req.messages,
+                max_tokens=self.max_tokens, temperature=self.temperature,
+            )
+            return resp.choices[0].message.content or "", resp.usage, None
+
+        sent = time.perf_counter()
+        ttft, parts, usage = None, [], None
+        stream = await client.chat.completions.create(
+            model=model, messages=req.messages,
+            max_tokens=self.max_tokens, temperature=self.temperature,
+            stream=True, stream_options={"include_usage": True},
+        )
+        async for chunk in stream:
+            # The final chunk carries the usage and no choices
+            usage = chunk.usage or usage
+            if chunk.choices and chunk.choices[0].delta.content:
+                if ttft is None:
+                    ttft = time.perf_counter() - sent
+                parts.append(chunk.choices[0].delta.content)
+        return "".join(parts), usage, ttft
+
+    async def _infer(self, requests, model):
+        from openai import AsyncOpenAI
+
+        client = AsyncOpenAI(base_url=self.base_url, api_key=self.api_key, timeout=self.timeout)
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def one(req):
+            queued = time.perf_counter()
+            async with semaphore:
+                sent = time.perf_counter()
+                text, usage, ttft = await self._create(client, model, req)
+            return GenerationResult(
+                text,
+                prompt_tokens=getattr(usage, "prompt_tokens", None),
+                completion_tokens=getattr(usage, "completion_tokens", None),
+                latency=time.perf_counter() - sent,
+                ttft=ttft,
+                queue_wait=sent - queued,
+            )
+
+        try:
+            return await asyncio.gather(*(one(r) for r in requests))
+        finally:
+            await client.close()
+
+    def infer(self, requests, adapter=None):
+        return asyncio.run(self._infer(requests, adapter[0] if adapter is not None else self.model))
+
+
+# =============================
+# CPU-only stand-in
+# =============================
+class MockBackend(Backend):
+    """Deterministic fake generations for dry runs and tests: no model, no GPU, no network."""
+
+    name = "mock"
+
+    def __init__(self, continuous_batching=False, **kwargs):
+        self.continuous_batching = continuous_batching
+
+    def infer(self, requests, adapter=None):
+        tag = f" ({adapter[0]})" if adapter is not None else ""
+        results = []
+        for req in requests:
+            prompt = "\n".join(m.get("content", "") for m in req.messages)
+            digest = hashlib.sha1(prompt.encode("utf-8")).hexdigest()[:8]
+            text = (
+                f"<think>\n1. Mock reasoning for request {digest}{tag}.\n</think>\n\n"
+                f"Mock cause for request {digest}{tag}."
+            )
+            results.append(GenerationResult(text, self.count_tokens(req), len(text.split())))
+        return results
+
+
+# =============================
+# CUDA OOM handling
+# =============================
+def is_oom_error(e):
+    try:
+        import torch
+        if isinstance(e, torch.cuda.OutOfMemoryError):
+            return True
+    except ImportError:
+        pass
+    return "out of memory" in str(e).lower()
+
+
+def free_accelerator_memory():
+    import gc
+    gc.collect()
+    try:
+        import torch
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+    except ImportError:
+        pass
+
+
+def infer_with_oom_split(backend, requests, adapter=None):
+    """
+    backend.infer(), but a CUDA OOM splits the batch in half and retries each
+    half instead of killing the run. A single request that still does not
+    fit comes back as None, so the caller can log it as failed and move on.
+    """
+    try:
+        return backend.infer(requests, adapter=adapter)
+    except Exception as e:
+        if not is_oom_error(e):
+            raise
+        free_accelerator_memory()
+
+        if len(requests) == 1:
+            print("CUDA OOM on a single request, marking it as failed")
+            return [None]
+
+        mid = len(requests) // 2
+        print(f"CUDA OOM on a batch of {len(requests)}, retrying as {mid} + {len(requests) - mid}")
+        return (infer_with_oom_split(backend, requests[:mid], adapter)
+                + infer_with_oom_split(backend, requests[mid:], adapter))
+
+
+def make_backend(name, **kwargs):
+    """Build a backend by name; kwargs go to the backend's constructor."""
+    if name in ("pt", "vllm", "lmdeploy"):
+        return SwiftBackend(name, **kwargs)
+    if name == "openai":
+        return OpenAIBackend(**kwargs)
+    if name == "mock":
+        return MockBackend(**kwargs)
+    raise ValueError(f"Unknown backend: {name}")
@@ -0,0 +1,118 @@
+"""
+Record-by-record reading and writing of the JSON / JSONL result files
+"""
+import os
+import re
+import json
+import textwrap
+
+READ_CHUNK_CHARS = 1 << 20
+_SEPARATORS = re.compile(r"[\s,]*")
+
+
+def iter_records(path, chunk_chars=READ_CHUNK_CHARS):
+    """
+    Yield the objects of a JSON list or a JSONL file without loading the whole
+    file. JSON lists are decoded element by element with raw_decode over a
+    sliding buffer, so memory stays around one chunk plus one record.
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        stripped = ""
+        while not stripped:
+            buf = f.read(chunk_chars)
+            if not buf:
+                return
+            stripped = buf.lstrip()
+        if stripped[0] != "[":
+            # JSONL (one object per line)
+            f.seek(0)
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    print(f"Skipping unreadable line in {path}")
+            return
+
+        decoder = json.JSONDecoder()
+        buf = stripped[1:]
+        idx = 0
+        eof = False
+        while True:
+            # Skip separators between elements; buf is only sliced when a chunk is appended,
+            # so each record costs its own length rather than a copy of the rest of the chunk
+            idx = _SEPARATORS.match(buf, idx).end()
+
+            if idx < len(buf) and buf[idx] == "]":
+                return
+            if idx < len(buf):
+                try:
+                    obj, end = decoder.raw_decode(buf, idx)
+                except json.JSONDecodeError:
+                    # Most likely the element continues in the next chunk
+                    if eof:
+                        raise
+                else:
+                    # An element ending exactly at the buffer end (e.g. a number) may continue too
+                    if end < len(buf) or eof:
+                        yield obj
+                        idx = end
+                        continue
+            elif eof:
+                raise ValueError(f"{path}: unexpected end of file inside the JSON list")
+
+            more = f.read(chunk_chars)
+            eof = not more
+            buf = buf[idx:] + more
+            idx = 0
+
+
+class JsonArrayWriter:
+    """
+    Write a JSON list one record at a time, formatted exactly like
+    json.dump(records, f, indent=4). The file only replaces `path` on close(),
+    so readers never see a half-written list.
+    """
+
+    def __init__(self, path):
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+
+        self.path = path
+        self.count = 0
+        self._tmp_path = path + ".tmp"
+        self._f = open(self._tmp_path, "w", encoding="utf-8")
+
+    def write(self, obj):
+        self._f.write("[\n" if self.count == 0 else ",\n")
+        self._f.write(textwrap.indent(json.dumps(obj, indent=4, ensure_ascii=False), "    "))
+        self.count += 1
+
+    def close(self):
+        if self._f.closed:
+            return
+        self._f.write("\n]" if self.count else "[]")
+        self._f.close()
+        os.replace(self._tmp_path, self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:
+            self._f.close()
+            os.remove(self._tmp_path)
+
+
+def open_record_writer(path):
+    """JsonArrayWriter for *.json, an append-only JSONL sink for anything else."""
+    if path.endswith(".json"):
+        return JsonArrayWriter(path)
+
+    from utils.checkpoint import JsonlSink
+    return JsonlSink(path)
@@ -0,0 +1,135 @@
+"""
+Helpers for re-assembling the judge prompt templates:
+prefix-cache-friendly layout and batched (all metrics in one JSON call) scoring
+"""
+import re
+import json
+
+
+# Context sections as they appear in the metric templates: "**Title**\n{field}"
+_CONTEXT_RE = re.compile(
+    r"\*\*(Accident Narrative|Chain of Thought|Generated Answer|Official Conclusion|Official Probable Cause)\*\*"
+    r"[ \t]*\n\{(\w+)\}[ \t]*\n"
+)
+# The per-metric "output only a number" instruction
+_OUTPUT_RE = re.compile(r"^[ \t]*(Please )?output only a number[^\n]*$", re.IGNORECASE | re.MULTILINE)
+
+CONTEXT_TITLES = {
+    "narrative": "Accident Narrative",
+    "cot": "Chain of Thought",
+    "answer": "Generated Answer",
+    "cause": "Official Conclusion",
+}
+CONTEXT_ORDER = ["narrative", "cot", "answer", "cause"]
+
+
+def template_fields(template):
+    """Context fields a metric template uses, e.g. {"narrative", "cot"}."""
+    return set(re.findall(r"\{(\w+)\}", template))
+
+
+def rubric_of(template):
+    """The metric-specific part of a template: instructions + scoring criteria, without the context blocks."""
+    text = _CONTEXT_RE.sub("", template)
+    text = _OUTPUT_RE.sub("", text)
+    return re.sub(r"\n{3,}", "\n\n", text).strip()
+
+
+def context_block(values, fields):
+    """Render the context sections for `fields` in a fixed order."""
+    parts = []
+    for field in CONTEXT_ORDER:
+        if field in fields:
+            parts.append(f"**{CONTEXT_TITLES[field]}**\n{values.get(field, '')}")
+    return "\n\n".join(parts)
+
+
+def all_fields(templates):
+    fields = set()
+    for t in templates.values():
+        fields |= template_fields(t)
+    return fields
+
+
+def _metric_section(metric, template):
+    uses = ", ".join(CONTEXT_TITLES[f] for f in CONTEXT_ORDER if f in template_fields(template))
+    return f"### Metric: {metric}\n(Use only: {uses})\n\n{rubric_of(template)}"
+
+
+# =============================
+# Prefix layout: stable per-record block first, metric rubric last
+# =============================
+def shared_prefix(values, fields):
+    """
+    The leading block every judge prompt of one record starts with. It is
+    byte-identical across metrics (same header, same fields, same order), so
+    a backend with automatic prefix caching prefills the narrative/CoT once
+    per record instead of once per metric.
+    """
+    return (
+        "You are an aviation accident investigation and safety expert. "
+        "The material below is evaluated on the metric(s) described after it.\n\n"
+        f"{context_block(values, fields)}\n\n"
+        "For each metric, only consider the material listed under \"Use only\" "
+        "and follow its own instructions and scoring criteria.\n\n"
+    )
+
+
+def build_prefixed_prompt(metric, template, values, fields):
+    """One metric's prompt in prefix layout; `fields` is the fixed field set of the whole evaluator."""
+    return (
+        shared_prefix(values, fields)
+        + _metric_section(metric, template)
+        + "\n\nPlease output only a number from 1 to 5. Do not output explanations or any other content."
+    )
+
+
+# =============================
+# Batched rubric: all metrics in one call
+# =============================
+def build_batched_prompt(templates, values, fields=None):
+    """
+    One prompt that carries the shared context once and asks for every
+    metric in `templates` ({metric: per-metric template}) as a JSON object.
+    It starts with the same shared_prefix() as the prefix layout.
+    """
+    if fields is None:
+        fields = all_fields(templates)
+
+    sections = [_metric_section(metric, t) for metric, t in templates.items()]
+    example = ", ".join(f'"{m}": <1-5>' for m in templates)
+
+    return (
+        shared_prefix(values, fields)
+        + "\n\n".join(sections)
+        + "\n\n"
+        "Output only one JSON object that maps every metric name to an integer score from 1 to 5, "
+        f"for example {{{example}}}. Do not output explanations or any other content."
+    )
+
+
+def parse_batched_scores(txt, metrics):
+    """
+    {metric: int 1-5 or None} from a batched judge answer. Fields that are
+    missing or not on the 1-5 scale come back as None so the caller can
+    fall back to per-metric calls for just those fields.
+    """
+    parsed = {}
+    start, end = txt.find("{"), txt.rfind("}")
+    if start != -1 and end > start:
+        try:
+            parsed = json.loads(txt[start:end + 1])
+        except json.JSONDecodeError:
+            parsed = {}
+    if not isinstance(parsed, dict):
+        parsed = {}
+
+    scores = {}
+    for m in metrics:
+        v = parsed.get(m)
+        if isinstance(v, str) and v.strip().isdigit():
+            v = int(v.strip())
+        if isinstance(v, float) and v.is_integer():
+            v = int(v)
+        scores[m] = v if isinstance(v, int) and not isinstance(v, bool) and 1 <= v <= 5 else None
+    return scores
@@ -0,0 +1,194 @@
+"""
+Shared LLM client: one wrapper around ChatOpenAI for the generator and the judges,
+with a persistent content-addressed response cache (SQLite)
+"""
+import os
+import json
+import time
+import asyncio
+import hashlib
+import sqlite3
+import threading
+
+from utils.telemetry import current_call
+
+
+# =============================
+# Cache key: hash of (model, temperature, prompt)
+# =============================
+def _prompt_payload(prompt):
+    # Plain strings, lists of messages and prompt values all hash the same way
+    if hasattr(prompt, "to_messages"):
+        prompt = prompt.to_messages()
+    if isinstance(prompt, str):
+        return prompt
+    return [
+        (getattr(m, "type", None), getattr(m, "content", m)) if not isinstance(m, (tuple, list, dict)) else m
+        for m in prompt
+    ]
+
+
+def cache_key(model, temperature, prompt):
+    payload = json.dumps(
+        {"model": model, "temperature": temperature, "prompt": _prompt_payload(prompt)},
+        ensure_ascii=False, sort_keys=True, default=str,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+# =============================
+# On-disk response cache with size-based LRU eviction
+# =============================
+class ResponseCache:
+    """
+    SQLite table of {key -> response text}. Every read refreshes the entry's
+    last-used time; when the stored text grows past `max_bytes`, the least
+    recently used entries are deleted until it is back under 90% of the limit.
+    """
+
+    def __init__(self, path, max_bytes=2 * 1024 ** 3):
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " key TEXT PRIMARY KEY, model TEXT, content TEXT,"
+            " size INTEGER, created REAL, last_used REAL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS idx_last_used ON responses(last_used)")
+        self._size = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def get(self, key):
+        with self._lock:
+            row = self._db.execute("SELECT content FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self._db.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+            self.hits += 1
+            return row[0]
+
+    def put(self, key, model, content):
+        size = len(content.encode("utf-8"))
+        now = time.time()
+        with self._lock:
+            old = self._db.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses (key, model, content, size, created, last_used)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (key, model, content, size, now, now),
+            )
+            self._size += size - (old[0] if old else 0)
+            if self._size > self.max_bytes:
+                self._evict(int(self.max_bytes * 0.9))
+
+    def _evict(self, target):
+        # Drop least recently used entries, oldest first, until under `target` bytes
+        victims = []
+        freed = 0
+        for key, size in self._db.execute("SELECT key, size FROM responses ORDER BY last_used"):
+            if self._size - freed <= target:
+                break
+            victims.append((key,))
+            freed += size
+        self._db.executemany("DELETE FROM responses WHERE key = ?", victims)
+        self._size -= freed
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            "bytes": self._size,
+        }
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+# =============================
+# LLM client wrapper
+# =============================
+class LLMClient:
+    """
+    Drop-in replacement for `llm.ainvoke(prompt)` that serves repeated
+    (model, temperature, prompt) calls from the response cache.
+
+    `cache_if(text)` decides whether a fresh response is worth storing, e.g. a
+    judge only keeps outputs that parsed as a valid score, so a retry after a
+    malformed answer really goes back to the model.
+    """
+
+    def __init__(self, llm, cache=None):
+        self.llm = llm
+        self.cache = cache
+        self.model_name = getattr(llm, "model_name", None) or getattr(llm, "model", "")
+        self.temperature = getattr(llm, "temperature", None)
+
+    async def ainvoke(self, prompt, cache_if=None, **kwargs):
+        # Instrumented call (utils/telemetry.py) this request belongs to, if any
+        rec = current_call()
+        if rec is not None and rec.model is None:
+            rec.model = self.model_name
+
+        if self.cache is None:
+            resp = await self.llm.ainvoke(prompt, **kwargs)
+            if rec is not None:
+                rec.observe_usage(resp)
+            return resp
+
+        from langchain_core.messages import AIMessage
+
+        key = cache_key(self.model_name, self.temperature, prompt)
+        cached = await asyncio.to_thread(self.cache.get, key)
+        if cached is not None:
+            if rec is not None:
+                rec.cache_hit = True
+            return AIMessage(content=cached)
+
+        resp = await self.llm.ainvoke(prompt, **kwargs)
+        if rec is not None:
+            rec.observe_usage(resp)
+
+        content = getattr(resp, "content", None)
+        if isinstance(content, str) and content.strip() and (cache_if is None or cache_if(content)):
+            await asyncio.to_thread(self.cache.put, key, self.model_name, content)
+
+        return resp
+
+    def cache_stats(self):
+        return self.cache.stats() if self.cache is not None else None
+
+
+def make_llm(model, base_url, api_key, temperature=0.3, timeout=120, cache_path=None,
+             cache_max_bytes=2 * 1024 ** 3, max_retries=0, **kwargs):
+    """
+    Build a ChatOpenAI client wrapped in LLMClient; cache_path=None disables caching.
+    max_retries=0: 429s and timeouts reach the caller's AdaptiveLimiter instead of
+    being retried blindly inside the client.
+    """
+    from langchain_openai import ChatOpenAI
+
+    llm = ChatOpenAI(
+        model=model,
+        base_url=base_url,
+        api_key=api_key,
+        temperature=temperature,
+        timeout=timeout,
+        max_retries=max_retries,
+        **kwargs,
+    )
+    cache = ResponseCache(cache_path, max_bytes=cache_max_bytes) if cache_path else None
+    return LLMClient(llm, cache)
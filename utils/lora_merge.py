@@ -0,0 +1,95 @@
+"""
+Merge-and-cache for LoRA checkpoints: merge the adapter into the base weights once
+(safetensors), then reuse the merged model on every later run
+
+    python -m utils.lora_merge --adapters <checkpoint> [--model <base>]   # prints the merged model dir
+"""
+import os
+import sys
+import json
+import shutil
+import hashlib
+import argparse
+import subprocess
+
+MERGED_CACHE_ROOT = "./cache/merged_models"
+
+
+def _fingerprint(lora_checkpoint):
+    # Size + mtime of the adapter files: a re-trained checkpoint at the same path is merged again
+    files = {}
+    for name in sorted(os.listdir(lora_checkpoint)):
+        if name.startswith("adapter_") or name in ("args.json", "configuration.json"):
+            st = os.stat(os.path.join(lora_checkpoint, name))
+            files[name] = [st.st_size, int(st.st_mtime)]
+    return files
+
+
+def merged_model_dir(base_model, lora_checkpoint, cache_root=MERGED_CACHE_ROOT):
+    """Cache location for one (base model path, checkpoint path) pair."""
+    base = os.path.abspath(base_model) if base_model else ""
+    ckpt = os.path.abspath(lora_checkpoint)
+    key = hashlib.sha256(f"{base}\0{ckpt}".encode("utf-8")).hexdigest()[:16]
+    return os.path.join(cache_root, f"{os.path.basename(ckpt.rstrip(os.sep))}-{key}")
+
+
+def get_merged_model(base_model, lora_checkpoint, model_type=None, cache_root=MERGED_CACHE_ROOT):
+    """
+    Path of the merged model for (base_model, lora_checkpoint), merging with
+    `swift export --merge_lora true` on the first call only.
+
+    The merge is written to a temporary directory and renamed into place with
+    a manifest, so an interrupted merge is never mistaken for a finished one.
+    base_model may be None: swift then takes the base model from the
+    checkpoint's args.json.
+    """
+    target = merged_model_dir(base_model, lora_checkpoint, cache_root)
+    manifest_path = os.path.join(target, "merge_manifest.json")
+    manifest = {
+        "base_model": os.path.abspath(base_model) if base_model else None,
+        "lora_checkpoint": os.path.abspath(lora_checkpoint),
+        "adapter_files": _fingerprint(lora_checkpoint),
+    }
+
+    if os.path.exists(manifest_path):
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            if json.load(f) == manifest:
+                print(f"Using cached merged model: {target}", file=sys.stderr)
+                return target
+        print(f"Checkpoint changed since the last merge, merging again: {lora_checkpoint}", file=sys.stderr)
+
+    tmp_dir = f"{target}.tmp-{os.getpid()}"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(os.path.dirname(tmp_dir) or ".", exist_ok=True)
+
+    cmd = ["swift", "export", "--adapters", lora_checkpoint, "--merge_lora", "true",
+           "--safe_serialization", "true", "--output_dir", tmp_dir]
+    if base_model:
+        cmd += ["--model", base_model]
+    if model_type:
+        cmd += ["--model_type", model_type]
+
+    # Progress and swift's own output go to stderr: stdout of the CLI carries only the merged path
+    print(f"Merging LoRA into the base model (one-off): {' '.join(cmd)}", file=sys.stderr)
+    subprocess.run(cmd, check=True, stdout=sys.stderr)
+
+    with open(os.path.join(tmp_dir, "merge_manifest.json"), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=4, ensure_ascii=False)
+
+    shutil.rmtree(target, ignore_errors=True)
+    os.rename(tmp_dir, target)
+    print(f"Merged model cached at: {target}", file=sys.stderr)
+    return target
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Merge a LoRA checkpoint once and print the cached model dir")
+    parser.add_argument("--adapters", required=True, help="LoRA checkpoint directory")
+    parser.add_argument("--model", default=None, help="Base model (default: taken from the checkpoint's args.json)")
+    parser.add_argument("--model_type", default=None)
+    parser.add_argument("--cache_root", default=MERGED_CACHE_ROOT)
+    args = parser.parse_args()
+
+    path = get_merged_model(args.model, args.adapters, model_type=args.model_type, cache_root=args.cache_root)
+    # The only line on stdout, for shell scripts: MERGED=$(python -m utils.lora_merge ...)
+    print(path)
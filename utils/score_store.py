@@ -0,0 +1,217 @@
+"""
+Parquet store for judge scores and generations (optional, needs pyarrow)
+
+Scores are stored long: one row per (ev_id, Aircraft_Key, model, metric) with
+the score and the record's error. The store is a directory partitioned by
+model (<root>/model=<name>/part-0.parquet), and every row group inside a file
+holds a single metric, so reading with a model / metric filter only opens the
+matching partitions and skips the other row groups from their statistics.
+
+    write_scores(results, "./score_store", model="Qwen3-8B")
+    table = read_scores("./score_store", models=["Qwen3-8B", "Llama-3.1-8B"], metrics=["support"])
+
+Generations go to their own store with one row per record.
+"""
+import os
+import re
+import shutil
+import argparse
+
+ROW_GROUP_ROWS = 64 * 1024
+
+GENERATION_TEXT_FIELDS = ["narr_accp", "model_output", "chain_of_thought", "answer"]
+
+
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.dataset
+        import pyarrow.parquet
+    except ImportError as e:
+        raise ImportError("The Parquet score store needs pyarrow: pip install pyarrow") from e
+    return pyarrow
+
+
+def score_schema():
+    pa = _pyarrow()
+    return pa.schema([
+        ("ev_id", pa.string()),
+        ("Aircraft_Key", pa.string()),
+        ("metric", pa.string()),
+        ("score", pa.float64()),
+        ("error", pa.string()),
+    ])
+
+
+def generation_schema():
+    pa = _pyarrow()
+    return pa.schema([("ev_id", pa.string()), ("Aircraft_Key", pa.string())]
+                     + [(name, pa.string()) for name in GENERATION_TEXT_FIELDS])
+
+
+def _str_or_none(v):
+    return None if v is None else str(v)
+
+
+def partition_name(model):
+    # The model name is a directory name; keep it readable but path-safe
+    return re.sub(r"[^\w.\-]+", "_", model)
+
+
+def _partition_dir(root, model):
+    return os.path.join(root, "model=" + partition_name(model))
+
+
+class _PartitionWriter:
+    """Writes one model partition to a temporary file and swaps it in on close()."""
+
+    def __init__(self, root, model, schema):
+        pa = _pyarrow()
+        self.schema = schema
+        self.final_dir = _partition_dir(root, model)
+        # "_" prefix: dataset discovery ignores the partition while it is being written
+        self.tmp_dir = os.path.join(root, "_tmp-" + partition_name(model))
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+        os.makedirs(self.tmp_dir)
+        self._writer = pa.parquet.ParquetWriter(os.path.join(self.tmp_dir, "part-0.parquet"), schema)
+        self.rows = 0
+
+    def write_rows(self, rows):
+        if not rows:
+            return
+        pa = _pyarrow()
+        columns = {name: [r[name] for r in rows] for name in self.schema.names}
+        self._writer.write_table(pa.table(columns, schema=self.schema), row_group_size=ROW_GROUP_ROWS)
+        self.rows += len(rows)
+
+    def close(self):
+        self._writer.close()
+        # Replace the model's previous partition (a re-run overwrites, it never appends duplicates)
+        shutil.rmtree(self.final_dir, ignore_errors=True)
+        os.replace(self.tmp_dir, self.final_dir)
+
+
+# =============================
+# Scores
+# =============================
+def write_scores(records, root, model):
+    """
+    Store the {"ev_id", "Aircraft_Key", "scores": {...}} records of one model
+    (replacing what the store had for it). Rows are buffered per metric and
+    written out one metric per row group.
+    """
+    writer = _PartitionWriter(root, model, score_schema())
+    buffers = {}
+
+    for item in records:
+        ev_id, ac_key = _str_or_none(item.get("ev_id")), _str_or_none(item.get("Aircraft_Key"))
+        scores = item.get("scores") or {}
+        error = _str_or_none(scores.get("error") or item.get("error"))
+
+        for metric, score in scores.items():
+            if metric == "error" or not (score is None or isinstance(score, (int, float))):
+                continue
+            buf = buffers.setdefault(metric, [])
+            buf.append({
+                "ev_id": ev_id,
+                "Aircraft_Key": ac_key,
+                "metric": metric,
+                "score": None if score is None else float(score),
+                "error": error,
+            })
+            if len(buf) >= ROW_GROUP_ROWS:
+                writer.write_rows(buf)
+                buffers[metric] = []
+
+    for metric in sorted(buffers):
+        writer.write_rows(buffers[metric])
+    writer.close()
+
+    print(f"Score store: {writer.rows} rows for {model} -> {writer.final_dir}")
+    return writer.rows
+
+
+def _dataset(root):
+    pa = _pyarrow()
+    partitioning = pa.dataset.partitioning(pa.schema([("model", pa.string())]), flavor="hive")
+    return pa.dataset.dataset(root, format="parquet", partitioning=partitioning)
+
+
+def read_scores(root, models=None, metrics=None, columns=None):
+    """
+    pyarrow Table of the stored scores. `models` and `metrics` are pushed down:
+    other model partitions are never opened and row groups of other metrics
+    are skipped.
+    """
+    pa = _pyarrow()
+    field = pa.dataset.field
+
+    condition = None
+    if models is not None:
+        condition = field("model").isin([partition_name(m) for m in models])
+    if metrics is not None:
+        metric_filter = field("metric").isin(list(metrics))
+        condition = metric_filter if condition is None else condition & metric_filter
+
+    return _dataset(root).to_table(columns=columns, filter=condition)
+
+
+def scores_wide(table):
+    """Long score table -> {(model, metric): {(ev_id, Aircraft_Key): score}} for paired comparisons."""
+    out = {}
+    cols = table.to_pydict()
+    for ev_id, ac_key, model, metric, score in zip(
+            cols["ev_id"], cols["Aircraft_Key"], cols["model"], cols["metric"], cols["score"]):
+        out.setdefault((model, metric), {})[(ev_id, ac_key)] = score
+    return out
+
+
+# =============================
+# Generations
+# =============================
+def write_generations(records, root, model):
+    """Store generator output records (raw model_output and / or chain_of_thought + answer) of one model."""
+    writer = _PartitionWriter(root, model, generation_schema())
+    buf = []
+
+    for item in records:
+        row = {"ev_id": _str_or_none(item.get("ev_id")), "Aircraft_Key": _str_or_none(item.get("Aircraft_Key"))}
+        for name in GENERATION_TEXT_FIELDS:
+            row[name] = _str_or_none(item.get(name))
+        buf.append(row)
+        if len(buf) >= ROW_GROUP_ROWS:
+            writer.write_rows(buf)
+            buf = []
+
+    writer.write_rows(buf)
+    writer.close()
+
+    print(f"Generation store: {writer.rows} rows for {model} -> {writer.final_dir}")
+    return writer.rows
+
+
+def read_generations(root, models=None, columns=None):
+    pa = _pyarrow()
+    condition = None if models is None else pa.dataset.field("model").isin([partition_name(m) for m in models])
+    return _dataset(root).to_table(columns=columns, filter=condition)
+
+
+# =============================
+# CLI: import existing JSON / JSONL score files
+# =============================
+def main():
+    from utils.json_stream import iter_records
+
+    parser = argparse.ArgumentParser(description="Import score files (JSON / JSONL) into a Parquet score store")
+    parser.add_argument("files", nargs="+", help="*_scores.json files; the model name is the file name without _scores")
+    parser.add_argument("--root", required=True, help="Score store directory")
+    args = parser.parse_args()
+
+    for path in args.files:
+        model = os.path.splitext(os.path.basename(path))[0]
+        model = model[:-len("_scores")] if model.endswith("_scores") else model
+        write_scores(iter_records(path), args.root, model)
+
+
+if __name__ == "__main__":
+    main()
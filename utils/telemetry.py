@@ -0,0 +1,252 @@
+"""
+Per-call instrumentation for judge / generator calls
+
+Every LLM call becomes one CallRecord (queue wait, latency, time to first
+token, prompt / completion tokens, retries, error, cache hit), grouped by
+(stage, model, label), e.g. ("judge", "DeepSeek-V3.2", "support"). The
+AdaptiveLimiter opens a record around each call and LLMClient fills in the
+model and token usage through a context variable, so the call sites only pass
+a label. Local engines report per batch with record_generation().
+
+At the end of a run:
+
+    TELEMETRY.report(prometheus_path="./cache/metrics/judge.prom")
+
+prints p50/p95/p99 per group with tokens/sec and a cost estimate, and
+optionally writes the same numbers in Prometheus text format (for the
+node_exporter textfile collector or a pushgateway).
+"""
+import os
+import math
+import time
+import contextvars
+from array import array
+
+# USD per 1M tokens: {model: (prompt, completion)}; models not listed are costed at 0
+PRICES_PER_MTOK = {}
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+_current = contextvars.ContextVar("llm_call", default=None)
+
+
+class CallRecord:
+    def __init__(self, stage, model=None, label=None):
+        self.stage = stage
+        self.model = model
+        self.label = label
+        self.started = time.time()
+        self.finished = None
+        self.queue_wait = 0.0
+        self.latency = None
+        self.ttft = None
+        self.prompt_tokens = None
+        self.completion_tokens = None
+        self.retries = 0
+        self.error = None
+        self.cache_hit = False
+
+    def observe_usage(self, resp):
+        """Token usage from a LangChain AIMessage or an OpenAI response, when it reports any."""
+        usage = getattr(resp, "usage_metadata", None)
+        if usage:
+            self.prompt_tokens = usage.get("input_tokens", self.prompt_tokens)
+            self.completion_tokens = usage.get("output_tokens", self.completion_tokens)
+            return
+        usage = (getattr(resp, "response_metadata", None) or {}).get("token_usage") or getattr(resp, "usage", None)
+        if usage:
+            get = usage.get if isinstance(usage, dict) else lambda k, d=None: getattr(usage, k, d)
+            self.prompt_tokens = get("prompt_tokens", self.prompt_tokens)
+            self.completion_tokens = get("completion_tokens", self.completion_tokens)
+
+
+def current_call():
+    """The CallRecord of the call running in this task, or None outside an instrumented call."""
+    return _current.get()
+
+
+class _Series:
+    def __init__(self):
+        self.queue_wait = array("d")
+        self.latency = array("d")
+        self.ttft = array("d")
+        self.calls = 0
+        self.errors = 0
+        self.retries = 0
+        self.cache_hits = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.first_start = None
+        self.last_finish = None
+
+    def add(self, rec):
+        self.calls += 1
+        self.errors += rec.error is not None
+        self.retries += rec.retries
+        self.cache_hits += rec.cache_hit
+        self.queue_wait.append(rec.queue_wait)
+        if rec.latency is not None:
+            self.latency.append(rec.latency)
+        if rec.ttft is not None:
+            self.ttft.append(rec.ttft)
+        self.prompt_tokens += rec.prompt_tokens or 0
+        self.completion_tokens += rec.completion_tokens or 0
+        self.first_start = rec.started if self.first_start is None else min(self.first_start, rec.started)
+        self.last_finish = rec.finished if self.last_finish is None else max(self.last_finish, rec.finished)
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    ordered = sorted(values)
+    # Nearest rank
+    return ordered[max(0, math.ceil(q * len(ordered)) - 1)]
+
+
+class Telemetry:
+    def __init__(self, prices=None):
+        self.prices = PRICES_PER_MTOK if prices is None else prices
+        self._series = {}
+
+    # ---------- recording ----------
+    def start(self, stage, model=None, label=None):
+        rec = CallRecord(stage, model, label)
+        return rec, _current.set(rec)
+
+    def finish(self, rec, token=None):
+        if token is not None:
+            _current.reset(token)
+        rec.finished = time.time()
+        self.record(rec)
+
+    def record(self, rec):
+        if rec.finished is None:
+            rec.finished = time.time()
+        key = (rec.stage, rec.model or "", rec.label or "")
+        self._series.setdefault(key, _Series()).add(rec)
+
+    def reset(self):
+        self._series = {}
+
+    def record_generation(self, stage, model, results, batch_latency, queue_wait=0.0, label=None):
+        """One record per request of a local engine batch; failed requests are None in results."""
+        now = time.time()
+        for res in results:
+            rec = CallRecord(stage, model, label)
+            rec.started, rec.finished = now - batch_latency - queue_wait, now
+            rec.queue_wait = getattr(res, "queue_wait", None) or queue_wait
+            if res is None:
+                rec.error = "failed"
+                rec.latency = batch_latency
+            else:
+                # Continuous-batching backends time each request; static batches finish together
+                rec.latency = getattr(res, "latency", None) or batch_latency
+                rec.ttft = getattr(res, "ttft", None)
+                rec.prompt_tokens = res.prompt_tokens
+                rec.completion_tokens = res.completion_tokens
+            self.record(rec)
+
+    # ---------- reporting ----------
+    def cost(self, model, prompt_tokens, completion_tokens):
+        p_in, p_out = self.prices.get(model, (0.0, 0.0))
+        return (prompt_tokens * p_in + completion_tokens * p_out) / 1e6
+
+    def summary(self):
+        rows = []
+        for (stage, model, label), s in sorted(self._series.items()):
+            wall = max(1e-9, (s.last_finish or 0) - (s.first_start or 0))
+            row = {
+                "stage": stage, "model": model, "label": label,
+                "calls": s.calls, "errors": s.errors, "retries": s.retries, "cache_hits": s.cache_hits,
+                "prompt_tokens": s.prompt_tokens, "completion_tokens": s.completion_tokens,
+                "calls_per_s": round(s.calls / wall, 3),
+                "completion_tokens_per_s": round(s.completion_tokens / wall, 1),
+                "cost_usd": round(self.cost(model, s.prompt_tokens, s.completion_tokens), 4),
+            }
+            for name, values in (("latency", s.latency), ("queue_wait", s.queue_wait), ("ttft", s.ttft)):
+                for q in QUANTILES:
+                    v = percentile(values, q)
+                    row[f"{name}_p{int(q * 100)}"] = None if v is None else round(v, 4)
+            rows.append(row)
+        return rows
+
+    def print_summary(self, rows=None):
+        rows = self.summary() if rows is None else rows
+        if not rows:
+            return
+        print("\n" + "=" * 40 + "\nCall statistics (seconds)")
+        for r in rows:
+            name = "/".join(x for x in (r["stage"], r["model"], r["label"]) if x)
+            print(f"   {name}: {r['calls']} calls, {r['errors']} errors, {r['retries']} retries, "
+                  f"{r['cache_hits']} cache hits")
+            print(f"      latency p50/p95/p99 {r['latency_p50']}/{r['latency_p95']}/{r['latency_p99']}"
+                  f" | queue wait p50/p95/p99 {r['queue_wait_p50']}/{r['queue_wait_p95']}/{r['queue_wait_p99']}"
+                  + (f" | ttft p50/p95 {r['ttft_p50']}/{r['ttft_p95']}" if r["ttft_p50"] is not None else ""))
+            print(f"      tokens {r['prompt_tokens']} in / {r['completion_tokens']} out, "
+                  f"{r['completion_tokens_per_s']} tok/s, {r['calls_per_s']} calls/s, est. ${r['cost_usd']}")
+        print("=" * 40)
+
+    def prometheus_text(self):
+        lines = []
+
+        def labels(stage, model, label, **extra):
+            pairs = dict(stage=stage, model=model, label=label, **extra)
+            return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs.items()) + "}"
+
+        for metric, attr, help_text in (
+            ("llm_request_latency_seconds", "latency", "Request latency of the final attempt"),
+            ("llm_queue_wait_seconds", "queue_wait", "Time spent waiting for a concurrency slot"),
+            ("llm_time_to_first_token_seconds", "ttft", "Time to first streamed token"),
+        ):
+            lines += [f"# HELP {metric} {help_text}", f"# TYPE {metric} summary"]
+            for key, s in sorted(self._series.items()):
+                values = getattr(s, attr)
+                if not values:
+                    continue
+                for q in QUANTILES:
+                    lines.append(f"{metric}{labels(*key, quantile=str(q))} {percentile(values, q)}")
+                lines.append(f"{metric}_sum{labels(*key)} {sum(values)}")
+                lines.append(f"{metric}_count{labels(*key)} {len(values)}")
+
+        for metric, attr, help_text in (
+            ("llm_requests_total", "calls", "Calls"),
+            ("llm_errors_total", "errors", "Calls that failed after all retries"),
+            ("llm_retries_total", "retries", "Retried attempts"),
+            ("llm_cache_hits_total", "cache_hits", "Calls answered from the response cache"),
+            ("llm_prompt_tokens_total", "prompt_tokens", "Prompt tokens"),
+            ("llm_completion_tokens_total", "completion_tokens", "Completion tokens"),
+        ):
+            lines += [f"# HELP {metric} {help_text}", f"# TYPE {metric} counter"]
+            for key, s in sorted(self._series.items()):
+                lines.append(f"{metric}{labels(*key)} {getattr(s, attr)}")
+
+        lines += ["# HELP llm_cost_usd_total Estimated cost from PRICES_PER_MTOK", "# TYPE llm_cost_usd_total counter"]
+        for key, s in sorted(self._series.items()):
+            lines.append(f"llm_cost_usd_total{labels(*key)} {self.cost(key[1], s.prompt_tokens, s.completion_tokens)}")
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path):
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        # Atomic replace: the textfile collector must never read half a file
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(self.prometheus_text())
+        os.replace(tmp_path, path)
+        print(f"Prometheus metrics: {path}")
+
+    def report(self, prometheus_path=None):
+        rows = self.summary()
+        self.print_summary(rows)
+        if prometheus_path:
+            self.write_prometheus(prometheus_path)
+        return rows
+
+
+def _escape(v):
+    return str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+# One registry per process, shared by the limiter, the LLM client and the scripts
+TELEMETRY = Telemetry()
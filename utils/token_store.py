@@ -0,0 +1,219 @@
+"""
+Memory-mapped store of pre-tokenized training samples
+
+A store directory holds every sample of one split, tokenized once with the
+chat template:
+
+    tokens.bin      uint32 token ids of all sequences, back to back
+    loss_mask.bin   uint8, 1 where the token is trained on (the assistant reply)
+    index.npy       int64 [samples, fields, 2]: offset and length of each sequence
+    packs.npy       int64 sample ids of all packs, back to back (optional)
+    pack_offsets.npy  int64 start of every pack in packs.npy, plus the end
+    manifest.json   fields, tokenizer, max_length, source files
+
+SFT samples have one field ("input_ids"); DPO samples two ("chosen", "rejected").
+The .bin files are mmap'ed, so opening a store costs nothing and workers of a
+DataLoader share the pages.
+
+    store = TokenStore("./COT/sft_data/tokenized/train")
+    dataset = PackedDataset(store)     # one item per pack, see collate_packed
+"""
+import os
+import json
+import shutil
+
+import numpy as np
+
+IGNORE_INDEX = -100
+
+
+# =============================
+# Write
+# =============================
+class TokenStoreWriter:
+    """Append samples ([(ids, mask), ...] per field) to a store; written to <dir>.tmp and swapped in on close()."""
+
+    def __init__(self, directory, fields):
+        self.directory = directory
+        self.fields = list(fields)
+        self.tmp_dir = directory + ".tmp"
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+        os.makedirs(self.tmp_dir)
+
+        self._tokens = open(os.path.join(self.tmp_dir, "tokens.bin"), "wb")
+        self._mask = open(os.path.join(self.tmp_dir, "loss_mask.bin"), "wb")
+        self._index = []
+        self._offset = 0
+
+    def add(self, sequences):
+        if len(sequences) != len(self.fields):
+            raise ValueError(f"Expected {len(self.fields)} sequences per sample, got {len(sequences)}")
+        entry = []
+        for ids, mask in sequences:
+            ids = np.asarray(ids, dtype=np.uint32)
+            self._tokens.write(ids.tobytes())
+            self._mask.write(np.asarray(mask, dtype=np.uint8).tobytes())
+            entry.append((self._offset, len(ids)))
+            self._offset += len(ids)
+        self._index.append(entry)
+
+    def close(self, packs=None, **manifest):
+        self._tokens.close()
+        self._mask.close()
+        index = np.asarray(self._index, dtype=np.int64).reshape(len(self._index), len(self.fields), 2)
+        np.save(os.path.join(self.tmp_dir, "index.npy"), index)
+
+        if packs is not None:
+            offsets = np.cumsum([0] + [len(p) for p in packs], dtype=np.int64)
+            flat = np.fromiter((i for p in packs for i in p), dtype=np.int64, count=int(offsets[-1]))
+            np.save(os.path.join(self.tmp_dir, "packs.npy"), flat)
+            np.save(os.path.join(self.tmp_dir, "pack_offsets.npy"), offsets)
+
+        with open(os.path.join(self.tmp_dir, "manifest.json"), "w", encoding="utf-8") as f:
+            json.dump(dict(manifest, fields=self.fields, samples=len(self._index), tokens=self._offset), f, indent=4)
+
+        shutil.rmtree(self.directory, ignore_errors=True)
+        os.replace(self.tmp_dir, self.directory)
+
+
+# =============================
+# Read
+# =============================
+class TokenStore:
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, "manifest.json"), "r", encoding="utf-8") as f:
+            self.manifest = json.load(f)
+        self.fields = self.manifest["fields"]
+
+        self.index = np.load(os.path.join(directory, "index.npy"))
+        # np.memmap cannot map an empty file
+        empty = self.manifest["tokens"] == 0
+        self.tokens = np.zeros(0, np.uint32) if empty else np.memmap(os.path.join(directory, "tokens.bin"), np.uint32, "r")
+        self.loss_mask = np.zeros(0, np.uint8) if empty else np.memmap(os.path.join(directory, "loss_mask.bin"), np.uint8, "r")
+
+        self.packs = self.pack_offsets = None
+        if os.path.exists(os.path.join(directory, "packs.npy")):
+            self.packs = np.load(os.path.join(directory, "packs.npy"))
+            self.pack_offsets = np.load(os.path.join(directory, "pack_offsets.npy"))
+
+    def __len__(self):
+        return len(self.index)
+
+    def lengths(self, field=0):
+        return self.index[:, field, 1]
+
+    def get(self, i, field=0):
+        """(token ids, loss mask) of sample i, as views into the mapped files."""
+        offset, length = self.index[i, field]
+        return self.tokens[offset:offset + length], self.loss_mask[offset:offset + length]
+
+    def num_packs(self):
+        return 0 if self.packs is None else len(self.pack_offsets) - 1
+
+    def pack(self, k):
+        return self.packs[self.pack_offsets[k]:self.pack_offsets[k + 1]]
+
+    def pack_lengths(self):
+        lengths = self.lengths()
+        return [int(lengths[self.pack(k)].sum()) for k in range(self.num_packs())]
+
+
+def labels_for(ids, mask):
+    labels = np.where(mask.astype(bool), ids.astype(np.int64), IGNORE_INDEX)
+    # The first token of a sequence is never a target: it would be predicted from the previous sequence of a pack
+    labels[:1] = IGNORE_INDEX
+    return labels
+
+
+# =============================
+# Datasets and collators (torch is only needed here)
+# =============================
+class PackedDataset:
+    """
+    One item per pack: the packed sequences concatenated, with position_ids
+    restarting at 0 at every sequence boundary. With flash attention, models
+    read those restarts as separate sequences (varlen attention), so no token
+    attends across samples.
+    """
+
+    def __init__(self, store):
+        if store.packs is None:
+            raise ValueError(f"{store.directory} has no packs; build it with packing enabled")
+        self.store = store
+
+    def __len__(self):
+        return self.store.num_packs()
+
+    def __getitem__(self, k):
+        ids, labels, positions = [], [], []
+        for i in self.store.pack(k):
+            seq_ids, mask = self.store.get(i)
+            ids.append(seq_ids.astype(np.int64))
+            labels.append(labels_for(seq_ids, mask))
+            positions.append(np.arange(len(seq_ids), dtype=np.int64))
+        return {"input_ids": np.concatenate(ids), "labels": np.concatenate(labels),
+                "position_ids": np.concatenate(positions)}
+
+
+class SequenceDataset:
+    """One item per sample (no packing), for padded batches with a length-grouped sampler."""
+
+    def __init__(self, store):
+        self.store = store
+
+    def __len__(self):
+        return len(self.store)
+
+    def __getitem__(self, i):
+        ids, mask = self.store.get(i)
+        return {"input_ids": ids.astype(np.int64), "labels": labels_for(ids, mask)}
+
+
+def collate_packed(features):
+    """Padding-free batch: all items of the batch flattened into one row, position_ids marking the boundaries."""
+    import torch
+
+    return {
+        "input_ids": torch.from_numpy(np.concatenate([f["input_ids"] for f in features]))[None],
+        "labels": torch.from_numpy(np.concatenate([f["labels"] for f in features]))[None],
+        "position_ids": torch.from_numpy(np.concatenate([f["position_ids"] for f in features]))[None],
+    }
+
+
+def collate_padded(features, pad_token_id=0):
+    import torch
+
+    width = max(len(f["input_ids"]) for f in features)
+    input_ids = torch.full((len(features), width), pad_token_id, dtype=torch.long)
+    labels = torch.full((len(features), width), IGNORE_INDEX, dtype=torch.long)
+    attention_mask = torch.zeros((len(features), width), dtype=torch.long)
+    for row, f in enumerate(features):
+        n = len(f["input_ids"])
+        input_ids[row, :n] = torch.from_numpy(f["input_ids"])
+        labels[row, :n] = torch.from_numpy(f["labels"])
+        attention_mask[row, :n] = 1
+    return {"input_ids": input_ids, "labels": labels, "attention_mask": attention_mask}
+
+
+class LengthGroupedSampler:
+    """Batch sampler over utils.batching.length_grouped_batches, reshuffled every epoch (set_epoch)."""
+
+    def __init__(self, lengths, batch_size, mega_batch_mult=50, seed=0):
+        self.lengths = list(lengths)
+        self.batch_size = batch_size
+        self.mega_batch_mult = mega_batch_mult
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        from utils.batching import length_grouped_batches
+
+        return iter(length_grouped_batches(self.lengths, self.batch_size, self.mega_batch_mult,
+                                           seed=self.seed + self.epoch))
+
+    def __len__(self):
+        return -(-len(self.lengths) // self.batch_size)